@@ -2,6 +2,7 @@ import cv2,math
 import cfg
 import os
 import subprocess
+import time
 import numpy as np
 from shutil import copy
 # from matplotlib import pyplot as plt
@@ -14,6 +15,23 @@ from skimage.feature import canny
 from skimage.transform import probabilistic_hough_line, rotate
 from detectron2.structures import BoxMode
 from multiprocessing import Pool, cpu_count
+from instrumentation import metrics
+from batch_correction import extract_bests
+from correction_cache import register_worker_flush
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# in-process tesseract handles of this worker, one per page segmentation mode
+tesseract_apis = {}
+
+# gene dictionary of this OCR worker, set once by init_ocr_worker
+worker_user_words = None
+
+# tesseract runs of this process, to compare threshold search strategies
+ocr_call_count = 0
 
 def display(input, file=None, to_print=False):
     if file:
@@ -188,7 +206,12 @@ def hist(src_folder, src_file, log_file,user_words, original_image=None, hist_fo
     height, width = image.shape[0], image.shape[1]
     test_vertical = width != 0 and height / float(width) >= cfg.vertical_ratio_thresh
 
-    if hist_folder and hist_file:
+    if hist_folder and hist_file and cfg.OCR_threshold_search != 'sweep':
+        search = get_threshold_search(cfg.OCR_threshold_search)(hist_folder, hist_file, log_file, user_words)
+        best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
+            all_results, corrected_results, fuzz_ratios, count = search.run(image, test_vertical)
+
+    elif hist_folder and hist_file:
         if test_vertical:
             rotated_90c_image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
             rotate_90cc_image = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
@@ -376,9 +399,10 @@ def test_side(index, start, end, left_bound, right_bound,
                 dst_file = dst_name + dst_ext
                 dst_path = os.path.join(dst_folder, dst_file)
 
+                th1 = None
                 if to_save:
+                    # written to dst_path by ocr_threshold_image when the cli engine needs a file
                     ret1, th1 = cv2.threshold(image, thresh, 255, cv2.THRESH_BINARY)
-                    cv2.imwrite(dst_path, th1)
 
                 if to_deskew:
                     deskew(src_folder, src_file, dst_folder,log_file, dst_file, take_ocr=False)
@@ -387,7 +411,7 @@ def test_side(index, start, end, left_bound, right_bound,
                     all_results, corrected_results, fuzz_ratios, count = \
                     check_if_best_result(thresh, dst_folder, dst_file, log_file,user_words,
                                          best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
-                                         all_results, corrected_results, fuzz_ratios, count)
+                                         all_results, corrected_results, fuzz_ratios, count, image=th1)
         else:
             to_continue = False
             break
@@ -398,21 +422,17 @@ def test_side(index, start, end, left_bound, right_bound,
 
 def check_if_best_result(threshold, dst_folder, dst_file,log_file, user_words,
                          best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
-                         all_results, corrected_results, fuzz_ratios, count):
+                         all_results, corrected_results, fuzz_ratios, count, image=None, result=None):
 
-    dst_name, dst_ext = os.path.splitext(dst_file)
-    result = ocr_text_from_image(dst_folder, dst_file, dst_folder, dst_name)
+    if result is None:
+        result = ocr_threshold_image(dst_folder, dst_file, image)
 
-    result = result.upper().replace('\n', '')
-    result = result.strip()
+    result, corrections = correct_ocr_result(result, user_words)
 
     if not result:
         return best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
             all_results, corrected_results, fuzz_ratios, count
 
-    corrections = process.extractBests(result, user_words, processor=default_processor,
-                                       scorer=fuzz.ratio, score_cutoff=cfg.candidate_threshold)
-
     all_results.add(result)  # add result to set
 
     if not corrections:
@@ -430,6 +450,31 @@ def check_if_best_result(threshold, dst_folder, dst_file,log_file, user_words,
     if corrections[0][0] == best_corrected_result and corrections[0][1] >= cfg.early_stop_threshold:
         count = count + 1.0
 
+    best_result, best_corrected_result, best_fuzz_ratio, best_thresh = \
+        record_corrections(threshold, result, corrections,
+                           best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
+                           all_results, corrected_results, fuzz_ratios)
+
+    return best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
+        all_results, corrected_results, fuzz_ratios, count
+
+
+def correct_ocr_result(result, user_words):
+    """Clean one raw tesseract result and rank its dictionary corrections, returns (result, corrections)."""
+    result = result.upper().replace('\n', '')
+    result = result.strip()
+
+    if not result:
+        return result, []
+
+    corrections = extract_bests(result, user_words, cfg.candidate_threshold)
+    return result, corrections
+
+
+def record_corrections(threshold, result, corrections,
+                       best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
+                       all_results, corrected_results, fuzz_ratios):
+    """Merge the corrections of one threshold into the candidate lists and keep the best one."""
     for i in reversed(range(0, len(corrections))):
         all_results.add(corrections[i][0])
 
@@ -451,14 +496,50 @@ def check_if_best_result(threshold, dst_folder, dst_file,log_file, user_words,
         best_fuzz_ratio = corrections[0][1]
         best_thresh = threshold
 
-    return best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
-        all_results, corrected_results, fuzz_ratios, count
+    return best_result, best_corrected_result, best_fuzz_ratio, best_thresh
+
+
+def init_ocr_worker(user_words=None):
+    """Pool initializer: load the gene dictionary once per worker instead of pickling it into every task."""
+    global worker_user_words
+    if user_words is None:
+        from gene_dictionary import get_gene_names
+        user_words = get_gene_names(upper=False)
+    worker_user_words = user_words
+    # atexit does not run in pool workers, their last corrections are written when the pool closes
+    register_worker_flush()
+
+
+class OCRWorkerPool(object):
+    """
+    Long-lived pool of OCR workers shared by every image of a run.
+
+    Each worker loads the gene dictionary once (see init_ocr_worker) and receives only the cropped
+    ROI of one text box, results are streamed back in the order they finish.
+    """
+
+    def __init__(self, user_words=None, processes=None):
+        self.pool = Pool(processes or cpu_count(), initializer=init_ocr_worker, initargs=(user_words,))
+
+    def imap(self, tasks):
+        return self.pool.imap_unordered(ocr_roi, tasks)
 
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
-def OCR(image_file, sub_image_folder, element_instances, user_words):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def OCR(image_file, sub_image_folder, element_instances, user_words=None, pool=None):
 
     #image_path = os.path.join(cfg.image_folder, image_file)
     image_name, image_ext = os.path.splitext(image_file)
+    start = time.time()
 
     to_fix_folder = os.path.join(sub_image_folder, "to_fix")
     hist_folder = os.path.join(sub_image_folder, "hist")
@@ -491,39 +572,46 @@ def OCR(image_file, sub_image_folder, element_instances, user_words):
 
     image_array = cv2.imread(image_file)
 
-    results = []
     coordinates_list = []
     ocr_results = []
     gene_idx_list = []
 
-    #start run ocr in parallel
-    pool = Pool(cpu_count())
-
-    #generate all ocr arguments for paralleling
-    for element_idx in range(0, len(element_instances)):
-
-        sub_image_name, sub_image_ext = str(element_idx), image_ext
-        sub_image_file = sub_image_name + sub_image_ext
-        sub_image_path = os.path.join(sub_image_folder, sub_image_file)
-        sub_split = sub_image_folder.split('\\')
-        sub_folder_name = sub_split[len(sub_split) - 1]
-        file = sub_folder_name + "_" + sub_image_file
-        results.append(pool.apply_async(crop_sub_image_do_ocr, \
-        (element_instances,element_idx, image_array, sub_image_folder,  sub_image_file,
-                     log_file, file, sub_image_name, sub_image_ext,hist_folder, deskew_folder, user_words)))
-    pool.close()
-    pool.join()
-    #parse the ocr async results
-    for result in results:
-        run_results = result.get()
-        if result.successful() and run_results is not None:
+    # the workers of a shared pool were started with its own gene dictionary
+    if pool is not None and user_words is not None:
+        raise ValueError('pass user_words to the OCRWorkerPool, a shared pool ignores the user_words of OCR()')
+
+    # without a shared pool, fall back to a pool for this image only
+    own_pool = pool is None
+    if own_pool:
+        pool = OCRWorkerPool(user_words)
+
+    #generate ocr tasks lazily, only the cropped ROIs are sent to the workers
+    def ocr_tasks():
+        for element_idx in range(0, len(element_instances)):
+
+            sub_image_name, sub_image_ext = str(element_idx), image_ext
+            sub_image_file = sub_image_name + sub_image_ext
+            sub_split = sub_image_folder.split('\\')
+            sub_folder_name = sub_split[len(sub_split) - 1]
+            file = sub_folder_name + "_" + sub_image_file
+            scaled_roi, roi, size, coordinates = crop_roi(image_array, element_instances.iloc[element_idx]['bbox'])
+            yield (element_idx, scaled_roi, roi, size, coordinates, sub_image_folder, sub_image_file,
+                   log_file, file, sub_image_name, sub_image_ext, hist_folder, deskew_folder)
+
+    #parse the ocr results as they finish
+    finished = []
+    for run_results in pool.imap(ocr_tasks()):
+        if run_results is not None:
             best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
-            all_results, corrected_results, fuzz_ratios, result_element_idx, result_file, result_coordinates = run_results
+            all_results, corrected_results, fuzz_ratios, result_element_idx, result_file, result_coordinates, worker_metrics = run_results
+            # counts and timings of the worker process that ran this box
+            metrics.merge(worker_metrics)
+            sub_image_path = os.path.join(sub_image_folder, str(result_element_idx) + image_ext)
             all_results_dict.update({result_file: all_results})
             corrected_results_dict.update({result_file: corrected_results})
             fuzz_ratios_dict.update({result_file: fuzz_ratios})
             if best_corrected_result and best_corrected_result != "*\t*\t*\t*\t*":
-                ocr_results.append(best_corrected_result)
+                ocr_result = best_corrected_result
                 # update recognized result to dataframe
                 #element_instances.loc[result_element_idx, 'ocr'] = best_corrected_result
             else:
@@ -532,36 +620,49 @@ def OCR(image_file, sub_image_folder, element_instances, user_words):
                     os.mkdir(failed_folder)
                 if not os.path.isdir(to_fix_folder):
                     os.mkdir(to_fix_folder)
-                ocr_results.append('*\t*\t*\t*\t*')
+                ocr_result = '*\t*\t*\t*\t*'
                 # update failed mark to dataframe
                 #element_instances.loc[result_element_idx, 'ocr'] = '*\t*\t*\t*\t*'
 
-                display("fail: \t" + str(sub_image_file) + "\n", file=log_file)
+                display("fail: \t" + str(result_element_idx) + image_ext + "\n", file=log_file)
 
                 failed_path = os.path.join(failed_folder, result_file)
                 to_fix_path = os.path.join(to_fix_folder, result_file)
 
                 copy(sub_image_path, failed_path)
                 copy(sub_image_path, to_fix_path)
-            result_coordinates = result_coordinates.tolist()
-            coordinates_list.append(result_coordinates)
-            gene_idx_list.append(result_element_idx)
+            finished.append((result_element_idx, ocr_result, result_coordinates.tolist()))
         del run_results
 
-    del image_array, pool, results
+    if own_pool:
+        pool.close()
+
+    # keep the element order of the input, whatever order the workers finished in
+    for result_element_idx, ocr_result, result_coordinates in sorted(finished, key=lambda x: x[0]):
+        ocr_results.append(ocr_result)
+        coordinates_list.append(result_coordinates)
+        gene_idx_list.append(result_element_idx)
+
+    del image_array, finished
+    metrics.observe('ocr_image', time.time() - start)
     return ocr_results, all_results_dict, corrected_results_dict, fuzz_ratios_dict, coordinates_list, gene_idx_list
 
 # def crop_sub_image_do_ocr_bridge(args):
 #     return crop_sub_image_do_ocr(args[0],args[1],args[2],args[3],args[4],args[5],args[6],args[7],args[8],args[9],args[10],args[11])
 
 
-def crop_sub_image_do_ocr(element_instances, element_idx, image_array, sub_image_folder,
-                          sub_image_file, log_file, file, sub_image_name, sub_image_ext, hist_folder, deskew_folder, user_words):
-    coordinates = np.array(BoxMode.convert(element_instances.iloc[element_idx]['bbox'],
-                                           BoxMode.XYWH_ABS, BoxMode.XYXY_ABS), dtype=float).reshape((-4, 2))
+def crop_roi(image_array, bbox):
+    """
+    Cut one text box out of the image in the parent process.
 
-    h = int(element_instances.iloc[element_idx]['bbox'][3])
-    w = int(element_instances.iloc[element_idx]['bbox'][2])
+    Returns the ROI with cfg.OCR_OFFSET margin (scaled up for recognition), the plain ROI (for the
+    histogram), the box (h, w) and its corners. The ROIs are copies, so only these small arrays get
+    pickled to a worker instead of the whole image.
+    """
+    coordinates = np.array(BoxMode.convert(bbox, BoxMode.XYWH_ABS, BoxMode.XYXY_ABS), dtype=float).reshape((-4, 2))
+
+    h = int(bbox[3])
+    w = int(bbox[2])
     Xs = [i[0] for i in coordinates]
     Ys = [i[1] for i in coordinates]
     x1 = int(min(Xs))
@@ -572,10 +673,21 @@ def crop_sub_image_do_ocr(element_instances, element_idx, image_array, sub_image
     if y1 < 0:
         y1 = 0
 
+    scaled_roi = image_array[y1 - cfg.OCR_OFFSET:y1 + h + cfg.OCR_OFFSET,
+                             x1 - cfg.OCR_OFFSET:x1 + w + cfg.OCR_OFFSET].copy()
+    roi = image_array[y1:y1 + h, x1:x1 + w].copy()
+    return scaled_roi, roi, (h, w), coordinates
+
+
+def ocr_roi(task):
+    """Worker side of OCRWorkerPool: run the histogram threshold search on one cropped ROI."""
+    element_idx, scaled_roi, roi, (h, w), coordinates, sub_image_folder, sub_image_file, \
+        log_file, file, sub_image_name, sub_image_ext, hist_folder, deskew_folder = task
+    before = metrics.snapshot()
+
     # scaling ROI for better recognition
     try:
-        resized_image = cv2.resize(image_array[y1 - cfg.OCR_OFFSET:y1 + h + cfg.OCR_OFFSET,
-                                   x1 - cfg.OCR_OFFSET:x1 + w + cfg.OCR_OFFSET],
+        resized_image = cv2.resize(scaled_roi,
                                    (int(cfg.OCR_SCALE * w),
                                     int(cfg.OCR_SCALE * h)),
                                    interpolation=cv2.INTER_CUBIC)
@@ -588,16 +700,17 @@ def crop_sub_image_do_ocr(element_instances, element_idx, image_array, sub_image
         hist_file = sub_image_name + sub_image_ext
         deskew_file = sub_image_name + sub_image_ext
 
-        original_image = image_array[y1:y1 + h, x1:x1 + w]
-
-        best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
-        all_results, corrected_results, fuzz_ratios = hist(sub_image_folder, sub_image_file, log_file, user_words,
-                                                           hist_folder=hist_folder, hist_file=hist_file,
-                                                           deskew_folder=deskew_folder, deskew_file=deskew_file,
-                                                           original_image=original_image)
+        with metrics.timer('ocr_box'):
+            best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
+            all_results, corrected_results, fuzz_ratios = hist(sub_image_folder, sub_image_file, log_file, worker_user_words,
+                                                               hist_folder=hist_folder, hist_file=hist_file,
+                                                               deskew_folder=deskew_folder, deskew_file=deskew_file,
+                                                               original_image=roi)
+        metrics.count('ocr_boxes')
 
+        # the parent merges what this box counted, the metrics of a worker process stay there otherwise
         return best_result, best_corrected_result, best_fuzz_ratio, best_thresh, \
-        all_results, corrected_results, fuzz_ratios, element_idx, file, coordinates
+        all_results, corrected_results, fuzz_ratios, element_idx, file, coordinates, metrics.delta(before)
     except Exception as e:
         print(e)
         return None
@@ -633,6 +746,72 @@ def ocr_text_from_image(src_folder, src_file, dst_folder, delete=True, psm=[3, 8
     return result
 
 
+def ocr_threshold_image(dst_folder, dst_file, image=None):
+    """
+    OCR one binarized image with the engine chosen in cfg.OCR_engine. The cli engine reads
+    dst_folder/dst_file (written first if an image is given), the tesserocr engine takes the array.
+    """
+    global ocr_call_count
+    ocr_call_count += 1
+    metrics.count('ocr_calls')
+
+    dst_name, dst_ext = os.path.splitext(dst_file)
+    if cfg.OCR_engine == 'tesserocr':
+        if image is None:
+            image = cv2.imread(os.path.join(dst_folder, dst_file), cv2.IMREAD_GRAYSCALE)
+        return ocr_text_from_array(image)
+    if image is not None:
+        cv2.imwrite(os.path.join(dst_folder, dst_file), image)
+    return ocr_text_from_image(dst_folder, dst_file, dst_folder, dst_name)
+
+
+def get_threshold_search(name):
+    """Look up a threshold search strategy of threshold_search.py by its cfg.OCR_threshold_search name."""
+    from threshold_search import THRESHOLD_SEARCHES
+    return THRESHOLD_SEARCHES[name]
+
+
+def get_tesseract_api(psm):
+    """Return this worker's tesseract handle for one page segmentation mode, created on first use."""
+    if tesserocr is None:
+        raise ImportError('Please install tesserocr first. '
+                          'Check out the installation guide at '
+                          'https://github.com/sirfz/tesserocr')
+    api = tesseract_apis.get(psm)
+    if api is None:
+        # same settings as the cli call in ocr_text_from_image: --oem 3 -l eng+equ
+        api = tesserocr.PyTessBaseAPI(lang='eng+equ', psm=psm, oem=tesserocr.OEM.DEFAULT)
+        tesseract_apis[psm] = api
+    return api
+
+
+def ocr_text_from_array(image, psm=[3, 8, 9]):
+    """
+    In-process counterpart of ocr_text_from_image: the binarized numpy array goes straight into
+    tesseract, no image or text file is written. Tries the psm modes in order and keeps the first
+    one that returns any lines, joined the same way as the cli output.
+    """
+    image = np.ascontiguousarray(image)
+    height, width = image.shape[0], image.shape[1]
+    bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+
+    result = ''
+    for num in range(0, len(psm)):
+        api = get_tesseract_api(psm[num])
+        api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, bytes_per_pixel * width)
+        words = api.GetUTF8Text().splitlines(True)
+        api.Clear()
+
+        if len(words) <= 0:
+            continue
+        else:
+            for word in words:
+                result += word + " "
+            break
+
+    return result
+
+
 
 
 
@@ -0,0 +1,140 @@
+import numpy as np
+from fuzzywuzzy import fuzz, process
+from fuzzywuzzy.process import default_processor
+
+import cfg
+from correction_cache import get_correction_cache
+from identity_cache import IdentityCache
+
+try:
+    from rapidfuzz import fuzz as rapid_fuzz
+    from rapidfuzz import process as rapid_process
+except ImportError:
+    rapid_fuzz = None
+    rapid_process = None
+
+# names of the dictionaries in use through default_processor, processed once per object
+_processed = IdentityCache(lambda gene_names: [default_processor(name) for name in gene_names])
+
+
+def compiled_scorer_available():
+    return rapid_process is not None
+
+
+def processed_names(gene_names):
+    return _processed.get(gene_names)
+
+
+def score_matrix(texts, gene_names):
+    '''
+
+    fuzz.ratio of every text against every gene name, both through default_processor as extractBests does
+
+    Args:
+        texts: OCR strings
+        gene_names: list of gene names
+
+    Return:
+        (np.ndarray) len(texts) x len(gene_names) integer scores
+
+    '''
+    queries = [default_processor(text) for text in texts]
+    choices = processed_names(gene_names)
+    # rapidfuzz.fuzz.ratio is the python-Levenshtein ratio fuzzywuzzy uses, round it as fuzzywuzzy does
+    scores = rapid_process.cdist(queries, choices, scorer=rapid_fuzz.ratio, dtype=np.float64,
+                                 workers=cfg.batch_correction_workers)
+    scores = np.rint(scores).astype(np.int64)
+
+    # fuzz.ratio calls two equal strings a match before it calls an empty one a miss
+    for row, query in enumerate(queries):
+        if not query:
+            scores[row] = [100 if not choice else 0 for choice in choices]
+    return scores
+
+
+def top_k(scores, gene_names, score_cutoff, limit):
+    """Best limit (gene name, score) of one row at or above score_cutoff, the first gene on ties, as extractBests."""
+    order = np.argsort(-scores, kind='stable')[:limit]
+    return [(gene_names[k], int(scores[k])) for k in order if scores[k] >= score_cutoff]
+
+
+def compute_bests(texts, gene_names, score_cutoff, limit):
+    if rapid_process is None:
+        return [process.extractBests(text, gene_names, processor=default_processor, scorer=fuzz.ratio,
+                                     score_cutoff=score_cutoff, limit=limit) for text in texts]
+
+    # bounded score matrices, a figure of 100 strings against 200k names would need 160 MB at once
+    rows = max(1, cfg.batch_correction_max_cells // max(len(gene_names), 1))
+    bests = []
+    for start in range(0, len(texts), rows):
+        for row_scores in score_matrix(texts[start:start + rows], gene_names):
+            bests.append(top_k(row_scores, gene_names, score_cutoff, limit))
+    return bests
+
+
+def batch_extract_bests(texts, gene_names, score_cutoff=None, limit=5):
+    '''
+
+    process.extractBests with fuzz.ratio for a batch of OCR strings, e.g. every text box of a figure
+
+    Args:
+        texts: OCR strings
+        gene_names: list of gene names
+        score_cutoff: lowest score kept, cfg.candidate_threshold if None
+        limit: corrections kept per string
+
+    Return:
+        (list) per string the (gene name, score) pairs, best first, as extractBests returns them
+
+    '''
+    texts = list(texts)
+    score_cutoff = cfg.candidate_threshold if score_cutoff is None else score_cutoff
+    compute_many = lambda missed: compute_bests(missed, gene_names, score_cutoff, limit)
+    if not cfg.correction_cache:
+        return compute_many(texts)
+    scorer = 'extract_bests' if limit == 5 else 'extract_bests_{:d}'.format(limit)
+    return get_correction_cache().get_many(scorer, gene_names, score_cutoff, texts, compute_many)
+
+
+def extract_bests(text, gene_names, score_cutoff):
+    '''
+
+    batch_extract_bests of one string, for callers that can not wait for the others (the threshold search)
+
+    Return:
+        (list) (gene name, score) pairs, best first
+
+    '''
+    return batch_extract_bests([text], gene_names, score_cutoff)[0]
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    from gene_dictionary import get_gene_names
+
+    # the text boxes of a dense figure: gene names, names with one character misread, and junk
+    gene_names = get_gene_names()
+    random.seed(0)
+    texts = []
+    for gene in random.sample(gene_names, 40):
+        texts.append(gene)
+        pos = random.randrange(len(gene))
+        texts.append(gene[:pos] + random.choice('01ILO-') + gene[pos + 1:])
+    texts.extend(['-', 'P', '', 'X7#', 'PI3K', 'AKT'])
+
+    start = time.time()
+    expected = [process.extractBests(text, gene_names, processor=default_processor, scorer=fuzz.ratio,
+                                     score_cutoff=cfg.candidate_threshold) for text in texts]
+    loop_time = time.time() - start
+
+    cfg.correction_cache = False
+    start = time.time()
+    found = batch_extract_bests(texts, gene_names)
+    batch_time = time.time() - start
+
+    same = sum(f == e for f, e in zip(found, expected))
+    print('{:d} strings x {:d} names: extractBests loop {:.2f}s, {:s} {:.2f}s, {:d} identical results'.format(
+        len(texts), len(gene_names), loop_time, 'score matrix' if compiled_scorer_available() else 'fallback loop',
+        batch_time, same))
@@ -14,57 +14,62 @@ import torch
 from detectron2.config import get_cfg
 from detectron2.data.build import DatasetMapper, trivial_batch_collator
 from OCR import OCR
+from gene_dictionary import get_gene_names
 from fuzzywuzzy import fuzz, process
 from fuzzywuzzy.process import default_processor
 import cfg
 import cfg_head
 from detectron2.checkpoint import DetectionCheckpointer
-from plain_train_net import ValidationSampler
 from train_net import RegularTrainer,Trainer
 from contextlib import contextmanager
 import numpy as np
 from GCV import gcv_ocr
 from relation_data_tool import PathwayDatasetMapper
+from image_manifest import get_image_manifest
 from shape_tool import relation_covers_this_element
 from formulate_relation import get_subimg, translation_transform_on_element_bbox, perspective_transform_on_element_bbox\
     ,find_largest_area_symbols,find_vertex_for_detected_relation_symbol_by_distance,dist_center,find_best_text,\
     center_point_in_box,calculate_distance_between_two_boxes
-from swaps import swaps
-from nfkc import nfkc
-from deburr import deburr
-from upper import upper
-from expand import expand
+from text_normalizer import normalize_tokens
 # write a function that loads the dataset into detectron2's standard format
 def get_data_dicts(img_path):
     # go through all label files
     dataset_dicts = []
     print("print from body interface line 40",img_path)
-    for idx, img_file in enumerate(os.listdir(img_path)):
-        try:
-
-            # read key and value from current json file
-            filename = os.path.join(img_path, img_file)
-            img = cv2.imread(filename)
-            height, width = img.shape[:2]
-            del img
-        except Exception as e:
-            # print(str(e))
-            continue
+    # sizes come from the image manifest, only new or changed files are read, and only their headers
+    for idx, filename, entry in get_image_manifest(img_path).images():
 
         # declare a dict variant to save the content
         record = {}
 
         record["file_name"] = filename
         record["image_id"] = idx
-        record["height"] = height
-        record["width"] = width
+        record["height"] = entry["height"]
+        record["width"] = entry["width"]
         record["annotations"] = None
         dataset_dicts.append(record)
 
     return dataset_dicts
 
 
-def build_data_fold_loader(cfg, data_folder, mapper=None):
+def aspect_ratio_batches(dataset_dicts, batch_size):
+    '''
+
+    Args:
+        dataset_dicts: records of get_data_dicts, with height and width
+        batch_size: images per batch
+
+    Return:
+        (list) batches of dataset indices, figures of similar width / height batched together so the
+        model pads them less
+
+    '''
+    order = sorted(range(len(dataset_dicts)),
+                   key=lambda k: (dataset_dicts[k]["width"] / float(dataset_dicts[k]["height"]), k))
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def build_data_fold_loader(cfg, data_folder, mapper=None, batch_size=None, keep=None):
     """
     Similar to `build_detection_test_loader`.
     But this function uses the given `dataset_name` argument (instead of the names in cfg),
@@ -75,6 +80,8 @@ def build_data_fold_loader(cfg, data_folder, mapper=None):
         mapper (callable): a callable which takes a sample (dict) from dataset
            and returns the format to be consumed by the model.
            By default it will be `DatasetMapper(cfg, False)`.
+        batch_size (int): images per model forward, `cfg.SOLVER.IMS_PER_BATCH` by default
+        keep (callable): takes a dataset dict, figures it returns False for are not loaded
 
     Returns:
         DataLoader: a torch DataLoader, that loads the given detection
@@ -83,14 +90,15 @@ def build_data_fold_loader(cfg, data_folder, mapper=None):
     print("data_folder",data_folder)
     dataset_dicts = list(itertools.chain.from_iterable([get_data_dicts(data_folder)]))
     # dataset_dicts = list(itertools.chain.from_iterable(get_data_dicts(data_folder)))
+    if keep is not None:
+        dataset_dicts = [record for record in dataset_dicts if keep(record)]
     dataset = DatasetFromList(dataset_dicts)
     if mapper is None:
         mapper = DatasetMapper(cfg, False)
     dataset = MapDataset(dataset, mapper)
 
-    sampler = ValidationSampler(len(dataset))
-
-    batch_sampler = torch.utils.data.sampler.BatchSampler(sampler, cfg.SOLVER.IMS_PER_BATCH, drop_last=False)
+    # group figures by aspect ratio, a batch is padded to its largest image
+    batch_sampler = aspect_ratio_batches(dataset_dicts, batch_size or cfg.SOLVER.IMS_PER_BATCH)
 
     data_loader = torch.utils.data.DataLoader(
         dataset,
@@ -102,6 +110,10 @@ def build_data_fold_loader(cfg, data_folder, mapper=None):
     return data_loader
 
 
+# keys of every prediction of instances_to_coco_json
+COCO_COLUMNS = ["image_id", "file_name", "category_id", "bbox", "score"]
+
+
 def instances_to_coco_json(instances, img_id, file_name):
     """
     Dump an "Instances" object to a COCO-format json that's used for evaluation.
@@ -135,6 +147,25 @@ def instances_to_coco_json(instances, img_id, file_name):
     return results
 
 
+def outputs_to_coco_json(outputs, inputs):
+    '''
+
+    Args:
+        outputs: model outputs of one batch
+        inputs: the batch given to the model
+
+    Return:
+        (list) COCO-format predictions of every image in the batch
+
+    '''
+    cpu_device = torch.device("cpu")
+    predictions = []
+    for output, input_per_image in zip(outputs, inputs):
+        instances = output["instances"].to(cpu_device)
+        predictions.extend(instances_to_coco_json(instances, input_per_image["image_id"], input_per_image['file_name']))
+    return predictions
+
+
 def inference_on_dataset(model, data_loader):
     """
     Run model on the data_loader and evaluate the metrics with evaluator.
@@ -166,8 +197,7 @@ def inference_on_dataset(model, data_loader):
         for idx, inputs in enumerate(data_loader):
             # print('&&&&&',idx,inputs)
             output = model.to(device)(inputs)
-            instances = output[0]["instances"].to(cpu_device)
-            prediction = instances_to_coco_json(instances, inputs[0]["image_id"], inputs[0]['file_name'])
+            prediction = outputs_to_coco_json(output, inputs)
             predictions.extend(prediction)
             del prediction
             # print(prediction)
@@ -593,8 +623,7 @@ def compute_dis(point1,point2):
 
 def run_model(cfg, relation_h, **kwargs):
     print("entered run_model")
-    with open(cfg.dictionary_path) as gene_name_list_fp:
-        gene_name_list = json.load(gene_name_list_fp)
+    gene_name_list = get_gene_names(upper=False)
 
     configuration = setup(cfg, kwargs)
 
@@ -609,7 +638,8 @@ def run_model(cfg, relation_h, **kwargs):
         os.mkdir(ocr_sub_img_folder)
     
 
-    data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False))
+    data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False),
+                                         batch_size=cfg.detection_batch_size)
     
     img_size = {}
     img_size['image_size'] = [data_loader.dataset[0]['height'], data_loader.dataset[0]['width']]
@@ -621,8 +651,7 @@ def run_model(cfg, relation_h, **kwargs):
         for idx, inputs in enumerate(data_loader):
             # print('&&&&&',idx,inputs)
             output = model.to(device)(inputs)
-            instances = output[0]["instances"].to(cpu_device)
-            predictions = instances_to_coco_json(instances, inputs[0]["image_id"], inputs[0]['file_name'])
+            predictions = outputs_to_coco_json(output, inputs)
     # predictions = inference_on_dataset(model, data_loader)
 
             element_instances = pd.DataFrame(predictions)
@@ -659,20 +688,7 @@ def run_model(cfg, relation_h, **kwargs):
                 # postprocessing
                 # nfkc->deburr->upper->expand->swap
 
-                postprocessing_ocr_results = []
-                for r in ocr_results:
-                    r = nfkc(r)
-                    r = ''.join(r)
-                    r = deburr(r)
-                    r = ''.join(r)
-                    r = upper(r)
-                    r = ''.join(r)
-                    r = expand(r)
-                    r = ''.join(r)
-                    pp_r = swaps(r)
-                    pp_r = ''.join(pp_r)
-
-                    postprocessing_ocr_results.append(pp_r)
+                postprocessing_ocr_results = normalize_tokens(ocr_results)
 
                 # print("\nocr_results\n",ocr_results)
                 # print('\npostprocessing_ocr_results\n',postprocessing_ocr_results)
@@ -28,11 +28,8 @@ from shape_tool import relation_covers_this_element
 from formulate_relation import get_subimg, translation_transform_on_element_bbox, perspective_transform_on_element_bbox\
     ,find_largest_area_symbols,find_vertex_for_detected_relation_symbol_by_distance,dist_center,find_best_text,\
     center_point_in_box,calculate_distance_between_two_boxes
-from swaps import swaps
-from nfkc import nfkc
-from deburr import deburr
-from upper import upper
-from expand import expand
+from text_normalizer import normalize_tokens
+from gene_dictionary import get_gene_names
 # write a function that loads the dataset into detectron2's standard format
 def get_data_dicts(img_path):
     # go through all label files
@@ -591,8 +588,8 @@ def compute_dis(point1,point2):
     return dis    
 
 def run_model(cfg, relation_h, **kwargs):
-    with open(cfg.dictionary_path) as gene_name_list_fp:
-        gene_name_list = json.load(gene_name_list_fp)
+    # get gene dictionary, loaded once per process
+    gene_name_list = get_gene_names(upper=False)
 
     configuration = setup(cfg, kwargs)
 
@@ -656,20 +653,7 @@ def run_model(cfg, relation_h, **kwargs):
                 # postprocessing
                 # nfkc->deburr->upper->expand->swap
 
-                postprocessing_ocr_results = []
-                for r in ocr_results:
-                    r = nfkc(r)
-                    r = ''.join(r)
-                    r = deburr(r)
-                    r = ''.join(r)
-                    r = upper(r)
-                    r = ''.join(r)
-                    r = expand(r)
-                    r = ''.join(r)
-                    pp_r = swaps(r)
-                    pp_r = ''.join(pp_r)
-
-                    postprocessing_ocr_results.append(pp_r)
+                postprocessing_ocr_results = normalize_tokens(ocr_results)
 
                 # print("\nocr_results\n",ocr_results)
                 # print('\npostprocessing_ocr_results\n',postprocessing_ocr_results)
@@ -12,7 +12,7 @@ from torchvision import datasets, transforms
 import torch
 from detectron2.config import get_cfg
 from detectron2.data.build import DatasetMapper, trivial_batch_collator
-from OCR import OCR
+from OCR import OCR, OCRWorkerPool
 from fuzzywuzzy import fuzz, process
 from fuzzywuzzy.process import default_processor
 import cfg
@@ -28,11 +28,7 @@ from shape_tool import relation_covers_this_element
 from formulate_relation import get_subimg, translation_transform_on_element_bbox, perspective_transform_on_element_bbox\
     ,find_largest_area_symbols,find_vertex_for_detected_relation_symbol_by_distance,dist_center,find_best_text,\
     center_point_in_box,calculate_distance_between_two_boxes
-from swaps import swaps
-from nfkc import nfkc
-from deburr import deburr
-from upper import upper
-from expand import expand
+from text_normalizer import normalize_tokens
 # write a function that loads the dataset into detectron2's standard format
 def get_data_dicts(img_path):
     # go through all label files
@@ -588,9 +584,6 @@ def compute_iou(box1, box2, wh=True):
 
 
 def run_model(cfg, relation_h, **kwargs):
-    with open(cfg.dictionary_path) as gene_name_list_fp:
-        gene_name_list = json.load(gene_name_list_fp)
-
     configuration = setup(cfg, kwargs)
 
     model = RegularTrainer.build_model(configuration)
@@ -604,336 +597,326 @@ def run_model(cfg, relation_h, **kwargs):
         os.mkdir(ocr_sub_img_folder)
 
     data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False))
+
+    # one pool of OCR workers for the whole run, each worker loads the gene dictionary once
+    with OCRWorkerPool() as ocr_pool:
   
-    img_size = {}
-    img_size['image_size'] = [data_loader.dataset[0]['height'], data_loader.dataset[0]['width']]
-    # print('data_loader.dataset[0]',data_loader.dataset[0])
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    cpu_device = torch.device("cpu")
-    predictions = []
-    with inference_context(model.to(device)), torch.no_grad():
-        for idx, inputs in enumerate(data_loader):
-            # print('&&&&&',idx,inputs)
-            output = model.to(device)(inputs)
-            instances = output[0]["instances"].to(cpu_device)
-            predictions = instances_to_coco_json(instances, inputs[0]["image_id"], inputs[0]['file_name'])
-    # predictions = inference_on_dataset(model, data_loader)
-
-            element_instances = pd.DataFrame(predictions)
-            # print('element_instances',element_instances)
-            element_instances['ocr'] = None
-            element_instances['head'] = None
-            element_instances['tail'] = None
-            element_instances_on_samples = element_instances.loc[(element_instances['score'] >= cfg.element_threshold) \
-                                                                 & (element_instances['category_id'] == cfg.element_list.index(
-                'gene'))]
-
-            relation_symbol_instances_on_samples = element_instances.loc[(element_instances['score'] >= cfg.element_threshold) \
-                                                                         & (element_instances[
-                                                                                'category_id'] != cfg.element_list.index(
-                'gene'))]
-            # print('relation_symbol_instances_on_samples', relation_symbol_instances_on_samples)
+        img_size = {}
+        img_size['image_size'] = [data_loader.dataset[0]['height'], data_loader.dataset[0]['width']]
+        # print('data_loader.dataset[0]',data_loader.dataset[0])
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        cpu_device = torch.device("cpu")
+        predictions = []
+        with inference_context(model.to(device)), torch.no_grad():
+            for idx, inputs in enumerate(data_loader):
+                # print('&&&&&',idx,inputs)
+                output = model.to(device)(inputs)
+                instances = output[0]["instances"].to(cpu_device)
+                predictions = instances_to_coco_json(instances, inputs[0]["image_id"], inputs[0]['file_name'])
+        # predictions = inference_on_dataset(model, data_loader)
+
+                element_instances = pd.DataFrame(predictions)
+                # print('element_instances',element_instances)
+                element_instances['ocr'] = None
+                element_instances['head'] = None
+                element_instances['tail'] = None
+                element_instances_on_samples = element_instances.loc[(element_instances['score'] >= cfg.element_threshold) \
+                                                                     & (element_instances['category_id'] == cfg.element_list.index(
+                    'gene'))]
+
+                relation_symbol_instances_on_samples = element_instances.loc[(element_instances['score'] >= cfg.element_threshold) \
+                                                                             & (element_instances[
+                                                                                    'category_id'] != cfg.element_list.index(
+                    'gene'))]
+                # print('relation_symbol_instances_on_samples', relation_symbol_instances_on_samples)
           
-            # do OCR
-            file_list = set(element_instances_on_samples['file_name'])
-            for file_name in file_list:
-                image_name, _ = os.path.splitext(os.path.basename(file_name))
-                print('doing ocr to file {:s}'.format(file_name))
-                # img_id = element_instances_on_samples.loc[element_instances['file_name'] == file_name]['image_id'].iloc[0]
-                img_id = \
-                element_instances_on_samples[element_instances_on_samples['file_name'] == file_name]['image_id'].values[0]
-
-                element_instances_on_sample = element_instances_on_samples.loc[element_instances_on_samples['file_name'] == file_name]
-
-                ocr_results, all_results_dict, corrected_results_dict, fuzz_ratios_dict, coordinates_list, element_idx_list = \
-                 OCR(file_name, ocr_sub_img_folder, element_instances_on_sample, user_words=gene_name_list)
-                # print('coordinates_list',coordinates_list)
-                # ocr_results, coordinates_list = gcv_ocr(file_name)
-                # postprocessing
-                # nfkc->deburr->upper->expand->swap
-
-                postprocessing_ocr_results = []
-                for r in ocr_results:
-                    r = nfkc(r)
-                    r = ''.join(r)
-                    r = deburr(r)
-                    r = ''.join(r)
-                    r = upper(r)
-                    r = ''.join(r)
-                    r = expand(r)
-                    r = ''.join(r)
-                    pp_r = swaps(r)
-                    pp_r = ''.join(pp_r)
-
-                    postprocessing_ocr_results.append(pp_r)
-
-                # print("\nocr_results\n",ocr_results)
-                # print('\npostprocessing_ocr_results\n',postprocessing_ocr_results)
-
-
-                ocr_prediction_results = []
-                for k in range(1, len(postprocessing_ocr_results)):
-                    result = {
-                        "image_id": img_id,
-                        "file_name": file_name,
-                        "category_id": 1,
-                        "bbox": BoxMode.convert(np.array([coordinates_list[k][0], coordinates_list[k][1]]).reshape((-1, 4)),BoxMode.XYXY_ABS, BoxMode.XYXY_ABS).tolist()[0],
-                        "score": float(1),
-                        "ocr": postprocessing_ocr_results[k]
-                    }
-                    ocr_prediction_results.append(result)
-
-                new_element_instances_on_samples = pd.DataFrame(ocr_prediction_results)
-                # new_element_instances_on_samples['bbox'] = element_instances['bbox']
-                # print('new_element_instances_on_samples',new_element_instances_on_samples['bbox'])
-                for i in range(0,len(new_element_instances_on_samples)):
-                    new_element_instances_on_samples['bbox'][i][2]= new_element_instances_on_samples['bbox'][i][2] -new_element_instances_on_samples['bbox'][i][0]
-                    new_element_instances_on_samples['bbox'][i][3]= new_element_instances_on_samples['bbox'][i][3] -new_element_instances_on_samples['bbox'][i][1]
-
-                relation_symbol_instances_on_samples = pd.concat([new_element_instances_on_samples, relation_symbol_instances_on_samples],
-                                              ignore_index=True)
-                # print('relation_symbol_instances_on_samples',relation_symbol_instances_on_samples)
-                # plot ocr results on images
-                # current_img = cv2.imread(file_name)
-                # for result_idx in range(1, len(ocr_results)):
-                #     cv2.putText(current_img, ocr_results[result_idx].encode('utf-8').decode('utf-8'),
-                #                 tuple(np.array(coordinates_list[result_idx][0], np.int)),
-                #                 cv2.FONT_HERSHEY_COMPLEX_SMALL,
-                #                 1, (0, 0, 255), 1)
-                #     # add ocr results to dataframe of element prediction results
-                #     # set_ocr_results_to_element_instance_df(element_instances,
-                #     #                                        element_instances_on_sample.iloc[element_idx_list[result_idx]]['bbox'],
-                #     #                                        results[result_idx])
-                # img_name, img_ext = os.path.splitext(file_name)
-                # cv2.imwrite(img_name + '_ocr' + img_ext, current_img)
-                # del current_img
-
-                # save results
-                json_dicts = []
-                json_dicts.append(img_size)
-                for i in range(1, len(postprocessing_ocr_results)):
-                    json_dict = {}
-                    json_dict['gene_name'] = postprocessing_ocr_results[i]
-                    json_dict['coordinates'] = \
-                    BoxMode.convert(np.array([coordinates_list[i][0], coordinates_list[i][1]]).reshape((-1, 4)),
-                                    BoxMode.XYXY_ABS, BoxMode.XYXY_ABS).tolist()[0]
-                    # add ocr results to dataframe of element prediction results
-                    # set_ocr_results_to_element_instance_df(element_instances, element_instances_on_sample.iloc[element_idx_list[i]]['bbox'], results[i])
-                    json_dicts.append(json_dict)
-                # with open(data_folder + 'output-1.json', 'w+', encoding='utf-8') as file:
-                #     json.dump(json_dicts, file, ensure_ascii=False)
-                # with open(data_folder + 'output-1.json', 'w+', encoding='utf-8') as file:
-                #     json.dump(json_dicts, file)
-                with open(data_folder + '{:s}_elements.json'.format(image_name), 'w+', encoding='utf-8') as file:
-                    json.dump(json_dicts, file)
-
-                del ocr_results, coordinates_list, json_dicts,postprocessing_ocr_results
-
-            element_instances = relation_symbol_instances_on_samples
-            relation_subimage_path = os.path.join(data_folder, 'relation_subimage')
-            if not os.path.isdir(relation_subimage_path):
-                os.mkdir(relation_subimage_path)
-
-            element_instances['normalized_bbox'] = None
-
-            # todo: organize results from one image as a group and sort by their scores
-            # element_instances.sort_values(by='score', ascending=False, inplace=True)
-
-            # run relation prediction
-            relation_predictions = predict(cfg.relation_config_file, 'relation', data_folder)
-            # print('relation_predictions',relation_predictions[0])
-            # read the relations according to the same image
-            relation_instances = pd.DataFrame(relation_predictions)
-            # print('relation_instances',relation_instances)
-            # add startor and receptor columns into relation_instances
-
-            relation_instances['normalized_bbox'] = None
-            relation_instances['startor'] = None
-            relation_instances['relation_category'] = None
-            relation_instances['receptor'] = None
-
-            image_file_list = set(element_instances['file_name'])
-            for current_image_file in image_file_list:
-                image_name, image_ext = os.path.splitext(os.path.basename(current_image_file))
-                element_instances_on_sample = element_instances[(element_instances['file_name'] == current_image_file) &
-                                                                (element_instances['score'] >= cfg.element_threshold)]
-                # print('element_instances_on_sample\n',element_instances_on_sample)
-                relation_instances_on_sample = relation_instances[(relation_instances['file_name'] == current_image_file) &
-                                                                  (relation_instances['score'] >= cfg.relation_threshold)]
+                # do OCR
+                file_list = set(element_instances_on_samples['file_name'])
+                for file_name in file_list:
+                    image_name, _ = os.path.splitext(os.path.basename(file_name))
+                    print('doing ocr to file {:s}'.format(file_name))
+                    # img_id = element_instances_on_samples.loc[element_instances['file_name'] == file_name]['image_id'].iloc[0]
+                    img_id = \
+                    element_instances_on_samples[element_instances_on_samples['file_name'] == file_name]['image_id'].values[0]
+
+                    element_instances_on_sample = element_instances_on_samples.loc[element_instances_on_samples['file_name'] == file_name]
+
+                    ocr_results, all_results_dict, corrected_results_dict, fuzz_ratios_dict, coordinates_list, element_idx_list = \
+                     OCR(file_name, ocr_sub_img_folder, element_instances_on_sample, pool=ocr_pool)
+                    # print('coordinates_list',coordinates_list)
+                    # ocr_results, coordinates_list = gcv_ocr(file_name)
+                    # postprocessing
+                    # nfkc->deburr->upper->expand->swap
+
+                    postprocessing_ocr_results = normalize_tokens(ocr_results)
+
+                    # print("\nocr_results\n",ocr_results)
+                    # print('\npostprocessing_ocr_results\n',postprocessing_ocr_results)
+
+
+                    ocr_prediction_results = []
+                    for k in range(1, len(postprocessing_ocr_results)):
+                        result = {
+                            "image_id": img_id,
+                            "file_name": file_name,
+                            "category_id": 1,
+                            "bbox": BoxMode.convert(np.array([coordinates_list[k][0], coordinates_list[k][1]]).reshape((-1, 4)),BoxMode.XYXY_ABS, BoxMode.XYXY_ABS).tolist()[0],
+                            "score": float(1),
+                            "ocr": postprocessing_ocr_results[k]
+                        }
+                        ocr_prediction_results.append(result)
+
+                    new_element_instances_on_samples = pd.DataFrame(ocr_prediction_results)
+                    # new_element_instances_on_samples['bbox'] = element_instances['bbox']
+                    # print('new_element_instances_on_samples',new_element_instances_on_samples['bbox'])
+                    for i in range(0,len(new_element_instances_on_samples)):
+                        new_element_instances_on_samples['bbox'][i][2]= new_element_instances_on_samples['bbox'][i][2] -new_element_instances_on_samples['bbox'][i][0]
+                        new_element_instances_on_samples['bbox'][i][3]= new_element_instances_on_samples['bbox'][i][3] -new_element_instances_on_samples['bbox'][i][1]
+
+                    relation_symbol_instances_on_samples = pd.concat([new_element_instances_on_samples, relation_symbol_instances_on_samples],
+                                                  ignore_index=True)
+                    # print('relation_symbol_instances_on_samples',relation_symbol_instances_on_samples)
+                    # plot ocr results on images
+                    # current_img = cv2.imread(file_name)
+                    # for result_idx in range(1, len(ocr_results)):
+                    #     cv2.putText(current_img, ocr_results[result_idx].encode('utf-8').decode('utf-8'),
+                    #                 tuple(np.array(coordinates_list[result_idx][0], np.int)),
+                    #                 cv2.FONT_HERSHEY_COMPLEX_SMALL,
+                    #                 1, (0, 0, 255), 1)
+                    #     # add ocr results to dataframe of element prediction results
+                    #     # set_ocr_results_to_element_instance_df(element_instances,
+                    #     #                                        element_instances_on_sample.iloc[element_idx_list[result_idx]]['bbox'],
+                    #     #                                        results[result_idx])
+                    # img_name, img_ext = os.path.splitext(file_name)
+                    # cv2.imwrite(img_name + '_ocr' + img_ext, current_img)
+                    # del current_img
+
+                    # save results
+                    json_dicts = []
+                    json_dicts.append(img_size)
+                    for i in range(1, len(postprocessing_ocr_results)):
+                        json_dict = {}
+                        json_dict['gene_name'] = postprocessing_ocr_results[i]
+                        json_dict['coordinates'] = \
+                        BoxMode.convert(np.array([coordinates_list[i][0], coordinates_list[i][1]]).reshape((-1, 4)),
+                                        BoxMode.XYXY_ABS, BoxMode.XYXY_ABS).tolist()[0]
+                        # add ocr results to dataframe of element prediction results
+                        # set_ocr_results_to_element_instance_df(element_instances, element_instances_on_sample.iloc[element_idx_list[i]]['bbox'], results[i])
+                        json_dicts.append(json_dict)
+                    # with open(data_folder + 'output-1.json', 'w+', encoding='utf-8') as file:
+                    #     json.dump(json_dicts, file, ensure_ascii=False)
+                    # with open(data_folder + 'output-1.json', 'w+', encoding='utf-8') as file:
+                    #     json.dump(json_dicts, file)
+                    with open(data_folder + '{:s}_elements.json'.format(image_name), 'w+', encoding='utf-8') as file:
+                        json.dump(json_dicts, file)
+
+                    del ocr_results, coordinates_list, json_dicts,postprocessing_ocr_results
+
+                element_instances = relation_symbol_instances_on_samples
+                relation_subimage_path = os.path.join(data_folder, 'relation_subimage')
+                if not os.path.isdir(relation_subimage_path):
+                    os.mkdir(relation_subimage_path)
+
+                element_instances['normalized_bbox'] = None
+
+                # todo: organize results from one image as a group and sort by their scores
+                # element_instances.sort_values(by='score', ascending=False, inplace=True)
+
+                # run relation prediction
+                relation_predictions = predict(cfg.relation_config_file, 'relation', data_folder)
+                # print('relation_predictions',relation_predictions[0])
+                # read the relations according to the same image
+                relation_instances = pd.DataFrame(relation_predictions)
+                # print('relation_instances',relation_instances)
+                # add startor and receptor columns into relation_instances
+
+                relation_instances['normalized_bbox'] = None
+                relation_instances['startor'] = None
+                relation_instances['relation_category'] = None
+                relation_instances['receptor'] = None
+
+                image_file_list = set(element_instances['file_name'])
+                for current_image_file in image_file_list:
+                    image_name, image_ext = os.path.splitext(os.path.basename(current_image_file))
+                    element_instances_on_sample = element_instances[(element_instances['file_name'] == current_image_file) &
+                                                                    (element_instances['score'] >= cfg.element_threshold)]
+                    # print('element_instances_on_sample\n',element_instances_on_sample)
+                    relation_instances_on_sample = relation_instances[(relation_instances['file_name'] == current_image_file) &
+                                                                      (relation_instances['score'] >= cfg.relation_threshold)]
                 
-                # find relation head
-                relationhead = relation_h[(relation_h['file_name'] == current_image_file)]
-
-                relation_head = relationhead['bbox'].tolist()
-                element_relation = element_instances[(element_instances['file_name'] == current_image_file)&(element_instances['category_id']!=1)]
-                relation_body = element_relation['bbox'].tolist()
-                # print(relation_body)
-                for i in range(0,len(relation_body)):
-                    iou=0
-                    temp_iou=0
-                    for j in range(0,len(relation_head)):
-                        # print('relation_head[i],relation_body[j]',relation_head[i],relation_body[j])
-                        temp_iou,center = compute_iou(relation_head[j],relation_body[i],True)
-                        if temp_iou>iou:
-                            iou = temp_iou
-                            element_instances_on_sample['head'][element_relation.index[i]] = center
-                        else:
-                            element_instances_on_sample['head'][element_relation.index[i]] = [0,0]
-                # print("iou",center)
-                # print('compute after relation_symbol_instances_on_samples', relation_symbol_instances_on_samples)
+                    # find relation head
+                    relationhead = relation_h[(relation_h['file_name'] == current_image_file)]
+
+                    relation_head = relationhead['bbox'].tolist()
+                    element_relation = element_instances[(element_instances['file_name'] == current_image_file)&(element_instances['category_id']!=1)]
+                    relation_body = element_relation['bbox'].tolist()
+                    # print(relation_body)
+                    for i in range(0,len(relation_body)):
+                        iou=0
+                        temp_iou=0
+                        for j in range(0,len(relation_head)):
+                            # print('relation_head[i],relation_body[j]',relation_head[i],relation_body[j])
+                            temp_iou,center = compute_iou(relation_head[j],relation_body[i],True)
+                            if temp_iou>iou:
+                                iou = temp_iou
+                                element_instances_on_sample['head'][element_relation.index[i]] = center
+                            else:
+                                element_instances_on_sample['head'][element_relation.index[i]] = [0,0]
+                    # print("iou",center)
+                    # print('compute after relation_symbol_instances_on_samples', relation_symbol_instances_on_samples)
                 
-                # find relation tail
-                # print('current_image_file',current_image_file)
-                img = cv2.imread(current_image_file)
-                for i in range(0,len(relation_body)):
-                    bbox = relation_body[i]
-                    dis_max = 0
-                    crop_img = img[int(bbox[1]):int(bbox[1]+bbox[3]), int(bbox[0]):int(bbox[0]+bbox[2])]
-                    if crop_img is not None:
-                    # cv2.imwrite('/mnt/detectron2/pathway_retinanet_weiwei_65k/test/crop_ok.jpg', crop_img)
-                        gray = cv2.cvtColor(crop_img,cv2.COLOR_BGR2GRAY)
-                        corners = cv2.goodFeaturesToTrack(gray,20,0.06,10)
-                        # print(type(corners))
+                    # find relation tail
+                    # print('current_image_file',current_image_file)
+                    img = cv2.imread(current_image_file)
+                    for i in range(0,len(relation_body)):
+                        bbox = relation_body[i]
+                        dis_max = 0
+                        crop_img = img[int(bbox[1]):int(bbox[1]+bbox[3]), int(bbox[0]):int(bbox[0]+bbox[2])]
+                        if crop_img is not None:
+                        # cv2.imwrite('/mnt/detectron2/pathway_retinanet_weiwei_65k/test/crop_ok.jpg', crop_img)
+                            gray = cv2.cvtColor(crop_img,cv2.COLOR_BGR2GRAY)
+                            corners = cv2.goodFeaturesToTrack(gray,20,0.06,10)
+                            # print(type(corners))
                         
-                        if type(corners) is not 'NoneType':
-                            # 返回的结果是[[ 311., 250.]] 两层括号的数组。
-                            # corners.tolist()
-                            # try:
-                            #     corners = np.int0(corners)
-                            # except:
-                            #     continue
-                            corners = np.int0(corners)
-                            # print('!!!!!!!!!!!!!!!!!',corners)
-                            tail = []
-                            for j in corners:
-                                x,y = j.ravel()
-                                cv2.circle(crop_img,(x,y),3,255,-1)
-                                raw_x = x+bbox[0]
-                                raw_y = y+bbox[1]
-                                try:
-                                    head_x = element_instances_on_sample['head'][element_relation.index[i]][0]
-                                    head_y = element_instances_on_sample['head'][element_relation.index[i]][1]
-                                except:
-                                    continue
-                                dis = np.sqrt((raw_x - head_x) ** 2 + (raw_y - head_y) ** 2)
-                                if dis > dis_max:
-                                    dis_max = dis
-                                    tail = [raw_x,raw_y]
-
-                            element_instances_on_sample['tail'][element_relation.index[i]] = tail 
-                            del tail
-                        else:
-                            element_instances_on_sample['tail'][element_relation.index[i]] = [0,0]
-                            # continue
-                # print('element_instances_on_sample',element_instances_on_sample['tail'])
-                # print('relation_instances_on_sample',relation_instances_on_sample)
-                img = cv2.imread(current_image_file)
-                height, width, _ = img.shape
-                normalize_all_boxes(relation_instances_on_sample, (height, width))
-                normalize_all_boxes(element_instances_on_sample, (height, width))
-
-
-                # visualize normalized bboxes to confirm detection results
-                img_copy = img.copy()
-                for element_idx in range(0, len(element_instances_on_sample)):
-                    if element_instances_on_sample.iloc[element_idx]['category_id'] == 0:
-                        if element_instances_on_sample.iloc[element_idx]['score'] >= cfg.element_threshold:
-                            cv2.polylines(img_copy, [element_instances_on_sample.iloc[element_idx]['normalized_bbox']],
-                                          isClosed=True, color=(255, 0, 0), thickness=2)
-                    elif element_instances_on_sample.iloc[element_idx]['category_id'] == 1:
-                        if element_instances_on_sample.iloc[element_idx]['score'] >= cfg.element_threshold:
-                            cv2.polylines(img_copy, [element_instances_on_sample.iloc[element_idx]['normalized_bbox']],
-                                          isClosed=True, color=(0, 255, 0), thickness=2)
-                    elif element_instances_on_sample.iloc[element_idx]['category_id'] == 2:
-                        if element_instances_on_sample.iloc[element_idx]['score'] >= cfg.element_threshold:
-                            cv2.polylines(img_copy, [element_instances_on_sample.iloc[element_idx]['normalized_bbox']],
-                                          isClosed=True, color=(0, 0, 255), thickness=2)
-                # print('!!!!!!element_instances_on_sample',element_instances_on_sample)
-                for relation_idx in range(0, len(relation_instances_on_sample)):
-                    if relation_instances_on_sample.iloc[relation_idx]['category_id']==0:
-                        if relation_instances_on_sample.iloc[relation_idx]['score'] >= cfg.relation_threshold:
-                            cv2.polylines(img_copy, [relation_instances_on_sample.iloc[relation_idx]['normalized_bbox']],
-                                            isClosed=True, color=(255, 215, 0), thickness=2)
-                    elif relation_instances_on_sample.iloc[relation_idx]['category_id']==1:
-                        if relation_instances_on_sample.iloc[relation_idx]['score'] >= cfg.relation_threshold:
-                            cv2.polylines(img_copy, [relation_instances_on_sample.iloc[relation_idx]['normalized_bbox']],
-                                            isClosed=True, color=(128, 0, 128), thickness=2)
-
-                # print('*******************************',relation_instances_on_sample)
+                            if type(corners) is not 'NoneType':
+                                # 返回的结果是[[ 311., 250.]] 两层括号的数组。
+                                # corners.tolist()
+                                # try:
+                                #     corners = np.int0(corners)
+                                # except:
+                                #     continue
+                                corners = np.int0(corners)
+                                # print('!!!!!!!!!!!!!!!!!',corners)
+                                tail = []
+                                for j in corners:
+                                    x,y = j.ravel()
+                                    cv2.circle(crop_img,(x,y),3,255,-1)
+                                    raw_x = x+bbox[0]
+                                    raw_y = y+bbox[1]
+                                    try:
+                                        head_x = element_instances_on_sample['head'][element_relation.index[i]][0]
+                                        head_y = element_instances_on_sample['head'][element_relation.index[i]][1]
+                                    except:
+                                        continue
+                                    dis = np.sqrt((raw_x - head_x) ** 2 + (raw_y - head_y) ** 2)
+                                    if dis > dis_max:
+                                        dis_max = dis
+                                        tail = [raw_x,raw_y]
+
+                                element_instances_on_sample['tail'][element_relation.index[i]] = tail 
+                                del tail
+                            else:
+                                element_instances_on_sample['tail'][element_relation.index[i]] = [0,0]
+                                # continue
+                    # print('element_instances_on_sample',element_instances_on_sample['tail'])
+                    # print('relation_instances_on_sample',relation_instances_on_sample)
+                    img = cv2.imread(current_image_file)
+                    height, width, _ = img.shape
+                    normalize_all_boxes(relation_instances_on_sample, (height, width))
+                    normalize_all_boxes(element_instances_on_sample, (height, width))
+
+
+                    # visualize normalized bboxes to confirm detection results
+                    img_copy = img.copy()
+                    for element_idx in range(0, len(element_instances_on_sample)):
+                        if element_instances_on_sample.iloc[element_idx]['category_id'] == 0:
+                            if element_instances_on_sample.iloc[element_idx]['score'] >= cfg.element_threshold:
+                                cv2.polylines(img_copy, [element_instances_on_sample.iloc[element_idx]['normalized_bbox']],
+                                              isClosed=True, color=(255, 0, 0), thickness=2)
+                        elif element_instances_on_sample.iloc[element_idx]['category_id'] == 1:
+                            if element_instances_on_sample.iloc[element_idx]['score'] >= cfg.element_threshold:
+                                cv2.polylines(img_copy, [element_instances_on_sample.iloc[element_idx]['normalized_bbox']],
+                                              isClosed=True, color=(0, 255, 0), thickness=2)
+                        elif element_instances_on_sample.iloc[element_idx]['category_id'] == 2:
+                            if element_instances_on_sample.iloc[element_idx]['score'] >= cfg.element_threshold:
+                                cv2.polylines(img_copy, [element_instances_on_sample.iloc[element_idx]['normalized_bbox']],
+                                              isClosed=True, color=(0, 0, 255), thickness=2)
+                    # print('!!!!!!element_instances_on_sample',element_instances_on_sample)
+                    for relation_idx in range(0, len(relation_instances_on_sample)):
+                        if relation_instances_on_sample.iloc[relation_idx]['category_id']==0:
+                            if relation_instances_on_sample.iloc[relation_idx]['score'] >= cfg.relation_threshold:
+                                cv2.polylines(img_copy, [relation_instances_on_sample.iloc[relation_idx]['normalized_bbox']],
+                                                isClosed=True, color=(255, 215, 0), thickness=2)
+                        elif relation_instances_on_sample.iloc[relation_idx]['category_id']==1:
+                            if relation_instances_on_sample.iloc[relation_idx]['score'] >= cfg.relation_threshold:
+                                cv2.polylines(img_copy, [relation_instances_on_sample.iloc[relation_idx]['normalized_bbox']],
+                                                isClosed=True, color=(128, 0, 128), thickness=2)
+
+                    # print('*******************************',relation_instances_on_sample)
                 
-                cv2.imwrite(os.path.join(relation_subimage_path, image_name + image_ext), img_copy)
-                del img_copy
-
-                valid_relations = []
-                for relation_idx in range(0, len(relation_instances_on_sample)):
-                    current_relation_vertex = relation_instances_on_sample.iloc[relation_idx]['normalized_bbox']
-
-                    genes_in_relation_count = 0
-                    relation_symbol_count = 0
-                    relation_symbol = False
-                    gene_counts = False
-                    covered_elements = []
-
-                    for element_idx in range(len(element_instances_on_sample)):
-                        current_element_vertex = element_instances_on_sample.iloc[element_idx]['normalized_bbox']
-                        # current_element_vertex = normalize_rect_vertex(current_element_vertex)
-                        current_element_category = cfg.element_list[
-                            element_instances_on_sample.iloc[element_idx]['category_id']]
-                        if relation_covers_this_element(element_box_points=current_element_vertex,
-                                                        relation_box_points=current_relation_vertex,
-                                                        cover_ratio=cfg.cover_ratio):
-                            if current_element_category == 'gene':
-                                genes_in_relation_count += 1
-                                covered_elements.append(element_idx)
-
-                                if genes_in_relation_count >= 2:
-                                    gene_counts = True
+                    cv2.imwrite(os.path.join(relation_subimage_path, image_name + image_ext), img_copy)
+                    del img_copy
+
+                    valid_relations = []
+                    for relation_idx in range(0, len(relation_instances_on_sample)):
+                        current_relation_vertex = relation_instances_on_sample.iloc[relation_idx]['normalized_bbox']
+
+                        genes_in_relation_count = 0
+                        relation_symbol_count = 0
+                        relation_symbol = False
+                        gene_counts = False
+                        covered_elements = []
+
+                        for element_idx in range(len(element_instances_on_sample)):
+                            current_element_vertex = element_instances_on_sample.iloc[element_idx]['normalized_bbox']
+                            # current_element_vertex = normalize_rect_vertex(current_element_vertex)
+                            current_element_category = cfg.element_list[
+                                element_instances_on_sample.iloc[element_idx]['category_id']]
+                            if relation_covers_this_element(element_box_points=current_element_vertex,
+                                                            relation_box_points=current_relation_vertex,
+                                                            cover_ratio=cfg.cover_ratio):
+                                if current_element_category == 'gene':
+                                    genes_in_relation_count += 1
+                                    covered_elements.append(element_idx)
+
+                                    if genes_in_relation_count >= 2:
+                                        gene_counts = True
+                                    else:
+                                        gene_counts = False
                                 else:
-                                    gene_counts = False
-                            else:
-                                relation_symbol_count += 1
-                                covered_elements.append(element_idx)
-                                if relation_symbol_count > 0:  # and (current_relation_category.find(current_element_category) != -1):
-                                    relation_symbol = True
-                    valid_relation_instance = relation_instances_on_sample.iloc[relation_idx].copy()
-                    valid_relation_instance['covered_elements'] = covered_elements
-                    del covered_elements
-                    if relation_symbol and gene_counts:
-                        # get all valid_relations
-                        valid_relations.append(valid_relation_instance.to_dict())
-                df_valid_relations = pd.DataFrame(valid_relations)
-
-                # #visualize covered element detection results
-                # for relation_idx in range(2, len(df_valid_relations)):
-                #     img_copy = img.copy()
-                #     cv2.polylines(img_copy, [df_valid_relations.iloc[relation_idx]['normalized_bbox']],
-                #                   isClosed=True, color=[0, 0, 255], thickness=2)
-                #     bboxes = element_instances_on_sample.iloc[df_valid_relations.iloc[relation_idx]['covered_elements']][
-                #         'normalized_bbox']
-                #     for bbox in bboxes:
-                #         cv2.polylines(img_copy, [bbox],
-                #                       isClosed=True, color=[255, 0, 0], thickness=2)
-                #     cv2.imwrite(os.path.join(relation_subimage_path, image_name + 'cover' + str(relation_idx) + image_ext),
-                #                 img_copy)
-                #     del img_copy
-
-                img_copy = img.copy()
-                relation_results = generate_relation_sub_image_and_pairing(img_copy, image_name, image_ext,
-                                                                           df_valid_relations,
-                                                                           element_instances_on_sample, 'relation',
-                                                                           relation_subimage_path)
-                print('relation_results',relation_results[['startor','relation_category','receptor']])
-
-
-                # todo: filter out None rows in relation_results
-
-                # save results
-                with open('{:s}_relation.json'.format(os.path.join(data_folder, image_name)), 'w') as output_fp:
-                    relation_results.to_json(output_fp, orient='index')
-
-                del relation_results, img, img_copy, valid_relations, df_valid_relations
-
-            del predictions, element_instances, relation_instances, image_file_list
+                                    relation_symbol_count += 1
+                                    covered_elements.append(element_idx)
+                                    if relation_symbol_count > 0:  # and (current_relation_category.find(current_element_category) != -1):
+                                        relation_symbol = True
+                        valid_relation_instance = relation_instances_on_sample.iloc[relation_idx].copy()
+                        valid_relation_instance['covered_elements'] = covered_elements
+                        del covered_elements
+                        if relation_symbol and gene_counts:
+                            # get all valid_relations
+                            valid_relations.append(valid_relation_instance.to_dict())
+                    df_valid_relations = pd.DataFrame(valid_relations)
+
+                    # #visualize covered element detection results
+                    # for relation_idx in range(2, len(df_valid_relations)):
+                    #     img_copy = img.copy()
+                    #     cv2.polylines(img_copy, [df_valid_relations.iloc[relation_idx]['normalized_bbox']],
+                    #                   isClosed=True, color=[0, 0, 255], thickness=2)
+                    #     bboxes = element_instances_on_sample.iloc[df_valid_relations.iloc[relation_idx]['covered_elements']][
+                    #         'normalized_bbox']
+                    #     for bbox in bboxes:
+                    #         cv2.polylines(img_copy, [bbox],
+                    #                       isClosed=True, color=[255, 0, 0], thickness=2)
+                    #     cv2.imwrite(os.path.join(relation_subimage_path, image_name + 'cover' + str(relation_idx) + image_ext),
+                    #                 img_copy)
+                    #     del img_copy
+
+                    img_copy = img.copy()
+                    relation_results = generate_relation_sub_image_and_pairing(img_copy, image_name, image_ext,
+                                                                               df_valid_relations,
+                                                                               element_instances_on_sample, 'relation',
+                                                                               relation_subimage_path)
+                    print('relation_results',relation_results[['startor','relation_category','receptor']])
+
+
+                    # todo: filter out None rows in relation_results
+
+                    # save results
+                    with open('{:s}_relation.json'.format(os.path.join(data_folder, image_name)), 'w') as output_fp:
+                        relation_results.to_json(output_fp, orient='index')
+
+                    del relation_results, img, img_copy, valid_relations, df_valid_relations
+
+                del predictions, element_instances, relation_instances, image_file_list
 
 def run_model_head(cfg_head,  **kwargs):
 
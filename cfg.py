@@ -34,6 +34,20 @@ previous_dictionary_path = ''  # none if not needed
 log_file = os.path.join(predict_folder, "log.txt")
 # dictionary_path = os.path.join(predict_folder, "gene_dictionary.xlsx")
 dictionary_path = r"./pathway_module/all_gene_names.json"
+hugo_dictionary_path = r"exHUGO_latest.json"
+verify_dictionary_index = False  # check every indexed dictionary correction against the full SequenceMatcher scan
+correction_cache = True  # memoize OCR string -> gene corrections (correction_cache.py)
+correction_cache_path = r"./dictionary_cache/corrections.sqlite"  # disk tier shared by workers and runs, '' keeps the cache in memory
+correction_cache_memory_size = 100000  # corrections in the in-process LRU
+correction_cache_flush_every = 32  # new corrections written to the disk tier at once
+batch_correction_workers = -1  # threads of the compiled fuzzy scorer (batch_correction.py, needs rapidfuzz), -1: all cores
+batch_correction_max_cells = 4000000  # strings x gene names scored in one matrix
+text_normalizer_cache_size = 200000  # OCR tokens memoized by the nfkc->deburr->upper->expand->swaps normalizer (text_normalizer.py)
+dictionary_cache_folder = r"./dictionary_cache"  # normalized dictionaries, rebuilt when the json changes
+cooccurrence_folder = r"nlp_pipeline_v2/from_PMCID_to_gene_annotation_and_cooccurrence/gene_co_occurrence/"  # <pmcid>.csv per article
+cooccurrence_cache_folder = r"./cooccurrence_cache"  # gene pair indexes of the articles, rebuilt when the csv changes
+image_manifest_folder = r"./manifest_cache"  # height, width and hash per image folder, rescanned for changed files only
+image_manifest_workers = 16  # threads reading image headers during a scan
 word_file = os.path.join(predict_folder, "word_cloud.txt")  # word cloud
 all_results_file = os.path.join(predict_folder, "all_results.txt")
 
@@ -49,11 +63,34 @@ early_stop_threshold = 10  # for patience
 patience_2 = 10  # stop if x consecutive bests >= threshold
 patience = 3  # stop if x bests >= early_stop_threshold
 
+OCR_threshold_search = 'sweep'  # 'sweep': walk the histogram around its peak, 'ranked': Otsu first, repeated bitmaps skipped (threshold_search.py)
+OCR_search_max_thresholds = 18  # thresholds per orientation for the ranked search, one sweep round on both sides
+
 vertical_ratio_thresh = 1.5  # rotate 90c and 90cc if height / width >= vertical_ratio_thresh
 detection_IoU_thresholds = [.1, .25, .5, .75]  #  threshold for evaluation
+evaluation_iou_workers = 0  # processes computing the rotated IoU matrices of the images in PathwayEval, 0 or 1: no pool
 
 padding = 50  # for deskew
 OCR_SCALE = 5  # for resizing image
+visualize_mode = 'off'  # debug renderings: 'off', 'sampled' (1 in visualize_sample_every figures), 'on_failure', 'on'
+visualize_sample_every = 20
+visualize_workers = 2  # background threads drawing the renderings
+detection_batch_size = 4  # figures per detection forward in the pipelines, batched by aspect ratio
+resume_runs = True  # pipeline_hugo: skip figures whose outputs are current, reuse current detections and OCR (run_manifest.py)
+run_manifest_save_every = 200  # stage updates between two writes of the run manifest
+result_format = 'parquet'  # pipeline_hugo results: 'parquet' appends to <img>/results (result_store.py, needs pyarrow), 'json' writes files per figure
+result_store_rows_per_part = 5000  # rows of one parquet part file
+result_store_queue_size = 64  # figures waiting for the result writer
+pipeline_mode = 'staged'  # pipeline_hugo: 'staged' overlaps detection, OCR, pairing and writing (staged_pipeline.py), 'sequential' runs one figure at a time
+pipeline_queue_size = 8  # items waiting between two stages, a faster stage blocks when the queue is full
+pipeline_ocr_workers = 4
+pipeline_pairing_workers = 2
+detection_mode = 'auto'  # element + body detection: 'auto', 'fused' (one shared backbone forward), 'concurrent', 'two_pass' (detection.py)
+mmocr_recog_batch_size = 64  # crops per MMOCR recognition batch, taken across the figures of a loader batch
+OCR_engine = 'cli'  # 'cli': tesseract subprocess per call, 'tesserocr': in-process api handle per worker, no temp files
+tail_mode = 'corners'  # relation tail candidates in pipeline_hugo: 'corners' (goodFeaturesToTrack), 'skeleton' (ends of the stroke skeleton)
+metrics_format = 'jsonl'  # stage timers and counters of a run (instrumentation.py): 'jsonl' appends one line, 'prometheus' writes a textfile, 'off'
+metrics_file = 'pipeline_metrics.jsonl'
 
 
 
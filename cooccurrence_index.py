@@ -0,0 +1,173 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import cfg
+
+# bump when the cached layout or the key normalization changes
+CACHE_VERSION = 1
+
+# per process, the figures of one article share its index
+_loaded = {}
+
+
+def gene_key(gene):
+    if gene is None or (isinstance(gene, float) and np.isnan(gene)):
+        return None
+    return str(gene).strip().upper()
+
+
+def pair_key(gene_1, gene_2):
+    """Same key for both orders of a gene pair, None if a gene is missing."""
+    gene_1, gene_2 = gene_key(gene_1), gene_key(gene_2)
+    if gene_1 is None or gene_2 is None:
+        return None
+    return '\t'.join(sorted((gene_1, gene_2)))
+
+
+class CooccurrenceIndex(object):
+    """
+    Co-occurrence counts of an article keyed by the unordered, upper-cased gene pair.
+
+    Built once from the gene_co_occurrence csv of the article. When a pair appears more than once
+    (in both orders, or differently cased) the first row counts, as in the row scan it replaces.
+    """
+
+    def __init__(self, keys, counts):
+        self.counts = pd.Series(np.asarray(counts), index=pd.Index(keys, dtype=object))
+
+    @classmethod
+    def from_frame(cls, gene_co_occurrence):
+        keys = [pair_key(gene_1, gene_2) for gene_1, gene_2 in
+                zip(gene_co_occurrence['gene_name_1'], gene_co_occurrence['gene_name_2'])]
+        counts = pd.Series(gene_co_occurrence['co_occurrence'].values, index=keys)
+        counts = counts[counts.index.notnull() & ~counts.index.duplicated(keep='first')]
+        return cls(counts.index.values, counts.values)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def lookup(self, startors, receptors):
+        '''
+
+        Args:
+            startors, receptors: gene names of the relations, in the same order
+
+        Return:
+            (np.ndarray) co-occurrence count per relation, 0 for a pair the article does not have
+
+        '''
+        keys = [pair_key(startor, receptor) for startor, receptor in zip(startors, receptors)]
+        return self.counts.reindex(keys).fillna(0).astype(self.counts.dtype).values
+
+
+def _csv_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return CACHE_VERSION, os.path.abspath(csv_path), stat.st_size, int(stat.st_mtime)
+
+
+def get_cooccurrence_index(pmcid, csv_folder=None):
+    '''
+
+    Co-occurrence index of one article, from memory, from the cache or built from its csv
+
+    Args:
+        pmcid: article of the figure
+        csv_folder: folder of the <pmcid>.csv files, cfg.cooccurrence_folder if None
+
+    Return:
+        (CooccurrenceIndex)
+
+    '''
+    csv_path = os.path.join(csv_folder or cfg.cooccurrence_folder, str(pmcid) + '.csv')
+    stamp = _csv_stamp(csv_path)
+    if _loaded.get(csv_path, (None,))[0] == stamp:
+        return _loaded[csv_path][1]
+
+    cache_path = os.path.join(cfg.cooccurrence_cache_folder, '{:s}.pairs'.format(str(pmcid)))
+    index = None
+    try:
+        with open(cache_path, 'rb') as cache_fp:
+            cached_stamp, keys, counts = pickle.load(cache_fp)
+        if cached_stamp == stamp:
+            index = CooccurrenceIndex(keys, counts)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        pass
+
+    if index is None:
+        index = CooccurrenceIndex.from_frame(pd.read_csv(csv_path))
+        if not os.path.isdir(cfg.cooccurrence_cache_folder):
+            os.makedirs(cfg.cooccurrence_cache_folder)
+        # write then rename, so other workers never read a half written file
+        tmp_path = '{:s}.{:d}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as cache_fp:
+            pickle.dump((stamp, index.counts.index.values, index.counts.values), cache_fp,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    _loaded[csv_path] = (stamp, index)
+    return index
+
+
+def score_relations(cooccurrence_index, processed_el_body_instances):
+    '''
+
+    rank each relationship by how often their genes co-occur in the figure's article
+
+    Args:
+        cooccurrence_index: CooccurrenceIndex of the article, or its gene_co_occurrence DataFrame
+        processed_el_body_instances: element and arrow/t-bar body instances
+
+    Return:
+        (pd.DataFrame) processed_el_body_instances with rank and relation_category set for every relationship
+
+    '''
+    if isinstance(cooccurrence_index, pd.DataFrame):
+        cooccurrence_index = CooccurrenceIndex.from_frame(cooccurrence_index)
+
+    processed_el_body_instances['rank'] = 0
+    is_relation = processed_el_body_instances['category_id'] != 1
+    relations = processed_el_body_instances[is_relation]
+    processed_el_body_instances.loc[is_relation, 'rank'] = cooccurrence_index.lookup(relations['startor'], relations['receptor'])
+
+    processed_el_body_instances.loc[processed_el_body_instances['category_id'] == 0, 'relation_category'] = 'activate_relation'
+    processed_el_body_instances.loc[processed_el_body_instances['category_id'] == 2, 'relation_category'] = 'inhibit_relation'
+    return processed_el_body_instances
+
+
+if __name__ == '__main__':
+    import time
+
+    # an article with 2000 gene pairs and a figure with 100 relations
+    rng = np.random.RandomState(0)
+    genes = ['GENE{:d}'.format(k) for k in range(400)]
+    pairs = rng.randint(0, len(genes), (2000, 2))
+    gene_co_occurrence = pd.DataFrame({'gene_name_1': [genes[a] for a in pairs[:, 0]],
+                                       'gene_name_2': [genes[b] for b in pairs[:, 1]],
+                                       'co_occurrence': rng.randint(1, 50, len(pairs))})
+    ends = rng.randint(0, len(genes), (100, 2))
+    instances = pd.DataFrame({'category_id': rng.choice([0, 2], len(ends)),
+                              'startor': [genes[a] for a in ends[:, 0]],
+                              'receptor': [genes[b] for b in ends[:, 1]],
+                              'relation_category': None})
+
+    start = time.time()
+    expected = []
+    for i, r_body_instance in instances.iterrows():
+        rank = 0
+        for j, row in gene_co_occurrence.iterrows():
+            if (r_body_instance['startor'] == row['gene_name_1'] and r_body_instance['receptor'] == row['gene_name_2']) or \
+                    (r_body_instance['receptor'] == row['gene_name_1'] and r_body_instance['startor'] == row['gene_name_2']):
+                rank = row['co_occurrence']
+                break
+        expected.append(rank)
+    scan_time = time.time() - start
+
+    start = time.time()
+    scored = score_relations(gene_co_occurrence, instances.copy())
+    index_time = time.time() - start
+
+    assert scored['rank'].tolist() == expected
+    print('100 relations x 2000 pairs: row scan {:.2f}s, pair index {:.1f} ms'.format(scan_time, index_time * 1000))
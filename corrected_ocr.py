@@ -1,5 +1,14 @@
 
+from collections import Counter, defaultdict
 from difflib import SequenceMatcher
+from math import ceil
+
+import cfg
+from correction_cache import get_correction_cache
+from instrumentation import metrics
+
+NO_ENTRIES = frozenset()
+
 
 def corrected_processing_by_dict(dictionary, ocr, thresh=0.9):
     """
@@ -8,14 +17,186 @@ def corrected_processing_by_dict(dictionary, ocr, thresh=0.9):
     thresh=0.9, the optimal threshold with the mean of precision and recall,
     thresh=1.0, the optimal threshold with precision.
 
-    :param dictionary: exHUGO dictionary, list
+    :param dictionary: exHUGO dictionary, list or DictionaryIndex
     :param ocr: one ocr results, string
     :param thresh: optimal threshold, ranges from 0 to 1, float
     :return:
     """
+    if cfg.correction_cache:
+        # only the upper-cased string is compared, AKT and akt share one entry
+        return get_correction_cache().get('sequence_matcher', dictionary, thresh, ocr.upper(),
+                                          lambda: correct_by_dict(dictionary, ocr, thresh))
+    return correct_by_dict(dictionary, ocr, thresh)
+
+
+def correct_by_dict(dictionary, ocr, thresh=0.9):
+    """corrected_processing_by_dict without the correction cache."""
+    if isinstance(dictionary, DictionaryIndex):
+        return dictionary.correct(ocr, thresh, verify=cfg.verify_dictionary_index)
+
     seq_match_ratio = [SequenceMatcher(None, ocr.upper(), gene.upper()).ratio() for gene in dictionary]
     corrected_ocr = dictionary[seq_match_ratio.index(max(seq_match_ratio))] if round(max(seq_match_ratio),
                                                                                      3) >= thresh else '-'
     return corrected_ocr
 
 
+def char_tokens(word):
+    """
+    Turn a string into its multiset of characters, e.g. 'AKT1A' -> (A,1) (K,1) (T,1) (1,1) (A,2).
+    The number of tokens two strings share is the size of their multiset intersection.
+    """
+    seen = Counter()
+    tokens = []
+    for c in word:
+        seen[c] += 1
+        tokens.append((c, seen[c]))
+    return tokens
+
+
+class DictionaryIndex(object):
+    """
+    Prebuilt approximate-match index over a gene dictionary.
+
+    SequenceMatcher.ratio() is 2*M/T where M can never exceed the shorter length nor the number
+    of characters both strings share. Entries are bucketed by length and every bucket keeps an
+    inverted list per character token, so only entries whose upper bound can still reach the
+    threshold are verified with SequenceMatcher. The result (best match, first one on ties, and
+    the threshold decision) is identical to corrected_processing_by_dict on the plain list.
+    """
+
+    def __init__(self, dictionary):
+        self.dictionary = list(dictionary)
+        self.upper_dictionary = [gene.upper() for gene in self.dictionary]
+
+        # length -> indices of entries, and length -> character token -> indices of entries
+        length_buckets = defaultdict(list)
+        postings = defaultdict(lambda: defaultdict(set))
+        for idx, gene in enumerate(self.upper_dictionary):
+            length_buckets[len(gene)].append(idx)
+            for token in char_tokens(gene):
+                postings[len(gene)][token].add(idx)
+
+        # plain dicts so a built index can be pickled into the dictionary cache
+        self.length_buckets = dict(length_buckets)
+        self.postings = {length: dict(bucket) for length, bucket in postings.items()}
+        self.lengths = sorted(self.length_buckets)
+
+        # number of SequenceMatcher ratios computed, for comparing against a linear scan
+        self.candidates_scored = 0
+
+    def __len__(self):
+        return len(self.dictionary)
+
+    def candidates(self, query, thresh):
+        """
+        Indices of all entries whose ratio against query can round to at least thresh, ascending.
+        """
+        # round(ratio, 3) >= thresh  <=>  ratio >= thresh - 0.0005, keep a little slack for floats
+        cutoff = thresh - 0.0005 - 1e-9
+        query_length = len(query)
+        tokens = char_tokens(query)
+
+        candidates = []
+        for length in self.lengths:
+            total = query_length + length
+            if total == 0:
+                candidates.extend(self.length_buckets[length])
+                continue
+            if 2.0 * min(query_length, length) / total < cutoff:
+                continue
+
+            # minimum number of shared characters needed to reach the cutoff
+            need = int(ceil(cutoff * total / 2.0))
+            if need <= 0:
+                candidates.extend(self.length_buckets[length])
+                continue
+            if need > query_length:
+                continue
+
+            bucket = self.postings.get(length, {})
+            lists = sorted((bucket.get(token, NO_ENTRIES) for token in tokens), key=len)
+            if need == query_length:
+                # every character of the query has to be present
+                if not lists[0]:
+                    continue
+                candidates.extend(set.intersection(*lists))
+            else:
+                # an entry missing at most (query_length - need) tokens has to appear in one of the
+                # (query_length - need + 1) shortest lists, only those entries get counted
+                possible = set().union(*lists[:query_length - need + 1])
+                shared = Counter()
+                for ids in lists:
+                    shared.update(possible & ids)
+                candidates.extend(idx for idx, count in shared.items() if count >= need)
+
+        candidates.sort()
+        return candidates
+
+    def correct(self, ocr, thresh=0.9, verify=False):
+        """
+        Same contract as corrected_processing_by_dict.
+
+        :param ocr: one ocr results, string
+        :param thresh: optimal threshold, ranges from 0 to 1, float
+        :param verify: also run the linear SequenceMatcher scan and fail if the results differ
+        :return: corrected gene name or '-'
+        """
+        query = ocr.upper()
+        matcher = SequenceMatcher(None, query)
+
+        best_idx = None
+        best_ratio = -1.0
+        candidates = self.candidates(query, thresh)
+        metrics.count('dictionary_corrections')
+        metrics.count('dictionary_candidates_scored', len(candidates))
+        for idx in candidates:
+            matcher.set_seq2(self.upper_dictionary[idx])
+            ratio = matcher.ratio()
+            self.candidates_scored += 1
+            if ratio > best_ratio:
+                best_ratio = ratio
+                best_idx = idx
+
+        corrected_ocr = self.dictionary[best_idx] if best_idx is not None and round(best_ratio, 3) >= thresh else '-'
+
+        if verify:
+            expected = correct_by_dict(self.dictionary, ocr, thresh)
+            assert corrected_ocr == expected, \
+                'DictionaryIndex returned {!r} for {!r}, linear scan returned {!r}'.format(corrected_ocr, ocr, expected)
+
+        return corrected_ocr
+
+
+if __name__ == '__main__':
+    import json
+    import random
+    import time
+
+    with open('exHUGO_latest.json') as hugo_fp:
+        hugo_dict = json.load(hugo_fp)
+
+    start = time.time()
+    index = DictionaryIndex(hugo_dict)
+    print('index built in {:.2f}s'.format(time.time() - start))
+
+    # noisy samples: exact symbols, symbols with one character changed or dropped, and junk
+    random.seed(0)
+    samples = []
+    for gene in random.sample(hugo_dict, 30):
+        samples.append(gene)
+        pos = random.randrange(len(gene))
+        samples.append(gene[:pos] + random.choice('01IlO-') + gene[pos + 1:])
+        samples.append(gene[:pos] + gene[pos + 1:])
+    samples.extend(['-', 'P', 'AKT', 'MTOR', 'PI3K', '', 'x7#'])
+
+    for thresh in [0.7, 0.9, 1.0]:
+        start = time.time()
+        for sample in samples:
+            index.correct(sample, thresh, verify=True)
+        total = time.time() - start
+        print('thresh {}: {} samples identical to linear scan ({:.1f}s incl. verification)'.format(thresh, len(samples), total))
+
+    start = time.time()
+    for sample in samples:
+        index.correct(sample)
+    print('index: {:.3f} ms per string'.format((time.time() - start) * 1000 / len(samples)))
@@ -0,0 +1,258 @@
+import atexit
+import hashlib
+import multiprocessing.util
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import cfg
+from identity_cache import IdentityCache
+from instrumentation import metrics
+
+# bump when a scorer changes what it returns for the same key
+CACHE_VERSION = 1
+
+# content digest of the dictionaries in use, computed once per object
+_versions = IdentityCache(lambda dictionary: hashlib.blake2b(
+    '\n'.join(getattr(dictionary, 'dictionary', dictionary)).encode('utf-8'), digest_size=16).hexdigest())
+
+# cache of this process, reopened after a fork
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def dictionary_version(dictionary):
+    '''
+
+    Args:
+        dictionary: gene names (list, tuple, not changed once used) or a DictionaryIndex
+
+    Return:
+        (str) digest of the content, the same dictionary loaded in another process or run gives the same one
+
+    '''
+    return _versions.get(dictionary)
+
+
+class CorrectionCache(object):
+    """
+    Corrections of OCR strings against a gene dictionary, memoized in two tiers.
+
+    A correction is keyed by (scorer, dictionary version, threshold, normalized OCR string). The first
+    tier is an LRU of memory_size entries in this process, the second a SQLite table shared by the OCR
+    worker processes and by later runs. New corrections are written in batches of flush_every, the
+    last batch by close, which atexit runs in the main process and flush_correction_cache in the OCR
+    pool workers (atexit does not run there), so a crashed worker only loses its newest entries. The
+    database runs in WAL mode, readers never wait for the writer of another process.
+    """
+
+    def __init__(self, path, memory_size=None, flush_every=None):
+        self.path = path
+        self.memory_size = memory_size or cfg.correction_cache_memory_size
+        self.flush_every = flush_every or cfg.correction_cache_flush_every
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.pending = []
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+        self.connection = None
+        if path:
+            folder = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS corrections (scorer TEXT, version TEXT, threshold REAL, '
+                                    'text TEXT, value BLOB, PRIMARY KEY (scorer, version, threshold, text))')
+            self.connection.commit()
+        atexit.register(self.close)
+
+    def key(self, scorer, dictionary, threshold, text):
+        return '{:s}/{:d}'.format(scorer, CACHE_VERSION), dictionary_version(dictionary), float(threshold), text
+
+    def lookup(self, key):
+        """Cached correction of key and the tier it came from, 'memory', 'disk' or None on a miss."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                metrics.count('correction_cache_memory_hits')
+                return self.memory[key], 'memory'
+
+            row = None
+            if self.connection is not None:
+                row = self.connection.execute('SELECT value FROM corrections WHERE scorer=? AND version=? AND threshold=? '
+                                              'AND text=?', key).fetchone()
+        if row is None:
+            return None, None
+        value = pickle.loads(row[0])
+        self.remember(key, value, 'disk')
+        return value, 'disk'
+
+    def remember(self, key, value, tier=None):
+        """Keep a correction in memory, and on disk too if it was computed (tier None)."""
+        with self.lock:
+            self.stats['disk_hits' if tier == 'disk' else 'misses'] += 1
+            self.memory[key] = value
+            if len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+            if tier is None and self.connection is not None:
+                self.pending.append(key + (pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),))
+                if len(self.pending) >= self.flush_every:
+                    self.flush_locked()
+        metrics.count('correction_cache_disk_hits' if tier == 'disk' else 'correction_cache_misses')
+
+    def get(self, scorer, dictionary, threshold, text, compute):
+        '''
+
+        Args:
+            scorer: name of the correction, part of the key
+            dictionary: dictionary the correction runs against, see dictionary_version
+            threshold: threshold or score cutoff of the correction
+            text: normalized OCR string, the correction has to depend on nothing else
+            compute: callable returning the correction on a miss, its result has to pickle
+
+        Return:
+            the correction, from memory, from disk or computed
+
+        '''
+        key = self.key(scorer, dictionary, threshold, text)
+        value, tier = self.lookup(key)
+        if tier is None:
+            value = compute()
+            self.remember(key, value)
+        return value
+
+    def get_many(self, scorer, dictionary, threshold, texts, compute_many):
+        '''
+
+        get for a batch of strings, the misses are computed together
+
+        Args:
+            compute_many: callable taking the list of missed strings and returning their corrections in order
+
+        Return:
+            (list) correction per string of texts
+
+        '''
+        keys = [self.key(scorer, dictionary, threshold, text) for text in texts]
+        values = {}
+        for key in keys:
+            if key not in values:
+                value, tier = self.lookup(key)
+                if tier is not None:
+                    values[key] = value
+        missed = list(OrderedDict.fromkeys(key for key in keys if key not in values))
+        if missed:
+            for key, value in zip(missed, compute_many([key[3] for key in missed])):
+                values[key] = value
+                self.remember(key, value)
+        return [values[key] for key in keys]
+
+    def flush_locked(self):
+        try:
+            self.connection.executemany('INSERT OR IGNORE INTO corrections VALUES (?, ?, ?, ?, ?)', self.pending)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            # the disk tier is an optimization, a locked or read-only database must not stop the OCR
+            print('could not write correction cache {:s}: {:s}'.format(self.path, str(e)))
+        self.pending = []
+
+    def flush(self):
+        with self.lock:
+            if self.pending and self.connection is not None:
+                self.flush_locked()
+
+    def hit_rate(self):
+        lookups = sum(self.stats.values())
+        return (self.stats['memory_hits'] + self.stats['disk_hits']) / lookups if lookups else 0.0
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+def get_correction_cache():
+    '''
+
+    Return:
+        (CorrectionCache) of this process at cfg.correction_cache_path, memory only if the path is empty
+
+    '''
+    with _cache_lock:
+        cache = _cache.get(os.getpid())
+        if cache is None:
+            # a connection opened before a fork must not be used by the child
+            _cache.clear()
+            cache = _cache[os.getpid()] = CorrectionCache(cfg.correction_cache_path)
+        return cache
+
+
+def flush_correction_cache():
+    '''
+
+    Write the pending corrections of this process and close its cache, for pool workers that exit
+    without running atexit
+
+    '''
+    with _cache_lock:
+        cache = _cache.pop(os.getpid(), None)
+    if cache is not None:
+        cache.close()
+
+
+def register_worker_flush():
+    """Flush the cache of a pool worker when the pool terminates it, call from the pool initializer."""
+    multiprocessing.util.Finalize(None, flush_correction_cache, exitpriority=10)
+
+
+if __name__ == '__main__':
+    import random
+    import tempfile
+    import time
+
+    from fuzzywuzzy import fuzz, process
+    from fuzzywuzzy.process import default_processor
+
+    from gene_dictionary import get_gene_names
+
+    # the hot vocabulary of pathway figures plus some noise, as one OCR run sees it
+    gene_names = get_gene_names(upper=False)
+    random.seed(0)
+    tokens = ['AKT', 'MTOR', 'PI3K', '-', 'P', 'RAS', 'ERK', 'MEK'] * 20 + random.sample(gene_names, 40)
+    random.shuffle(tokens)
+
+    start = time.time()
+    expected = [process.extractBests(token, gene_names, processor=default_processor, scorer=fuzz.ratio,
+                                     score_cutoff=cfg.candidate_threshold) for token in tokens]
+    scan_time = time.time() - start
+
+    def extract_bests(cache, token):
+        return cache.get('extract_bests', gene_names, cfg.candidate_threshold, token,
+                         lambda: process.extractBests(token, gene_names, processor=default_processor, scorer=fuzz.ratio,
+                                                      score_cutoff=cfg.candidate_threshold))
+
+    path = os.path.join(tempfile.mkdtemp(), 'corrections.sqlite')
+    cache = CorrectionCache(path)
+    start = time.time()
+    found = [extract_bests(cache, token) for token in tokens]
+    cached_time = time.time() - start
+    assert found == expected
+    hit_rate = cache.hit_rate()
+
+    # a later run: memory is empty, the disk tier answers
+    cache.close()
+    cache = CorrectionCache(path)
+    start = time.time()
+    assert [extract_bests(cache, token) for token in tokens] == expected
+    rerun_time = time.time() - start
+
+    print('{:d} tokens: full scans {:.2f}s, first run {:.2f}s ({:.0%} hits), next run {:.3f}s'.format(
+        len(tokens), scan_time, cached_time, hit_rate, rerun_time))
@@ -0,0 +1,173 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import cfg
+
+DETECTION_MODES = ('auto', 'fused', 'concurrent', 'two_pass')
+
+
+def backbones_match(model_a, model_b):
+    '''
+
+    Args:
+        model_a, model_b: detectron2 meta architectures with a backbone
+
+    Return:
+        (bool) both backbones hold the same weights and both models normalize the input the same way,
+        so one backbone forward serves the two heads
+
+    '''
+    state_a = model_a.backbone.state_dict()
+    state_b = model_b.backbone.state_dict()
+    if state_a.keys() != state_b.keys():
+        return False
+    if not (torch.equal(model_a.pixel_mean, model_b.pixel_mean) and torch.equal(model_a.pixel_std, model_b.pixel_std)):
+        return False
+    return all(state_a[key].shape == state_b[key].shape and torch.equal(state_a[key], state_b[key].to(state_a[key].device))
+               for key in state_a)
+
+
+class DualDetector(object):
+    """
+    Runs the element model and the relation body model on the same inputs.
+
+    Both models are moved to the device and put in eval mode once. cfg.detection_mode selects:
+        'fused'      one backbone forward, its FPN features reused by the body model, needs equal backbones
+        'concurrent' two full forwards at the same time, each on its own thread and CUDA stream
+        'two_pass'   the two forwards one after the other, as before
+        'auto'       'fused' if the backbones match, 'concurrent' otherwise
+    Outputs are the same as calling both models, (el_output, body_output).
+    """
+
+    def __init__(self, el_model, body_model, device=None, mode=None):
+        self.device = device or torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.el_model = el_model.to(self.device).eval()
+        self.body_model = body_model.to(self.device).eval()
+
+        self.mode = mode or cfg.detection_mode
+        if self.mode not in DETECTION_MODES:
+            raise ValueError('detection_mode has to be one of {}, got {!r}'.format(DETECTION_MODES, self.mode))
+        shared = backbones_match(self.el_model, self.body_model)
+        if self.mode == 'auto':
+            self.mode = 'fused' if shared else 'concurrent'
+        elif self.mode == 'fused' and not shared:
+            print('element and relation checkpoints have different backbones, running them concurrently')
+            self.mode = 'concurrent'
+
+        self.executor = None
+        self.streams = None
+        if self.mode == 'concurrent':
+            self.executor = ThreadPoolExecutor(max_workers=2)
+            if self.device.type == 'cuda':
+                self.streams = (torch.cuda.Stream(self.device), torch.cuda.Stream(self.device))
+
+        self.figures = 0
+        self.seconds = 0.0
+
+    def __call__(self, inputs):
+        start = time.time()
+        if self.mode == 'fused':
+            outputs = self.fused(inputs)
+        elif self.mode == 'concurrent':
+            outputs = self.concurrent(inputs)
+        else:
+            with torch.no_grad():
+                outputs = self.el_model(inputs), self.body_model(inputs)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+        self.figures += len(inputs)
+        self.seconds += time.time() - start
+        return outputs
+
+    def fused(self, inputs):
+        # keep the features of the element backbone, then hand them to the body model in place of its own forward
+        features = []
+        hook = self.el_model.backbone.register_forward_hook(lambda module, args, output: features.append(output))
+        try:
+            with torch.no_grad():
+                el_output = self.el_model(inputs)
+        finally:
+            hook.remove()
+
+        self.body_model.backbone.forward = lambda *args, **kwargs: features[0]
+        try:
+            with torch.no_grad():
+                body_output = self.body_model(inputs)
+        finally:
+            del self.body_model.backbone.forward
+        return el_output, body_output
+
+    def run(self, model, inputs, stream):
+        # grad mode is per thread, set it again on the worker
+        with torch.no_grad():
+            if stream is None:
+                return model(inputs)
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+                output = model(inputs)
+            stream.synchronize()
+            return output
+
+    def concurrent(self, inputs):
+        streams = self.streams or (None, None)
+        el_future = self.executor.submit(self.run, self.el_model, inputs, streams[0])
+        body_future = self.executor.submit(self.run, self.body_model, inputs, streams[1])
+        return el_future.result(), body_future.result()
+
+    @property
+    def latency(self):
+        """Mean detection seconds per figure so far."""
+        return self.seconds / max(self.figures, 1)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    from detectron2.checkpoint import DetectionCheckpointer
+    from detectron2.data.build import DatasetMapper
+
+    from body_interface import build_data_fold_loader, setup
+    from train_net import RegularTrainer
+
+    # usage: python detection.py <dataset folder with img/>
+    data_folder = os.path.join(sys.argv[1], 'img/')
+    configuration = setup(cfg, {})
+
+    el_model = RegularTrainer.build_model(configuration)
+    DetectionCheckpointer(model=el_model, save_dir=configuration.OUTPUT_DIR).resume_or_load(cfg.element_model, resume=False)
+    body_model = RegularTrainer.build_model(configuration)
+    DetectionCheckpointer(model=body_model, save_dir=configuration.OUTPUT_DIR).resume_or_load(cfg.relation_model, resume=False)
+
+    data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False))
+    batches = list(data_loader)
+    print('backbones match: {}'.format(backbones_match(el_model, body_model)))
+
+    # the two-pass flow of pipeline_hugo before, .to(device) on every iteration
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    figures = 0
+    start = time.time()
+    with torch.no_grad():
+        for inputs in batches:
+            el_model.to(device).eval()(inputs)
+            body_model.to(device).eval()(inputs)
+            figures += len(inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    print('loop two_pass: {:.1f} ms per figure'.format((time.time() - start) * 1000 / max(figures, 1)))
+
+    modes = ['two_pass', 'concurrent'] + (['fused'] if backbones_match(el_model, body_model) else [])
+    for mode in modes:
+        detector = DualDetector(el_model, body_model, device, mode=mode)
+        for inputs in batches:
+            detector(inputs)
+        detector.close()
+        print('{:s}: {:.1f} ms per figure'.format(mode, detector.latency * 1000))
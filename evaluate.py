@@ -1,12 +1,27 @@
+import argparse
 import csv
 import pandas as pd
 import os
 import copy
 import json
 import numpy as np
+from result_store import read_results
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--predictions', default="filtered_val_images" + "/img_both",
+                    help='folder of the predicted relations: the <image>_relation.json files of pipeline2, pipeline3 '
+                         'and body_interface (the default), or of pipeline_hugo its result store <folder>/results '
+                         '(cfg.result_format parquet) or <folder>/relation (json)')
+args = parser.parse_args()
 
 df = pd.read_csv("checked_relation.csv")
 
+# predicted relations of every figure in one read, from the result store or the per-figure json files
+predicted_relations = read_results(args.predictions, 'relations')
+if len(predicted_relations) == 0:
+    raise SystemExit('no predicted relations in {:s}'.format(args.predictions))
+predicted_by_image = dict(tuple(predicted_relations.groupby('image_name')))
+
 directory = "filtered_val_images/img_both/relation_subimage"
 accuracies = []
 recalls = []
@@ -52,7 +67,7 @@ for filename in os.listdir(directory):
 
     # get predicted relationships
     image_name, ext = os.path.splitext(os.path.basename(filename))
-    tmp_df = pd.read_json("filtered_val_images" + "/img_both/" + image_name + "_relation.json").T
+    tmp_df = predicted_by_image.get(image_name, predicted_relations.iloc[:0])
     tmp_df = tmp_df.loc[tmp_df['startor'].str.len() < 7]
     tmp_df = tmp_df.loc[tmp_df['receptor'].str.len() < 7]
     pred_startors = tmp_df['startor'].str.upper().replace(" ","")
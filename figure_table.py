@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+
+import cfg
+
+GENE_CATEGORY = cfg.element_list.index('gene')
+RELATION_CATEGORIES = {cfg.element_list.index('activate'): 'activate_relation',
+                       cfg.element_list.index('inhibit'): 'inhibit_relation'}
+
+# columns of the <image>_relation.json files
+RELATION_OUTPUT_COLUMNS = ["image_id", "file_name", "category_id", "bbox", "normalized_bbox", "startor", "startor_bbox",
+                           "relation_category", "receptor", "receptor_bbox"]
+
+
+def object_column(values):
+    # one cell per value, even when the values are arrays or lists of the same shape
+    column = np.empty(len(values), dtype=object)
+    for k, value in enumerate(values):
+        column[k] = value
+    return column
+
+
+class FigureTable(object):
+    """
+    Struct-of-arrays model of one figure: the OCR'd genes followed by the arrow/t-bar bodies.
+
+    Every field is one contiguous array with a row per instance. Points that are not known yet
+    (center of a relation body, head or tail not found) are NaN, receptor and startor hold the row
+    of the paired gene or -1. row_ids keeps the row labels the DataFrame of the pipeline used, so
+    the json output is keyed as before. Convert with to_relation_frame only for the output.
+    """
+
+    def __init__(self, file_name, image_id, category_id, score, bbox, ocr, row_ids=None):
+        self.file_name = file_name
+        self.image_id = image_id
+
+        self.category_id = np.asarray(category_id, dtype=np.int32)
+        size = len(self.category_id)
+        self.score = np.asarray(score, dtype=np.float32)
+        self.bbox = np.asarray(bbox, dtype=np.float32).reshape(-1, 4)  # xywh
+        self.ocr = object_column(list(ocr))
+        self.row_ids = np.arange(size) if row_ids is None else np.asarray(row_ids)
+
+        self.normalized_bbox = np.zeros((size, 4, 2), dtype=np.int32)
+        self.center = np.full((size, 2), np.nan, dtype=np.float32)
+        self.head = np.full((size, 2), np.nan, dtype=np.float32)
+        self.tail = np.full((size, 2), np.nan, dtype=np.float32)
+        self.receptor = np.full(size, -1, dtype=np.int32)
+        self.startor = np.full(size, -1, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.category_id)
+
+    @classmethod
+    def from_instances(cls, file_name, image_id, genes, relation_body_instances):
+        '''
+
+        Args:
+            file_name: filepath of the figure
+            image_id: image id of the figure
+            genes: list of (xywh bbox, corrected ocr) of the recognized genes
+            relation_body_instances: arrow/t-bar body instances of the figure from reorganize_outputs
+
+        Return:
+            (FigureTable) genes first, then relation bodies
+
+        '''
+        bboxes = [bbox for bbox, _ in genes] + relation_body_instances['bbox'].tolist()
+        return cls(file_name, image_id,
+                   category_id=[GENE_CATEGORY] * len(genes) + relation_body_instances['category_id'].tolist(),
+                   score=[1.0] * len(genes) + relation_body_instances['score'].tolist(),
+                   bbox=np.asarray(bboxes, dtype=np.float32).reshape(-1, 4),
+                   ocr=[ocr for _, ocr in genes] + [None] * len(relation_body_instances))
+
+    @property
+    def gene_rows(self):
+        return np.flatnonzero(self.category_id == GENE_CATEGORY)
+
+    @property
+    def relation_rows(self):
+        return np.flatnonzero(self.category_id != GENE_CATEGORY)
+
+    def select(self, keep):
+        '''
+
+        Args:
+            keep: boolean mask of the rows to keep
+
+        Return:
+            (FigureTable) the kept rows, receptor and startor still pointing at the same genes
+
+        '''
+        keep = np.asarray(keep, dtype=bool)
+        table = FigureTable(self.file_name, self.image_id, self.category_id[keep], self.score[keep],
+                            self.bbox[keep], self.ocr[keep], self.row_ids[keep])
+        table.normalized_bbox = self.normalized_bbox[keep]
+        table.center = self.center[keep]
+        table.head = self.head[keep]
+        table.tail = self.tail[keep]
+
+        new_rows = np.full(len(self) + 1, -1, dtype=np.int32)  # last entry maps -1 to -1
+        new_rows[np.flatnonzero(keep)] = np.arange(int(keep.sum()))
+        table.receptor = new_rows[self.receptor[keep]]
+        table.startor = new_rows[self.startor[keep]]
+        return table
+
+    def normalize_boxes(self, image_size):
+        '''
+
+        Corner points of every box clipped to the image, as normalize_rect_vertex
+
+        Args:
+            image_size: (height, width)
+
+        '''
+        height, width = image_size
+        bbox = self.bbox.astype(np.float64)
+        xs = np.clip(np.stack([bbox[:, 0], bbox[:, 0] + bbox[:, 2]], axis=1), 0, width)
+        ys = np.clip(np.stack([bbox[:, 1], bbox[:, 1] + bbox[:, 3]], axis=1), 0, height)
+        x0, x1 = xs.min(axis=1), xs.max(axis=1)
+        y0, y1 = ys.min(axis=1), ys.max(axis=1)
+        self.normalized_bbox = np.stack([np.stack([x0, y0], axis=1), np.stack([x1, y0], axis=1),
+                                         np.stack([x1, y1], axis=1), np.stack([x0, y1], axis=1)],
+                                        axis=1).astype(np.int32)
+
+    def to_relation_frame(self):
+        '''
+
+        Return:
+            (pd.DataFrame) one row per relation body with RELATION_OUTPUT_COLUMNS, indexed by row_ids
+
+        '''
+        rows = self.relation_rows
+
+        def paired(gene_rows, values):
+            return [values[gene] if gene >= 0 else None for gene in gene_rows]
+
+        return pd.DataFrame({
+            "image_id": [self.image_id] * len(rows),
+            "file_name": [self.file_name] * len(rows),
+            "category_id": self.category_id[rows].astype(np.int64),
+            "bbox": object_column(self.bbox[rows].tolist()),
+            "normalized_bbox": object_column(list(self.normalized_bbox[rows])),
+            "startor": object_column(paired(self.startor[rows], self.ocr)),
+            "startor_bbox": object_column(paired(self.startor[rows], self.normalized_bbox)),
+            "relation_category": [RELATION_CATEGORIES.get(category) for category in self.category_id[rows]],
+            "receptor": object_column(paired(self.receptor[rows], self.ocr)),
+            "receptor_bbox": object_column(paired(self.receptor[rows], self.normalized_bbox)),
+        }, index=self.row_ids[rows], columns=RELATION_OUTPUT_COLUMNS)
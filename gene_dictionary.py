@@ -0,0 +1,120 @@
+import json
+import os
+import pickle
+import sys
+
+import cfg
+from corrected_ocr import DictionaryIndex
+
+# bump when the cached layout or the normalization below changes
+CACHE_VERSION = 1
+
+# process wide store, every dictionary is loaded and normalized at most once per process
+_loaded = {}
+
+
+def _source_stamp(source_path):
+    stat = os.stat(source_path)
+    return CACHE_VERSION, os.path.abspath(source_path), stat.st_size, int(stat.st_mtime)
+
+
+def _cache_path(source_path, kind):
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(cfg.dictionary_cache_folder, '{:s}.{:s}.cache'.format(name, kind))
+
+
+def _read_cache(cache_path, stamp):
+    """
+    Unpickle a cache file, None if the file is missing, unreadable (e.g. pickled from a class that was
+    renamed since) or was built from another source.
+    """
+    try:
+        with open(cache_path, 'rb') as cache_fp:
+            cached_stamp, data = pickle.load(cache_fp)
+    except (OSError, ValueError, EOFError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+    if cached_stamp != stamp:
+        return None
+    return data
+
+
+def _write_cache(cache_path, stamp, data):
+    if not os.path.isdir(cfg.dictionary_cache_folder):
+        os.makedirs(cfg.dictionary_cache_folder)
+    # write then rename, so other workers never read a half written file
+    tmp_path = '{:s}.{:d}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as cache_fp:
+        pickle.dump((stamp, data), cache_fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def _load(source_path, kind, build):
+    '''
+
+    Load one normalized dictionary, from memory, from the binary cache or from the json source
+
+    Args:
+        source_path: json file the dictionary is built from
+        kind: name of the normalized form, part of the cache file name
+        build: callable turning the parsed json into the normalized form
+
+    Return:
+        the normalized dictionary
+
+    '''
+
+    key = (os.path.abspath(source_path), kind)
+    if key in _loaded:
+        return _loaded[key]
+
+    stamp = _source_stamp(source_path)
+    cache_path = _cache_path(source_path, kind)
+    data = _read_cache(cache_path, stamp)
+    if data is None:
+        with open(source_path, encoding='utf-8') as source_fp:
+            data = build(json.load(source_fp))
+        try:
+            _write_cache(cache_path, stamp, data)
+        except OSError as e:
+            print('could not write dictionary cache {:s}: {:s}'.format(cache_path, str(e)))
+
+    _loaded[key] = data
+    return data
+
+
+def _intern_all(words):
+    return tuple(sys.intern(word) for word in words)
+
+
+def get_hugo_index():
+    '''
+
+    Return:
+        (DictionaryIndex) approximate-match index over exHUGO, for corrected_processing_by_dict
+
+    '''
+    return _load(cfg.hugo_dictionary_path, 'index', lambda words: DictionaryIndex(_intern_all(words)))
+
+
+def get_gene_names(upper=True):
+    '''
+
+    Args:
+        upper: upper-case every name, as the fuzzy matching in the pipelines expects
+
+    Return:
+        (tuple) gene names from cfg.dictionary_path (all_gene_names.json)
+
+    '''
+    if upper:
+        return _load(cfg.dictionary_path, 'upper', lambda words: _intern_all(x.upper() for x in words))
+    return _load(cfg.dictionary_path, 'list', _intern_all)
+
+
+if __name__ == '__main__':
+    import time
+
+    for name, loader in [('exHUGO index', get_hugo_index), ('gene names', get_gene_names)]:
+        start = time.time()
+        entries = loader()
+        print('{:s}: {:d} entries in {:.3f}s'.format(name, len(entries), time.time() - start))
@@ -0,0 +1,35 @@
+import threading
+from collections import OrderedDict
+
+
+class IdentityCache(object):
+    """
+    Values derived from a few large objects (gene lists), keyed by the identity of the object.
+
+    Hashing a list of 200k names on every call would cost more than the lookup it keys, so the object
+    itself is the key. The cache holds a reference to the objects it keys, so an id is never reused
+    while cached, and keeps only the maxsize most recently used ones. The objects must not change
+    once they are cached.
+    """
+
+    def __init__(self, build, maxsize=4):
+        self.build = build
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # id -> (object, value)
+
+    def get(self, obj):
+        with self.lock:
+            entry = self.entries.get(id(obj))
+            if entry is not None and entry[0] is obj:
+                self.entries.move_to_end(id(obj))
+                return entry[1]
+
+        # built outside the lock, two threads may build the same value once
+        value = self.build(obj)
+        with self.lock:
+            self.entries[id(obj)] = (obj, value)
+            self.entries.move_to_end(id(obj))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
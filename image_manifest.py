@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+import cfg
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# bump when the entry layout or the way sizes are read changes
+MANIFEST_VERSION = 2
+
+# PIL formats cv2.imread decodes, other files PIL reads (GIF, ICO, PSD, ...) are decoded with cv2 to decide
+CV2_FORMATS = frozenset(['BMP', 'DIB', 'JPEG', 'JPEG2000', 'MPO', 'PNG', 'PPM', 'SUN', 'TIFF', 'WEBP'])
+
+# EXIF orientations that swap width and height, cv2.imread and detectron2 read_image apply them
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+EXIF_ORIENTATION = 274
+
+
+def file_hash(file_name):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name, 'rb') as image_fp:
+        for chunk in iter(lambda: image_fp.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_image_size(file_name):
+    '''
+
+    Args:
+        file_name: path of an image
+
+    Return:
+        (height, width) as cv2.imread would decode it, read from the file header when PIL is available;
+        None if the file is not an image
+
+    '''
+    if Image is not None:
+        try:
+            with Image.open(file_name) as image:
+                if image.format not in CV2_FORMATS:
+                    raise ValueError('cv2 may not decode {!r}'.format(image.format))
+                width, height = image.size
+                try:
+                    orientation = image.getexif().get(EXIF_ORIENTATION)
+                except Exception:
+                    orientation = None
+            if orientation in TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return height, width
+        except Exception:
+            pass
+
+    # formats PIL does not read or cv2 may not, or no PIL: decode
+    img = cv2.imread(file_name)
+    if img is None:
+        return None
+    return img.shape[:2]
+
+
+def scan_entry(file_name, stat):
+    size = read_image_size(file_name)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size,
+            'height': size[0] if size else None, 'width': size[1] if size else None,
+            'hash': file_hash(file_name) if size else None}
+
+
+class ImageManifest(object):
+    """
+    Height, width and content hash of every file in one image folder, kept on disk between runs.
+
+    The manifest lives in cfg.image_manifest_folder, one json per folder. A scan lists the folder,
+    keeps the entry of every file whose mtime and size did not change and reads only new or changed
+    files, their headers on cfg.image_manifest_workers threads. Files that are not images are
+    recorded too, with None sizes, so they are not opened again.
+    """
+
+    def __init__(self, folder, workers=None):
+        self.folder = folder
+        self.workers = workers or cfg.image_manifest_workers
+        self.manifest_file = os.path.join(cfg.image_manifest_folder, '{:s}.json'.format(
+            hashlib.blake2b(os.path.abspath(folder).encode('utf-8'), digest_size=8).hexdigest()))
+        self.entries = {}  # file name in folder -> entry
+        self.order = []  # file names in folder listing order
+        self.rescanned = 0
+
+    def load(self):
+        try:
+            with open(self.manifest_file, 'r') as manifest_fp:
+                manifest = json.load(manifest_fp)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('folder') != os.path.abspath(self.folder):
+            return {}
+        return manifest['entries']
+
+    def save(self):
+        if not os.path.isdir(cfg.image_manifest_folder):
+            os.makedirs(cfg.image_manifest_folder)
+        # write then rename, a crashed run leaves the previous manifest
+        tmp_file = '{:s}.{:d}.tmp'.format(self.manifest_file, os.getpid())
+        with open(tmp_file, 'w') as manifest_fp:
+            json.dump({'version': MANIFEST_VERSION, 'folder': os.path.abspath(self.folder),
+                       'entries': self.entries}, manifest_fp)
+        os.replace(tmp_file, self.manifest_file)
+
+    def scan(self):
+        '''
+
+        Bring the manifest up to date with the folder and save it if anything changed
+
+        Return:
+            (ImageManifest) self
+
+        '''
+        cached = self.load()
+        dir_entries = list(os.scandir(self.folder))
+        self.order = [dir_entry.name for dir_entry in dir_entries]
+        stats = {dir_entry.name: dir_entry.stat() for dir_entry in dir_entries if dir_entry.is_file()}
+
+        entries = {}
+        changed = []
+        for name, stat in stats.items():
+            entry = cached.get(name)
+            if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                entries[name] = entry
+            else:
+                changed.append(name)
+
+        if changed:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                scanned = executor.map(lambda name: scan_entry(os.path.join(self.folder, name), stats[name]), changed)
+                entries.update(zip(changed, scanned))
+
+        self.entries = entries
+        self.rescanned = len(changed)
+        if changed or len(entries) != len(cached):
+            try:
+                self.save()
+            except OSError as e:
+                print('could not save image manifest {:s}: {:s}'.format(self.manifest_file, str(e)))
+        return self
+
+    def image_size(self, file_name):
+        """(height, width) of a file of the folder, None if it is not an image."""
+        entry = self.entries.get(os.path.relpath(file_name, self.folder))
+        if entry is None:
+            # not in the folder listing, e.g. an imagePath pointing into a sub folder
+            return read_image_size(file_name) if os.path.isfile(file_name) else None
+        if entry['height'] is None:
+            return None
+        return entry['height'], entry['width']
+
+    def images(self):
+        '''
+
+        Return:
+            (list) (index in the folder listing, path, entry) of every image of the folder
+
+        '''
+        return [(idx, os.path.join(self.folder, name), self.entries[name])
+                for idx, name in enumerate(self.order)
+                if name in self.entries and self.entries[name]['height'] is not None]
+
+
+def get_image_manifest(folder):
+    return ImageManifest(folder).scan()
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    # usage: python image_manifest.py <image folder>
+    folder = sys.argv[1]
+
+    start = time.time()
+    decoded = 0
+    for name in os.listdir(folder):
+        img = cv2.imread(os.path.join(folder, name))
+        decoded += img is not None
+    decode_time = time.time() - start
+
+    for run in ['first scan', 'rescan']:
+        start = time.time()
+        manifest = get_image_manifest(folder)
+        print('{:s}: {:d} images, {:d} files read, {:.2f}s'.format(
+            run, len(manifest.images()), manifest.rescanned, time.time() - start))
+    print('cv2.imread of every file: {:d} images, {:.2f}s'.format(decoded, decode_time))
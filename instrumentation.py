@@ -0,0 +1,156 @@
+import cProfile
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import cfg
+
+
+class Metrics(object):
+    """
+    Counters and stage timers of one process, safe to update from any thread.
+
+    Counters count things (figures, OCR calls, cache hits), timers sum the seconds and calls of a
+    stage. Worker processes send back delta(before) with their results and the parent merges it, so
+    the totals cover the whole run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}  # name -> [calls, seconds, max seconds]
+        self.started = time.time()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds, calls=1):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds / max(calls, 1))
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'timers': {name: list(timer) for name, timer in self.timers.items()}}
+
+    def delta(self, before):
+        """What was counted and timed since snapshot before, to send to the parent process."""
+        now = self.snapshot()
+        counters = {name: value - before['counters'].get(name, 0) for name, value in now['counters'].items()}
+        timers = {}
+        for name, (calls, seconds, longest) in now['timers'].items():
+            before_calls, before_seconds, _ = before['timers'].get(name, [0, 0.0, 0.0])
+            if calls > before_calls:
+                timers[name] = [calls - before_calls, seconds - before_seconds, longest]
+        return {'counters': {name: value for name, value in counters.items() if value}, 'timers': timers}
+
+    def merge(self, delta):
+        for name, value in delta['counters'].items():
+            self.count(name, value)
+        with self.lock:
+            for name, (calls, seconds, longest) in delta['timers'].items():
+                timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += calls
+                timer[1] += seconds
+                timer[2] = max(timer[2], longest)
+
+    def report(self):
+        '''
+
+        Return:
+            (dict) counters, per stage calls, total and mean seconds, and OCR calls per text box
+
+        '''
+        snapshot = self.snapshot()
+        report = {'time': time.time(), 'uptime': time.time() - self.started, 'counters': snapshot['counters'],
+                  'stages': {name: {'calls': calls, 'seconds': seconds, 'mean_seconds': seconds / max(calls, 1),
+                                    'max_seconds': longest}
+                             for name, (calls, seconds, longest) in snapshot['timers'].items()}}
+        if snapshot['counters'].get('ocr_boxes'):
+            report['ocr_calls_per_box'] = snapshot['counters'].get('ocr_calls', 0) / snapshot['counters']['ocr_boxes']
+        return report
+
+    def export_json_lines(self, file_name):
+        """Append the report as one json line, a run writes one line per export."""
+        with open(file_name, 'a') as metrics_fp:
+            metrics_fp.write(json.dumps(self.report()) + '\n')
+
+    def export_prometheus(self, file_name):
+        """Write the report in the Prometheus text format, for the node exporter textfile collector."""
+        report = self.report()
+        lines = []
+        for name, value in sorted(report['counters'].items()):
+            metric = 'pathway_{:s}_total'.format(re.sub(r'[^a-zA-Z0-9_]', '_', name))
+            lines += ['# TYPE {:s} counter'.format(metric), '{:s} {:g}'.format(metric, value)]
+        lines.append('# TYPE pathway_stage_seconds summary')
+        for name, stage in sorted(report['stages'].items()):
+            lines.append('pathway_stage_seconds_sum{{stage="{:s}"}} {:.6f}'.format(name, stage['seconds']))
+            lines.append('pathway_stage_seconds_count{{stage="{:s}"}} {:d}'.format(name, stage['calls']))
+        if 'ocr_calls_per_box' in report:
+            lines += ['# TYPE pathway_ocr_calls_per_box gauge',
+                      'pathway_ocr_calls_per_box {:.6f}'.format(report['ocr_calls_per_box'])]
+
+        # write then rename, the collector never reads a half written file
+        tmp_file = '{:s}.{:d}.tmp'.format(file_name, os.getpid())
+        with open(tmp_file, 'w') as metrics_fp:
+            metrics_fp.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, file_name)
+
+    def export(self):
+        """Export as cfg.metrics_format selects: 'jsonl', 'prometheus' or 'off'."""
+        if cfg.metrics_format == 'jsonl':
+            self.export_json_lines(cfg.metrics_file)
+        elif cfg.metrics_format == 'prometheus':
+            self.export_prometheus(cfg.metrics_file)
+
+
+# metrics of this process, every stage records into it
+metrics = Metrics()
+
+
+def profile_call(profile_file, function, *args):
+    '''
+
+    Run function under cProfile and dump the stats
+
+    Args:
+        profile_file: file for the pstats dump, open it with python -m pstats
+        function: callable run with *args
+
+    Return:
+        what function returns
+
+    '''
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(profile_file)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    # cost of a timer and a counter, the pipeline records a few per text box
+    n = 100000
+    start = time.time()
+    for k in range(n):
+        with metrics.timer('box'):
+            metrics.count('boxes')
+    print('{:.2f} us per timed and counted box'.format((time.time() - start) / n * 1e6))
+    print(json.dumps(metrics.report(), indent=2))
@@ -13,6 +13,8 @@ from mmcv.runner import load_checkpoint
 from mmcv.utils.config import Config
 from PIL import Image
 
+import cfg
+
 try:
     import tesserocr
 except ImportError:
@@ -689,10 +691,66 @@ def cropimg(src_img, box):
     return dst_img
 
 
-def mmocr_without_det(det=None, recog='SEG', img=None, element_bbox=None, output=None):
+class RecognizerSession:
+    """
+    Text recognizer loaded once and reused for the crops of many figures.
+
+    Crops are keyed by (figure id, box id). recognize() sorts them by aspect ratio so every batch
+    holds crops of similar shape, which keeps the padding of the resized batch small, and runs
+    each batch through MMOCR.single_inference(batch_mode=True).
+    """
+
+    def __init__(self, recog='SEG', recog_config='', recog_ckpt='', device=None, batch_size=None):
+        self.ocr = MMOCR(det=None, recog=recog, recog_config=recog_config, recog_ckpt=recog_ckpt, device=device)
+        self.batch_size = batch_size or cfg.mmocr_recog_batch_size
+
+        # number of crops and batches recognized by this session
+        self.crops_recognized = 0
+        self.batches_run = 0
+
+    def recognize(self, keyed_crops):
+        '''
+
+        Args:
+            keyed_crops: list of ((figure id, box id), crop array)
+
+        Return:
+            (dict) (figure id, box id) -> recognized text, '' for empty crops
+
+        '''
+        texts = {}
+        crops = []
+        for key, crop in keyed_crops:
+            if crop.size == 0:
+                texts[key] = ''
+            else:
+                crops.append((crop.shape[1] / float(crop.shape[0]), key, crop))
+
+        crops.sort(key=lambda item: item[0])
+        for start in range(0, len(crops), self.batch_size):
+            batch = crops[start:start + self.batch_size]
+            results = self.ocr.single_inference(self.ocr.recog_model, [crop for _, _, crop in batch], batch_mode=True)
+            for (_, key, _), result in zip(batch, results):
+                texts[key] = result['text']
+            self.crops_recognized += len(batch)
+            self.batches_run += 1
+
+        return texts
+
+
+# recognizer sessions of this process, by recognition model
+recognizer_sessions = {}
+
+
+def get_recognizer_session(recog='SEG'):
+    if recog not in recognizer_sessions:
+        recognizer_sessions[recog] = RecognizerSession(recog=recog)
+    return recognizer_sessions[recog]
+
+
+def crop_element_boxes(img_cv, element_bbox):
     img_crops = []
     boxs = []
-    img_cv = cv2.imread(img)
     for index in element_bbox.index:
         min_x = round(element_bbox.loc[index][0])
         min_y = round(element_bbox.loc[index][1])
@@ -706,15 +764,68 @@ def mmocr_without_det(det=None, recog='SEG', img=None, element_bbox=None, output
         img_crop = cropimg(img_cv, box)
         img_crops.append(img_crop)
         boxs.append(boxx)
-    ocr = MMOCR(det=det, recog=recog)
-    mmocr_results = ocr.readtext(img_crops)
+    return img_crops, boxs
+
+
+def read_figure(img):
+    return img if isinstance(img, np.ndarray) else cv2.imread(img)
+
+
+def recognize_figures(figures, session=None):
+    '''
+
+    Recognize the element boxes of several figures in shared batches
+
+    Args:
+        figures: list of (figure id, decoded BGR image or image file, element bbox series in xywh)
+        session: RecognizerSession, the cached SEG session of this process if None
+
+    Return:
+        (dict) figure id -> (texts in box order, boxes as [[min_x, min_y], [max_x, max_y]])
+
+    '''
+    if session is None:
+        session = get_recognizer_session()
+
+    keyed_crops = []
+    figure_boxes = {}
+    for figure_id, img, element_bbox in figures:
+        img_crops, boxs = crop_element_boxes(read_figure(img), element_bbox)
+        keyed_crops.extend(((figure_id, box_id), img_crop) for box_id, img_crop in enumerate(img_crops))
+        figure_boxes[figure_id] = boxs
+
+    texts = session.recognize(keyed_crops)
+    return {figure_id: ([texts[(figure_id, box_id)] for box_id in range(len(boxs))], boxs)
+            for figure_id, boxs in figure_boxes.items()}
+
+
+def mmocr_without_det(det=None, recog='SEG', img=None, element_bbox=None, session=None, recognized=None):
+    if recognized is not None:
+        # texts and boxes already recognized with the other figures of the batch, see recognize_figures
+        texts, boxs = recognized
+        mmocr_results = (texts, [])
+    elif det is None:
+        if session is None:
+            session = get_recognizer_session(recog)
+        texts, boxs = recognize_figures([(0, img, element_bbox)], session)[0]
+        mmocr_results = (texts, [])
+    else:
+        img_crops, boxs = crop_element_boxes(read_figure(img), element_bbox)
+        ocr = MMOCR(det=det, recog=recog)
+        mmocr_results = ocr.readtext(img_crops)
+
+    return mmocr_results, boxs
+
+
+def show_recognition_result(img, texts, boxs, output):
+    """Draw the recognized texts of mmocr_without_det on the figure and write it to output."""
     box_text_list = []
     # box_text_dit = {}
     # det_recog_result = [{'result': box_text_list}]
 
-    for i in range(len(mmocr_results[0])):
+    for i in range(len(texts)):
         box_text_dit = {}
-        box_text_dit['text'] = mmocr_results[0][i]
+        box_text_dit['text'] = texts[i]
         box_text_dit['box'] = boxs[i]
         box_text_list.append(box_text_dit)
 
@@ -724,10 +835,8 @@ def mmocr_without_det(det=None, recog='SEG', img=None, element_bbox=None, output
     det_recog_result = xxyy2xyxy(det_recog_result)
     det_recog_result = det_recog_result[0]
     # print('det_recog_result:\n', det_recog_result)
-    res_img = det_recog_show_result(
-        img, det_recog_result, out_file=output)
-
-    return mmocr_results, boxs
+    # draw on a copy, a decoded figure is shared with the other pipeline stages
+    det_recog_show_result(read_figure(img).copy(), det_recog_result, out_file=output)
 
 
 if __name__ == "__main__":
@@ -11,6 +11,7 @@ import os
 from collections import OrderedDict
 import torch
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 from fvcore.common.file_io import PathManager
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
@@ -27,11 +28,57 @@ from detectron2.utils.logger import create_small_table
 from detectron2.data.datasets.coco import convert_to_coco_json
 from detectron2.evaluation.coco_evaluation import COCOEvaluator
 
+import cfg
+
+
+def rotated_iou_matrix(gt_boxes, dt_boxes):
+    '''
+
+    Args:
+        gt_boxes: list of [cx, cy, w, h, angle] ground truth boxes
+        dt_boxes: list of [cx, cy, w, h, angle] detections, sorted by score
+
+    Return:
+        (np.ndarray) len(dt_boxes) x len(gt_boxes) IoU matrix from one pairwise_iou_rotated call
+
+    '''
+    if len(gt_boxes) == 0 or len(dt_boxes) == 0:
+        return np.zeros((len(dt_boxes), len(gt_boxes)))
+    gt_rotated_boxes = RotatedBoxes(torch.tensor(gt_boxes, dtype=torch.float).view(-1, 5))
+    dt_rotated_boxes = RotatedBoxes(torch.tensor(dt_boxes, dtype=torch.float).view(-1, 5))
+    return pairwise_iou_rotated(dt_rotated_boxes, gt_rotated_boxes).numpy().astype(np.float64)
+
+
+def _rotated_iou_matrix_task(boxes):
+    return rotated_iou_matrix(*boxes)
+
+
 class PathwayEval(COCOeval):
-    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm'):
+    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm', workers=0):
        super().__init__(cocoGt, cocoDt, iouType)
+       # processes computing the IoU matrices of the images, 0 computes them in evaluate's loop
+       self.workers = workers
+       self.precomputed_ious = {}
+
+    def _prepare(self):
+        super()._prepare()
+        self.precomputed_ious = {}
+        if self.workers <= 1:
+            return
 
-    def computeIoU(self, imgId, catId):
+        # every (image, category) evaluate will ask for, the matrices are spread over the pool
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        keys = [(imgId, catId) for imgId in p.imgIds for catId in catIds]
+        boxes = [self.sorted_boxes(imgId, catId) for imgId, catId in keys]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            matrices = executor.map(_rotated_iou_matrix_task, [box for box in boxes if box is not None],
+                                    chunksize=max(1, len(keys) // (self.workers * 8)))
+            for key, box in zip(keys, boxes):
+                self.precomputed_ious[key] = [] if box is None else next(matrices)
+
+    def sorted_boxes(self, imgId, catId):
+        """(gt boxes, dt boxes by score) of one image and category, None if there are neither."""
         p = self.params
         if p.useCats:
             gt = self._gts[imgId,catId]
@@ -40,19 +87,21 @@ class PathwayEval(COCOeval):
             gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
             dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
         if len(gt) == 0 and len(dt) ==0:
-            return []
+            return None
         inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
         dt = [dt[i] for i in inds]
         if len(dt) > p.maxDets[-1]:
             dt=dt[0:p.maxDets[-1]]
-        ious = np.zeros((len(dt), len(gt)))
-        for j, g in enumerate(gt):
-            for i, d in enumerate(dt):
-                # create bounds for ignore regions(double the gt bbox)
-                gt_rotated_box = RotatedBoxes(torch.tensor(g['bbox'], dtype= torch.float).view(-1,5))
-                dt_rotated_box = RotatedBoxes(torch.tensor(d['bbox'], dtype= torch.float).view(-1,5))
-                ious[i, j] = pairwise_iou_rotated(gt_rotated_box, dt_rotated_box)
-                del gt_rotated_box,dt_rotated_box
+        return [g['bbox'] for g in gt], [d['bbox'] for d in dt]
+
+    def computeIoU(self, imgId, catId):
+        if (imgId, catId) in self.precomputed_ious:
+            return self.precomputed_ious[imgId, catId]
+        boxes = self.sorted_boxes(imgId, catId)
+        if boxes is None:
+            return []
+        # all gt and dt boxes of the image and category in one call
+        ious = rotated_iou_matrix(*boxes)
         # if p.iouType == 'segm':
         #     g = [g['segmentation'] for g in gt]
         #     d = [d['segmentation'] for d in dt]
@@ -65,7 +114,6 @@ class PathwayEval(COCOeval):
         # # compute iou between each dt and gt region
         # iscrowd = [int(o['iscrowd']) for o in gt]
         # ious = maskUtils.iou(d,g,iscrowd)
-        del gt, dt
         return ious
 
 
@@ -559,7 +607,7 @@ def _evaluate_predictions_on_coco(coco_gt, coco_results, iou_type, kpt_oks_sigma
 
     coco_dt = coco_gt.loadRes(coco_results)
 
-    pathway_eval = PathwayEval(coco_gt, coco_dt, iou_type)
+    pathway_eval = PathwayEval(coco_gt, coco_dt, iou_type, workers=cfg.evaluation_iou_workers)
 
 
     # Use the COCO default keypoint OKS sigmas unless overrides are specified
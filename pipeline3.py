@@ -11,11 +11,7 @@ import cfg
 import torch
 from train_net import RegularTrainer
 import pandas as pd
-from nfkc import nfkc
-from deburr import deburr
-from upper import upper
-from expand import expand
-from swaps import swaps
+from text_normalizer import normalize_tokens
 import numpy as np
 import copy
 import requests
@@ -26,6 +22,7 @@ from xml.etree import ElementTree
 
 from fuzzywuzzy import fuzz, process
 from fuzzywuzzy.process import default_processor
+from batch_correction import batch_extract_bests
 
 from detectron2.structures import BoxMode,Boxes
 
@@ -44,7 +41,12 @@ from nlp_pipeline_v2.from_PMCID_to_gene_annotation_and_cooccurrence.SubmitPMCIDL
 from nlp_pipeline_v2.from_PMCID_to_gene_annotation_and_cooccurrence.gene_cooccurrence_from_pubtator_results import extract_gene_annotation_and_full_text,preprocess_sent_list_and_gene_list,gene_co_occurrence_in_sentence
 
 
-from body_interface import instances_to_coco_json,setup,build_data_fold_loader,inference_context
+from gene_dictionary import get_gene_names
+from relation_geometry import assign_relation_heads
+from visualization import get_visualization_policy
+from body_interface import instances_to_coco_json,outputs_to_coco_json,COCO_COLUMNS,setup,build_data_fold_loader,inference_context
+from cooccurrence_index import get_cooccurrence_index, score_relations
+from similarity import get_similarity_index, jaro_distance
 from demo.predictor_jingyi import VisualizationDemo
 
 # constants
@@ -183,7 +185,7 @@ def compute_iou(box1, box2, wh=True):
     # print('iou,center',iou,center)
     return iou,center
 
-def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
+def reorganize_outputs(el_output,body_output,inputs,cfg):
     '''
 
     Reorganize outputs into coco format and split results into dataframes by category id
@@ -191,8 +193,7 @@ def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
     Args:
         el_output: direct outputs from the element model
         body_output: direct outputs from the relation model
-        image_ids: image ids for current inputs
-        file_names: filenames of current inputs
+        inputs: the batch given to both models, one output per image
         cfg: configuration dict for model
     
     Return:
@@ -203,16 +204,13 @@ def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
     '''
 
     # get results and convert to coco format
-    cpu_device = torch.device("cpu")
-    el_instances = el_output[0]["instances"].to(cpu_device)
-    el_predictions = instances_to_coco_json(el_instances, image_ids, file_names)
-    body_instances = body_output[0]["instances"].to(cpu_device)
-    body_predictions = instances_to_coco_json(body_instances, image_ids, file_names)
+    el_predictions = outputs_to_coco_json(el_output, inputs)
+    body_predictions = outputs_to_coco_json(body_output, inputs)
 
-    el_model_instances = pd.DataFrame(el_predictions)
+    el_model_instances = pd.DataFrame(el_predictions, columns=COCO_COLUMNS)
     el_model_instances['ocr'] = None
 
-    body_instances = pd.DataFrame(body_predictions)
+    body_instances = pd.DataFrame(body_predictions, columns=COCO_COLUMNS)
     body_instances['ocr'] = None
     body_instances['head'] = None
     body_instances['tail'] = None
@@ -229,90 +227,12 @@ def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
     return element_instances, relation_head_instances, relation_body_instances
 
 def get_jaccard(candidate_entity,gene_name_list,score_cutoff):
-
-    candidate_entity = set(candidate_entity)
-
-    results = []
-    for gene_name in gene_name_list:
-        jd = nltk.jaccard_distance(candidate_entity,set(gene_name))
-        if jd > score_cutoff:
-            results.append([gene_name,jd])
-
-    return results
-
-def jaro_distance(s1, s2):
-     
-    # If the s are equal
-    if (s1 == s2):
-        return 1.0
- 
-    # Length of two s
-    len1 = len(s1)
-    len2 = len(s2)
- 
-    # Maximum distance upto which matching
-    # is allowed
-    max_dist = floor(max(len1, len2) / 2) - 1
- 
-    # Count of matches
-    match = 0
- 
-    # Hash for matches
-    hash_s1 = [0] * len(s1)
-    hash_s2 = [0] * len(s2)
- 
-    # Traverse through the first
-    for i in range(len1):
- 
-        # Check if there is any matches
-        for j in range(max(0, i - max_dist),
-                       min(len2, i + max_dist + 1)):
-             
-            # If there is a match
-            if (s1[i] == s2[j] and hash_s2[j] == 0):
-                hash_s1[i] = 1
-                hash_s2[j] = 1
-                match += 1
-                break
- 
-    # If there is no match
-    if (match == 0):
-        return 0.0
- 
-    # Number of transpositions
-    t = 0
-    point = 0
- 
-    # Count number of occurrences
-    # where two characters match but
-    # there is a third matched character
-    # in between the indices
-    for i in range(len1):
-        if (hash_s1[i]):
- 
-            # Find the next matched character
-            # in second
-            while (hash_s2[point] == 0):
-                point += 1
- 
-            if (s1[i] != s2[point]):
-                point += 1
-                t += 1
-    t = t//2
- 
-    # Return the Jaro Similarity
-    return (match/ len1 + match / len2 +
-            (match - t + 1) / match)/ 3.0
+    # character set masks of the gene list are built once, see similarity.py
+    return get_similarity_index(gene_name_list).jaccard(candidate_entity, score_cutoff)
 
 def get_jaro(candidate_entity,gene_name_list,score_cutoff):
-
-    results = []
-    for gene_name in gene_name_list:
-        jd = jaro_distance(candidate_entity,gene_name)
-        if jd > score_cutoff:
-            results.append([gene_name,jd])
-
-    return results
+    # entries that can not beat score_cutoff are skipped, see similarity.py
+    return get_similarity_index(gene_name_list).jaro(candidate_entity, score_cutoff)
 
 
 def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,image_name,relation_body_instances,img_id):
@@ -341,20 +261,7 @@ def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,imag
     # postprocessing on ocr result
     # nfkc->deburr->upper->expand->swap
     # TODO:: problem with swapping correctly detected special characters
-    postprocessing_ocr_results = []
-    for r in ocr_results:
-        r = nfkc(r)
-        r = ''.join(r)
-        r = deburr(r)
-        r = ''.join(r)
-        r = upper(r)
-        r = ''.join(r)
-        r = expand(r)
-        r = ''.join(r)
-        pp_r = swaps(r)
-        pp_r = ''.join(pp_r)
-
-        postprocessing_ocr_results.append(pp_r)
+    postprocessing_ocr_results = normalize_tokens(ocr_results)
 
     print("list len")
     print(len(gene_name_list))
@@ -365,6 +272,12 @@ def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,imag
     # check for perfect match from pubtator results and check for fuzzy match
     not_gene_idxs = []
     fuzz_match_thresh = 90
+
+    # score every string that needs a fuzzy match against the gene list at once
+    to_correct = [candidate_entity for candidate_entity in postprocessing_ocr_results
+                  if candidate_entity and not (article_gene_list and candidate_entity in article_gene_list)]
+    all_corrections = dict(zip(to_correct, batch_extract_bests(to_correct, gene_name_list, cfg.candidate_threshold)))
+
     for idx,candidate_entity in enumerate(postprocessing_ocr_results):
 
         if article_gene_list and candidate_entity in article_gene_list:
@@ -375,7 +288,7 @@ def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,imag
                 continue
             
             # change to do fuzzy match w/ article gene list
-            corrections = process.extractBests(candidate_entity, gene_name_list, processor=default_processor, scorer=fuzz.ratio, score_cutoff=cfg.candidate_threshold)
+            corrections = all_corrections[candidate_entity]
             # corrections = get_jaccard(candidate_entity,gene_name_list,score_cutoff=cfg.candidate_threshold)
 
 
@@ -483,15 +396,13 @@ def get_relationship_head(processed_el_body_instances,current_relation_head_inst
     current_relation_body_instances = processed_el_body_instances[(processed_el_body_instances['category_id'] != 1)]
     relation_body_bboxes = current_relation_body_instances['bbox'].tolist()
     
-    # head can be none for a relation body if no indicator is inside of it
-    for i in range(0,len(relation_body_bboxes)):
-        iou=0
-        for j in range(0,len(relation_head_bboxes)):
-            temp_iou,center = compute_iou(relation_head_bboxes[j],relation_body_bboxes[i],True)
-            if temp_iou>iou:
-                iou = temp_iou
-                # relation_body_instance.index slice maintains the row indexing from processed_el_body_instance: this may throw a warning, but it is working as intended
-                processed_el_body_instances['head'][current_relation_body_instances.index[i]] = center
+    # head can be none for a relation body if no indicator is inside of it, it keeps its previous value then
+    relation_heads = assign_relation_heads(relation_body_bboxes, relation_head_bboxes)
+    heads = processed_el_body_instances['head'].tolist()
+    for position, center in zip(np.flatnonzero((processed_el_body_instances['category_id'] != 1).values), relation_heads):
+        if center is not None:
+            heads[position] = center
+    processed_el_body_instances['head'] = pd.Series(heads, index=processed_el_body_instances.index, dtype=object)
 
     return processed_el_body_instances
 
@@ -548,13 +459,13 @@ def get_relationship_tail(current_image_file,processed_el_body_instances):
                         dis_max = dis
                         tail = [raw_x, raw_y]
 
-                # current_relation_body_instances.index slice maintains the row indexing from processed_el_body_instances: this may throw a warning, but it is working as intended
-                processed_el_body_instances['tail'][current_relation_body_instances.index[i]] = tail
+                # current_relation_body_instances.index slice maintains the row indexing from processed_el_body_instances
+                processed_el_body_instances.at[current_relation_body_instances.index[i], 'tail'] = tail
                 del tail
             else:
                 # TODO:: handle this case better
                 # if no corners found, set tail to top left corner
-                processed_el_body_instances['tail'][current_relation_body_instances.index[i]] = [0, 0]
+                processed_el_body_instances.at[current_relation_body_instances.index[i], 'tail'] = [0, 0]
 
     return processed_el_body_instances
 
@@ -579,7 +490,6 @@ def get_receptor(relation_heads,current_relation_body_instances,gene_centers,pro
 
     min_js = []
 
-    print(len(relation_heads))
 
     # TODO:: maybe do different handling for no head detected
     # get relation body receptor
@@ -597,7 +507,7 @@ def get_receptor(relation_heads,current_relation_body_instances,gene_centers,pro
                     ocr = processed_el_body_instances['ocr'][processed_genes.index[j]]
 
         min_js.append(min_j)
-        processed_el_body_instances['receptor'][current_relation_body_instances.index[i]] = ocr
+        processed_el_body_instances.at[current_relation_body_instances.index[i], 'receptor'] = ocr
 
     return processed_el_body_instances, min_js
 
@@ -620,7 +530,6 @@ def get_startor(relation_tails,current_relation_body_instances,gene_centers,proc
         
     '''
 
-    print(len(relation_tails))
 
     # get relation body starter
     for i in range(0,len(relation_tails)):
@@ -639,7 +548,7 @@ def get_startor(relation_tails,current_relation_body_instances,gene_centers,proc
                 if dis<dis_tail:
                     dis_tail = dis
                     ocr = processed_el_body_instances['ocr'][processed_genes.index[j]]
-        processed_el_body_instances['startor'][current_relation_body_instances.index[i]] = ocr
+        processed_el_body_instances.at[current_relation_body_instances.index[i], 'startor'] = ocr
 
     return processed_el_body_instances
 
@@ -707,8 +616,8 @@ def get_startors_and_receptors(current_image_file,processed_el_body_instances):
     for i in range(0, len(gene_list)):
         # gene_list bbox values are XYWH
         center = [int(gene_list[i][0] + gene_list[i][2] / 2), int(gene_list[i][1] + gene_list[i][3] / 2)]
-        # gene_dic.index slice maintains the row indexing from element_instances: this may throw a warning, but it is working as intended
-        processed_el_body_instances['center'][gene_dic.index[i]] = center
+        # gene_dic.index slice maintains the row indexing from element_instances
+        processed_el_body_instances.at[gene_dic.index[i], 'center'] = center
     processed_genes = processed_el_body_instances[processed_el_body_instances['category_id'] == 1]
     gene_centers = processed_genes['center'].tolist()
 
@@ -730,7 +639,7 @@ def score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances):
     rank each relationship by how often their gene's co_occur the figure's article
 
     Args:
-        gene_co_occurrence: current article's co-occurring genes by sentence
+        gene_co_occurrence: CooccurrenceIndex of the current article (get_cooccurrence_index), or its co-occurring genes by sentence
         processed_el_body_instances: element and arrow/t-bar body instances
         
     Return:
@@ -738,26 +647,8 @@ def score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances):
 
     '''
 
-    # TODO:: make this faster
-    # set coocurrence score and relation category
-    processed_el_body_instances['rank'] = 0
-    r_body_instances = processed_el_body_instances[processed_el_body_instances['category_id'] != 1]
-    for i, r_body_instance in r_body_instances.iterrows():
-
-        for j, row in gene_co_occurrence.iterrows():
-            if r_body_instance['startor'] == row['gene_name_1'] and r_body_instance['receptor'] == row['gene_name_2']:
-                processed_el_body_instances['rank'][i] = row['co_occurrence']
-                break
-            elif r_body_instance['receptor'] == row['gene_name_1'] and r_body_instance['startor'] == row['gene_name_2']:
-                processed_el_body_instances['rank'][i] = row['co_occurrence']
-                break
-
-        if r_body_instance['category_id']==0:
-            processed_el_body_instances['relation_category'][i] = 'activate_relation'
-        if r_body_instance['category_id']==2:
-            processed_el_body_instances['relation_category'][i] = 'inhibit_relation'
-
-    return processed_el_body_instances
+    # set coocurrence score and relation category, one pair lookup per relationship
+    return score_relations(gene_co_occurrence, processed_el_body_instances)
 
 def filter_heads_and_tails(processed_el_body_instances):
 
@@ -792,10 +683,8 @@ def filter_heads_and_tails(processed_el_body_instances):
 
 def run_model(cfg, article_pd, **kwargs):
     
-    # get gene dictionary
-    with open(cfg.dictionary_path) as gene_name_list_fp:
-        gene_name_list = json.load(gene_name_list_fp)
-    gene_name_list = [x.upper() for x in gene_name_list]
+    # get gene dictionary, loaded once per process
+    gene_name_list = get_gene_names()
 
 
     # load models
@@ -820,7 +709,8 @@ def run_model(cfg, article_pd, **kwargs):
 
 
     # get data loader
-    data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False))
+    data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False),
+                                         batch_size=cfg.detection_batch_size)
 
     # set which device to run on
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -834,12 +724,11 @@ def run_model(cfg, article_pd, **kwargs):
             body_output = body_model.to(device)(inputs)
 
             # reorganize model outputs into dataframes by category
-            image_ids = inputs[0]["image_id"]
-            file_names = inputs[0]['file_name']
-            element_instances, relation_head_instances, relation_body_instances = reorganize_outputs(el_output,body_output,image_ids,file_names,cfg)
+            element_instances, relation_head_instances, relation_body_instances = reorganize_outputs(el_output,body_output,inputs,cfg)
 
             # loop through each image in batch
-            file_list = set(element_instances['file_name'])
+            # in batch order, figures without any gene are skipped
+            file_list = [x['file_name'] for x in inputs if x['file_name'] in set(element_instances['file_name'])]
             for current_image_file in file_list:
                 image_name, ext = os.path.splitext(os.path.basename(current_image_file))
                 print('doing ocr to file {:s}'.format(current_image_file))
@@ -855,7 +744,7 @@ def run_model(cfg, article_pd, **kwargs):
                 article_gene_list = article_pd.loc[(article_pd['figid'] == image_name+ext)]['gene_list'].values[0]
                 # article_gene_list = article_pd
                 # current_pmcid = article_pd.loc[(article_pd['figid'] == image_name+ext)]['pmcid'].values[0]
-                # gene_co_occurrence = pd.read_csv('nlp_pipeline_v2/from_PMCID_to_gene_annotation_and_cooccurrence/gene_co_occurrence/' + str(current_pmcid) + ".csv")
+                # gene_co_occurrence = get_cooccurrence_index(current_pmcid)
 
                 # get ocr result
                 img_id = current_element_instances['image_id'].values[0]
@@ -874,8 +763,10 @@ def run_model(cfg, article_pd, **kwargs):
                 # score relationships
                 # processed_el_body_instances = score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances)
 
-                # visualize elements and relationships
-                save_visual(current_image_file, processed_el_body_instances,visuals_folder, image_name, ext)
+                # visualize elements and relationships, as cfg.visualize_mode selects
+                get_visualization_policy().render(image_name, save_visual, current_image_file, processed_el_body_instances,
+                                                  visuals_folder, image_name, ext,
+                                                  failed=not (processed_el_body_instances['category_id'] != 1).any())
 
                 # save outputs
                 result = processed_el_body_instances[processed_el_body_instances['category_id'] != 1]
@@ -890,6 +781,9 @@ def run_model(cfg, article_pd, **kwargs):
 
                 del current_element_instances
 
+    # wait for queued visualizations
+    get_visualization_policy().close()
+
 
 if __name__ == "__main__":
 
@@ -981,7 +875,7 @@ if __name__ == "__main__":
 
             gene_annotation = list(set(gene_annotation))
             gene_annotation = [x.upper() for x in gene_annotation]
-            article_pd['gene_list'][index] = copy.deepcopy(gene_annotation)
+            article_pd.at[index, 'gene_list'] = copy.deepcopy(gene_annotation)
     '''
 
 
@@ -1017,7 +911,7 @@ if __name__ == "__main__":
 
             gene_annotation = list(set(gene_annotation))
             gene_annotation = [x.upper() for x in gene_annotation]
-            article_pd['gene_list'][index] = copy.deepcopy(gene_annotation)
+            article_pd.at[index, 'gene_list'] = copy.deepcopy(gene_annotation)
  
 
 
@@ -25,6 +25,9 @@ import time
 from xml.etree import ElementTree
 import statistics
 from corrected_ocr import corrected_processing_by_dict
+from gene_dictionary import get_gene_names, get_hugo_index
+from relation_geometry import assign_relation_heads, find_relation_tails, GeneCenterIndex
+from figure_table import FigureTable
 
 from fuzzywuzzy import fuzz, process
 from fuzzywuzzy.process import default_processor
@@ -46,10 +49,24 @@ from detectron2.data.build import DatasetMapper
 # from nlp_pipeline_v2.from_PMCID_to_gene_annotation_and_cooccurrence.gene_cooccurrence_from_pubtator_results import extract_gene_annotation_and_full_text,preprocess_sent_list_and_gene_list,gene_co_occurrence_in_sentence
 
 
-from body_interface import instances_to_coco_json,setup,build_data_fold_loader,inference_context
+from body_interface import instances_to_coco_json,outputs_to_coco_json,COCO_COLUMNS,setup,build_data_fold_loader,inference_context
+from cooccurrence_index import get_cooccurrence_index, score_relations
+from similarity import get_similarity_index, jaro_distance
 from demo.predictor_jingyi import VisualizationDemo
 
-from new_mmocr import mmocr_f, mmocr_without_det
+from new_mmocr import mmocr_f, mmocr_without_det, recognize_figures, RecognizerSession, show_recognition_result
+from visualization import get_visualization_policy
+from figure_context import FigureContext
+from detection import DualDetector
+from staged_pipeline import Stage, StagedPipeline
+from run_manifest import RunManifest, code_fingerprint, file_stamp
+from result_store import ResultStore, parquet_available
+from instrumentation import metrics, profile_call
+import corrected_ocr
+import correction_cache
+import gene_dictionary
+import new_mmocr
+import relation_geometry
 
 # constants
 WINDOW_NAME = "COCO detections"
@@ -188,7 +205,7 @@ def compute_iou(box1, box2, wh=True):
     # print('iou,center',iou,center)
     return iou,center
 
-def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
+def reorganize_outputs(el_output,body_output,inputs,cfg):
     '''
 
     Reorganize outputs into coco format and split results into dataframes by category id
@@ -196,8 +213,7 @@ def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
     Args:
         el_output: direct outputs from the element model
         body_output: direct outputs from the relation model
-        image_ids: image ids for current inputs
-        file_names: filenames of current inputs
+        inputs: the batch given to both models, one output per image
         cfg: configuration dict for model
     
     Return:
@@ -208,16 +224,13 @@ def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
     '''
 
     # get results and convert to coco format
-    cpu_device = torch.device("cpu")
-    el_instances = el_output[0]["instances"].to(cpu_device)
-    el_predictions = instances_to_coco_json(el_instances, image_ids, file_names)
-    body_instances = body_output[0]["instances"].to(cpu_device)
-    body_predictions = instances_to_coco_json(body_instances, image_ids, file_names)
+    el_predictions = outputs_to_coco_json(el_output, inputs)
+    body_predictions = outputs_to_coco_json(body_output, inputs)
 
-    el_model_instances = pd.DataFrame(el_predictions)
+    el_model_instances = pd.DataFrame(el_predictions, columns=COCO_COLUMNS)
     el_model_instances['ocr'] = None
 
-    body_instances = pd.DataFrame(body_predictions)
+    body_instances = pd.DataFrame(body_predictions, columns=COCO_COLUMNS)
     body_instances['ocr'] = None
     body_instances['head'] = None
     body_instances['tail'] = None
@@ -234,110 +247,40 @@ def reorganize_outputs(el_output,body_output,image_ids,file_names,cfg):
     return element_instances, relation_head_instances, relation_body_instances
 
 def get_jaccard(candidate_entity,gene_name_list,score_cutoff):
-
-    candidate_entity = set(candidate_entity)
-
-    results = []
-    for gene_name in gene_name_list:
-        jd = nltk.jaccard_distance(candidate_entity,set(gene_name))
-        if jd > score_cutoff:
-            results.append([gene_name,jd])
-
-    return results
-
-def jaro_distance(s1, s2):
-     
-    # If the s are equal
-    if (s1 == s2):
-        return 1.0
- 
-    # Length of two s
-    len1 = len(s1)
-    len2 = len(s2)
- 
-    # Maximum distance upto which matching
-    # is allowed
-    max_dist = floor(max(len1, len2) / 2) - 1
- 
-    # Count of matches
-    match = 0
- 
-    # Hash for matches
-    hash_s1 = [0] * len(s1)
-    hash_s2 = [0] * len(s2)
- 
-    # Traverse through the first
-    for i in range(len1):
- 
-        # Check if there is any matches
-        for j in range(max(0, i - max_dist),
-                       min(len2, i + max_dist + 1)):
-             
-            # If there is a match
-            if (s1[i] == s2[j] and hash_s2[j] == 0):
-                hash_s1[i] = 1
-                hash_s2[j] = 1
-                match += 1
-                break
- 
-    # If there is no match
-    if (match == 0):
-        return 0.0
- 
-    # Number of transpositions
-    t = 0
-    point = 0
- 
-    # Count number of occurrences
-    # where two characters match but
-    # there is a third matched character
-    # in between the indices
-    for i in range(len1):
-        if (hash_s1[i]):
- 
-            # Find the next matched character
-            # in second
-            while (hash_s2[point] == 0):
-                point += 1
- 
-            if (s1[i] != s2[point]):
-                point += 1
-                t += 1
-    t = t//2
- 
-    # Return the Jaro Similarity
-    return (match/ len1 + match / len2 +
-            (match - t + 1) / match)/ 3.0
+    # character set masks of the gene list are built once, see similarity.py
+    return get_similarity_index(gene_name_list).jaccard(candidate_entity, score_cutoff)
 
 def get_jaro(candidate_entity,gene_name_list,score_cutoff):
+    # entries that can not beat score_cutoff are skipped, see similarity.py
+    return get_similarity_index(gene_name_list).jaro(candidate_entity, score_cutoff)
 
-    results = []
-    for gene_name in gene_name_list:
-        jd = jaro_distance(candidate_entity,gene_name)
-        if jd > score_cutoff:
-            results.append([gene_name,jd])
 
-    return results
+def select_text_boxes(current_element_instances):
+    return current_element_instances[current_element_instances['score'] > 0.9]
 
 
-def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,image_name,relation_body_instances,img_id,current_element_instances):
+def get_ocr(figure,article_gene_list,gene_name_list,data_folder,image_name,relation_body_instances,img_id,current_element_instances,recognized=None,
+            result_store=None,outputs=None):
 
     '''
 
     Detect text from element predictions
 
     Args:
-        current_image_file: filepath of image being processed
+        figure: FigureContext of image being processed
         article_gene_list: gene list from current image's article from pubtator
         gene_name_list: list of genes from general gene dictionary
         data_folder: folder to save results to
         image_name: name of image being processed
         relation_body_instances: arrow and t-bar body instances of current image
         img_id: image id of current image being processed
+        recognized: (texts, boxes) of this image from recognize_figures, recognized here if None
+        result_store: ResultStore the genes are appended to, a gene_name json file is written if None
+        outputs: list the path of the written results is appended to
         
     
     Return:
-        (pd.DataFrame) relation_body_instances: contains all detected element (ex. text) and arrow/t-bar body instances
+        (FigureTable) figure_table: contains all detected element (ex. text) and arrow/t-bar body instances
 
     '''
 
@@ -352,11 +295,10 @@ def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,imag
     box_res = {}
     # box_res['box'] = current_element_instances['bbox']#[round(x) for x in current_element_instances['bbox'][:]]  # round() 向上取整
     # print('box:\n', current_element_instances)
-    current_element_instances = current_element_instances[current_element_instances['score'] > 0.9]
+    current_element_instances = select_text_boxes(current_element_instances)
     box_res['box'] = current_element_instances['bbox']
     # print('box:\n', current_element_instances)
-    ocr_results, coordinates_list = mmocr_without_det(img=current_image_file, element_bbox=box_res['box'], output='my_visualize_result/' +
-                                                      current_image_file.split('/')[-1])
+    ocr_results, coordinates_list = mmocr_without_det(img=figure.image, element_bbox=box_res['box'], recognized=recognized)
     ocr_results = ocr_results[0]
 
 
@@ -368,20 +310,25 @@ def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,imag
 
 
     postprocessing_ocr_results = []
-    f = open('exHUGO_latest.json')
-    hugo_dict = json.load(f)
-    for idx, ocr_sample in enumerate(ocr_results):
-        corrected_sample = corrected_processing_by_dict(hugo_dict,ocr_sample)
-        # postprocessing_ocr_results[idx] = corrected_sample
-        postprocessing_ocr_results.append(corrected_sample)
+    hugo_index = get_hugo_index()
+    metrics.count('text_boxes', len(ocr_results))
+    with metrics.timer('dictionary_correction'):
+        for idx, ocr_sample in enumerate(ocr_results):
+            corrected_sample = corrected_processing_by_dict(hugo_index,ocr_sample)
+            # postprocessing_ocr_results[idx] = corrected_sample
+            postprocessing_ocr_results.append(corrected_sample)
     # print('postprocessing_ocr_results:', postprocessing_ocr_results)
 
+    # a figure without any dictionary gene counts as failed
+    get_visualization_policy().render(image_name, show_recognition_result, figure.image, ocr_results, coordinates_list,
+                                      'my_visualize_result/' + figure.file_name.split('/')[-1],
+                                      failed=all(gene == '-' for gene in postprocessing_ocr_results))
+
 
 
     # save results to json file
     # TODO:: this only saves the gene results
-    current_img = cv2.imread(current_image_file)
-    current_height, current_width, _ = current_img.shape
+    current_height, current_width = figure.shape
     json_dicts = []
     img_size = {}
     img_size['image_size'] = [current_height, current_width]
@@ -402,72 +349,45 @@ def get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,imag
         # add ocr results to dataframe of element prediction results
         json_dicts.append(json_dict)
 
-    gene_path = data_folder + 'gene_name/'
+    if result_store is not None:
+        elements = pd.DataFrame(json_dicts[1:], columns=['gene_name', 'post_gene_name', 'coordinates'])
+        elements['image_id'], elements['file_name'] = img_id, figure.file_name
+        elements['height'], elements['width'] = current_height, current_width
+        output_file = result_store.append('elements', elements)
+    else:
+        gene_path = data_folder + 'gene_name/'
 
-    if not os.path.exists(gene_path):
-        os.makedirs(gene_path)
-    with open(gene_path + '{:s}_elements.json'.format(image_name), 'w+', encoding='utf-8') as file:
-        json.dump(json_dicts, file)
+        os.makedirs(gene_path, exist_ok=True)
+        output_file = gene_path + '{:s}_elements.json'.format(image_name)
+        with open(output_file, 'w+', encoding='utf-8') as file:
+            json.dump(json_dicts, file)
+    if outputs is not None:
+        outputs.append(output_file)
 
-    # reorganize ocr result into coco json format for further use
-    # TODO:: change coordinates to be true mins and maxes
-    ocr_prediction_results = []
+    # combine gene ocr results and relation body instances into one figure table, genes first
+    genes = []
     for k in range(0, len(postprocessing_ocr_results)):
-        x1 = coordinates_list[k][0][0]
-        y1 = coordinates_list[k][0][1]
-        x2 = coordinates_list[k][1][0]
-        y2 = coordinates_list[k][1][1]
-        result = {
-            "image_id": img_id,
-            "file_name": current_image_file,
-            "category_id": 1,
-            "normalized_bbox": [[x1,y1],[x2,y1],[x2,y2],[x1,y2]],
-            "bbox":
-                BoxMode.convert(np.array([coordinates_list[k][0], coordinates_list[k][1]]).reshape((-1, 4)),
-                                BoxMode.XYXY_ABS, BoxMode.XYWH_ABS).tolist()[0],
-            "score": float(1),
-            "ocr": postprocessing_ocr_results[k]
-        }
-        ocr_prediction_results.append(result)
+        bbox = BoxMode.convert(np.array([coordinates_list[k][0], coordinates_list[k][1]]).reshape((-1, 4)),
+                               BoxMode.XYXY_ABS, BoxMode.XYWH_ABS).tolist()[0]
+        genes.append((bbox, postprocessing_ocr_results[k]))
 
     # del ocr_results, coordinates_list, json_dicts, postprocessing_ocr_results
     del coordinates_list, json_dicts, postprocessing_ocr_results
 
-    # combine ocr gene results and relation head results
-    ocr_instances = pd.DataFrame(ocr_prediction_results)
-
-    # uncomment if only want genes
-    # remove zero index and subtract one, since ocr_prediction_results does not save first pred
-    # not_gene_idxs.remove(0)
-    # not_gene_idxs = [x-1 for x in not_gene_idxs]
-    # ocr_instances = ocr_instances.drop(labels=not_gene_idxs,axis=0)
-
-    # combine gene ocr and relation instances into 1 dataframe
-    relation_body_instances = pd.concat([ocr_instances, relation_body_instances], ignore_index=True)
-
-    # prepare df for building relationships
-    relation_body_instances['normalized_bbox'] = None
-    relation_body_instances['center'] = None
-    relation_body_instances['startor'] = None
-    relation_body_instances['receptor'] = None
-    relation_body_instances['startor_bbox'] = None
-    relation_body_instances['receptor_bbox'] = None
-    relation_body_instances["relation_category"] = None
+    return FigureTable.from_instances(figure.file_name, img_id, genes, relation_body_instances)
 
-    return relation_body_instances
-
-def get_relationship_head(processed_el_body_instances,current_relation_head_instances):
+def get_relationship_head(figure_table,current_relation_head_instances):
 
     '''
 
     For each arrow/t-bar body find corresponding head via largest IOU
 
     Args:
-        processed_el_body_instances: element and arrow/t-bar body instances
+        figure_table: FigureTable of element and arrow/t-bar body instances
         current_relation_head_instances: arrow/t-bar head instances
         
     Return:
-        (pd.DataFrame) processed_el_body_instances: processed_el_body_instances with detected relationship heads
+        (FigureTable) figure_table: figure_table with detected relationship heads
 
     '''
 
@@ -475,300 +395,124 @@ def get_relationship_head(processed_el_body_instances,current_relation_head_inst
     relation_head_bboxes = current_relation_head_instances['bbox'].tolist()
 
     # get relation body bbox
-    current_relation_body_instances = processed_el_body_instances[(processed_el_body_instances['category_id'] != 1)]
-    relation_body_bboxes = current_relation_body_instances['bbox'].tolist()
+    relation_rows = figure_table.relation_rows
+    relation_body_bboxes = figure_table.bbox[relation_rows].tolist()
     
-    # head can be none for a relation body if no indicator is inside of it
-    for i in range(0,len(relation_body_bboxes)):
-        iou=0
-        for j in range(0,len(relation_head_bboxes)):
-            temp_iou,center = compute_iou(relation_head_bboxes[j],relation_body_bboxes[i],True)
-            if temp_iou>iou:
-                iou = temp_iou
-                # relation_body_instance.index slice maintains the row indexing from processed_el_body_instance: this may throw a warning, but it is working as intended
-                processed_el_body_instances['head'][current_relation_body_instances.index[i]] = center
+    # head stays NaN for a relation body if no indicator is inside of it
+    relation_heads = assign_relation_heads(relation_body_bboxes, relation_head_bboxes)
+    found = np.array([center is not None for center in relation_heads], dtype=bool)
+    if found.any():
+        figure_table.head[relation_rows[found]] = [center for center in relation_heads if center is not None]
 
-    return processed_el_body_instances
+    return figure_table
 
-def get_relationship_tail(current_image_file,processed_el_body_instances):
+def get_relationship_tail(figure,figure_table):
 
     '''
 
-    Find each relation body's corresponding tail by choosing the detected corner furthest away from head in subimage as tail
+    Find each relation body's corresponding tail by choosing the detected corner (or skeleton end, as cfg.tail_mode
+    selects) furthest away from head in subimage as tail
 
     Args:
-        current_image_file: filepath of image being processed
-        processed_el_body_instances: element and arrow/t-bar body instances
+        figure: FigureContext of image being processed
+        figure_table: FigureTable of element and arrow/t-bar body instances
         
     Return:
-        (pd.DataFrame) processed_el_body_instances: processed_el_body_instances with detected relationship tails
+        (FigureTable) figure_table: figure_table with detected relationship tails
 
     '''
 
-    # get relation body bbox
-    current_relation_body_instances = processed_el_body_instances[(processed_el_body_instances['category_id'] != 1)]
-    relation_body_bboxes = current_relation_body_instances['bbox'].tolist()
-
-    img = cv2.imread(current_image_file)
-    for i in range(0, len(relation_body_bboxes)):
-        bbox = relation_body_bboxes[i]
-        dis_max = 0
-        crop_img = img[int(bbox[1]):int(bbox[1] + bbox[3]), int(bbox[0]):int(bbox[0] + bbox[2])]
-        if crop_img is not None:
-
-            gray = cv2.cvtColor(crop_img, cv2.COLOR_BGR2GRAY)
-            corners = cv2.goodFeaturesToTrack(gray, 20, 0.06, 10)
-
-            if type(corners) is not 'NoneType':
-
-                corners = np.int0(corners)
-
-                tail = []
-                for j in corners:
-                    x, y = j.ravel()
-                    cv2.circle(crop_img, (x, y), 3, 255, -1)
-                    raw_x = x + bbox[0]
-                    raw_y = y + bbox[1]
-
-                    # TODO:: this try can be moved out, only needs to be run once every i loop
-                    try:
-                        head_x = processed_el_body_instances['head'][current_relation_body_instances.index[i]][
-                            0]
-                        head_y = processed_el_body_instances['head'][current_relation_body_instances.index[i]][
-                            1]
-                    except:
-                        continue
-                    dis = np.sqrt((raw_x - head_x) ** 2 + (raw_y - head_y) ** 2)
-                    if dis > dis_max:
-                        dis_max = dis
-                        tail = [raw_x, raw_y]
-
-                # current_relation_body_instances.index slice maintains the row indexing from processed_el_body_instances: this may throw a warning, but it is working as intended
-                processed_el_body_instances['tail'][current_relation_body_instances.index[i]] = tail
-                del tail
-            else:
-                # TODO:: handle this case better
-                # if no corners found, set tail to top left corner
-                processed_el_body_instances['tail'][current_relation_body_instances.index[i]] = [0, 0]
-
-    return processed_el_body_instances
-
-def get_receptor(relation_heads,current_relation_body_instances,gene_centers,processed_el_body_instances,processed_genes):
+    # all bodies at once on the shared grayscale figure, a body without head or corners keeps a NaN tail
+    # and is dropped by filter_heads_and_tails
+    rows = figure_table.relation_rows
+    figure_table.tail[rows] = find_relation_tails(figure.gray, figure_table.bbox[rows], figure_table.head[rows],
+                                                  mode=cfg.tail_mode)
+
+    return figure_table
+
+def get_receptor(figure_table,gene_index):
 
     '''
 
     Find each relation body's corresponding receptor by finding the closest gene
 
     Args:
-        relation_heads: relationship head centers
-        current_relation_body_instances: arrow/t-bar body instances
-        gene_centers: center points of detected genes
-        processed_el_body_instances: element and arrow/t-bar body instances
-        processed_genes: element instances
+        figure_table: FigureTable of element and arrow/t-bar body instances, with gene centers
+        gene_index: GeneCenterIndex over the gene centers of figure_table, in gene row order
         
     Return:
-        (pd.DataFrame) processed_el_body_instances: processed_el_body_instances with detected gene receptors for each relationship
-        (List) min_js: indices of detected receptors for each relationship
+        (List) min_js: indices into the genes of detected receptors for each relationship, None if no gene is close
 
     '''
 
+    gene_rows = figure_table.gene_rows
     min_js = []
 
-    # print(len(relation_heads))
-
     # get relation body receptor
-    for i in range(0,len(relation_heads)):
-
-        dis_head = 500
-        min_j = None
-        min_dash = None
-        min_dash_dist = 500
-        min_entity = None
-        min_entity_dist = 500
-        for j in range(0,len(gene_centers)):
-            if gene_centers[j]!=None and gene_centers[j]!=[]:
-                dis = compute_dis(relation_heads[i],gene_centers[j])
-                if dis<dis_head:
-                    if processed_el_body_instances['ocr'][processed_genes.index[j]] == '-':
-                        if dis < min_dash_dist:
-                            min_dash_dist = dis
-                            min_dash = j
-                    else:
-                        if dis < min_entity_dist:
-                            min_entity_dist = dis
-                            min_entity = j
-        
-        if min_entity is not None and min_dash is not None:
-            entity_dis = compute_dis(relation_heads[i],gene_centers[min_entity])
-            dash_dis = compute_dis(relation_heads[i],gene_centers[min_dash])
-            dash_entity_dis = compute_dis(gene_centers[min_entity],gene_centers[min_dash])
-
-            # do this compare to check if they are apart of same cluster
-            if dash_entity_dis > 75:
-                if entity_dis > dash_dis:
-                    min_j = min_dash
-                else:
-                    min_j = min_entity
-            else:
-                if min_entity is not None:
-                    min_j = min_entity
-                else:
-                    min_j = min_dash
+    # closest named gene or dash within 500 px, dashes within 75 px of a named gene belong to its cluster
+    for row in figure_table.relation_rows:
 
-        else:
-            if min_entity is not None:
-                min_j = min_entity
-            else:
-                min_j = min_dash
+        min_j = gene_index.closest_gene(figure_table.head[row].astype(np.float64))
 
         min_js.append(min_j)
-        try:
-            ocr = processed_el_body_instances['ocr'][processed_genes.index[min_j]]
-            processed_el_body_instances['receptor'][current_relation_body_instances.index[i]] = ocr
-            processed_el_body_instances['receptor_bbox'][current_relation_body_instances.index[i]] = processed_el_body_instances['normalized_bbox'][processed_genes.index[min_j]]
-
-        except:
-            print(min_j)
-            print(processed_genes.index[min_j])
+        if min_j is not None:
+            figure_table.receptor[row] = gene_rows[min_j]
 
-    return processed_el_body_instances, min_js
+    return min_js
 
-def get_startor(relation_tails,current_relation_body_instances,gene_centers,processed_el_body_instances,processed_genes,min_js):
+def get_startor(figure_table,gene_index,min_js):
 
     '''
 
     Find each relation body's corresponding startor by finding the closest gene (no direct repeats)
 
     Args:
-        relation_tails: relationship tails centers
-        current_relation_body_instances: arrow/t-bar body instances
-        gene_centers: center points of detected genes
-        processed_el_body_instances: element and arrow/t-bar body instances
-        processed_genes: element instances
+        figure_table: FigureTable of element and arrow/t-bar body instances, with gene centers
+        gene_index: GeneCenterIndex over the gene centers of figure_table, in gene row order
         min_js: indices of detected receptors for each relationship
         
     Return:
-        (pd.DataFrame) processed_el_body_instances: processed_el_body_instances with detected gene receptors for each relationship
-        
+        (FigureTable) figure_table: figure_table with detected gene startors, and receptors swapped where the tail is closer to them
+
     '''
 
-    # print(len(relation_tails))
+    gene_rows = figure_table.gene_rows
 
     # get relation body starter
-    for i in range(0,len(relation_tails)):
-
-        min_j = min_js[i]
-
-        closes_entity = None
-        dis_tail = 500
-        min_dash = None
-        min_dash_dist = 500
-        min_entity = None
-        min_entity_dist = 500
-        for j in range(0,len(gene_centers)):
-
-            # startor can't be the receptor
-            if j == min_j:
-                continue
-
-            if gene_centers[j]!=None and gene_centers[j]!=[]:
-                dis = compute_dis(relation_tails[i],gene_centers[j])
-                if dis<dis_tail:
-                    if processed_el_body_instances['ocr'][processed_genes.index[j]] == '-':
-                        if dis < min_dash_dist:
-                            min_dash_dist = dis
-                            min_dash = j
-                    else:
-                        if dis < min_entity_dist:
-                            min_entity_dist = dis
-                            min_entity = j
-
-        if min_entity is not None and min_dash is not None:
-            entity_dis = compute_dis(relation_tails[i],gene_centers[min_entity])
-            dash_dis = compute_dis(relation_tails[i],gene_centers[min_dash])
-            dash_entity_dis = compute_dis(gene_centers[min_entity],gene_centers[min_dash])
-
-            # do this compare to check if they are apart of same cluster
-            if dash_entity_dis > 75:
-                if entity_dis > dash_dis:
-                    closes_entity = min_dash
-                else:
-                    closes_entity = min_entity
-
-            else:
-                if min_entity is not None:
-                    closes_entity = min_entity
-                else:
-                    closes_entity = min_dash
-
-        else:
-
-            if min_entity is not None:
-                closes_entity = min_entity
-            else:
-                closes_entity = min_dash
+    for row, min_j in zip(figure_table.relation_rows, min_js):
 
-        try:
-
-            tail_to_receptor = compute_dis(gene_centers[min_j],relation_tails[i])
-            tail_to_closest_non_receptor = compute_dis(gene_centers[closes_entity],relation_tails[i])
-
-            if tail_to_receptor < tail_to_closest_non_receptor:
-                ocr = processed_el_body_instances['ocr'][processed_genes.index[closes_entity]]
-                processed_el_body_instances['receptor'][current_relation_body_instances.index[i]] = ocr
-                processed_el_body_instances['receptor_bbox'][current_relation_body_instances.index[i]] = processed_el_body_instances['normalized_bbox'][processed_genes.index[closes_entity]]
-
-                ocr = processed_el_body_instances['ocr'][processed_genes.index[min_j]]
-                processed_el_body_instances['startor'][current_relation_body_instances.index[i]] = ocr
-                processed_el_body_instances['startor_bbox'][current_relation_body_instances.index[i]] = processed_el_body_instances['normalized_bbox'][processed_genes.index[min_j]]
-            else:
-                ocr = processed_el_body_instances['ocr'][processed_genes.index[closes_entity]]
-                processed_el_body_instances['startor'][current_relation_body_instances.index[i]] = ocr
-                processed_el_body_instances['startor_bbox'][current_relation_body_instances.index[i]] = processed_el_body_instances['normalized_bbox'][processed_genes.index[closes_entity]]
+        tail = figure_table.tail[row].astype(np.float64)
 
+        # startor can't be the receptor
+        closes_entity = gene_index.closest_gene(tail, exclude=min_j)
+        if min_j is None or closes_entity is None:
+            continue
 
-        except:
-            print(closes_entity)
-            print(min_dash)
-            print(min_entity)
-            print(processed_genes.index[closes_entity])
-            print(processed_el_body_instances['receptor'][current_relation_body_instances.index[i]])
+        tail_to_receptor = compute_dis(gene_index.gene_centers[min_j],tail)
+        tail_to_closest_non_receptor = compute_dis(gene_index.gene_centers[closes_entity],tail)
 
-    return processed_el_body_instances
+        if tail_to_receptor < tail_to_closest_non_receptor:
+            figure_table.receptor[row] = gene_rows[closes_entity]
+            figure_table.startor[row] = gene_rows[min_j]
+        else:
+            figure_table.startor[row] = gene_rows[closes_entity]
 
-def save_visual(current_image_file, processed_el_body_instance,visuals_folder, image_name, ext):
+    return figure_table
 
-    img = cv2.imread(current_image_file)
-    height, width, _ = img.shape
-    image_size = (height,width)
+def save_visual(figure, figure_table,visuals_folder, image_name, ext):
 
     # visualize normalized bboxes to confirm detection results and save
-    img_copy = img.copy()
-    for element_idx in range(0, len(processed_el_body_instance)):
-        if processed_el_body_instance.iloc[element_idx]['category_id'] == 0:
-            if processed_el_body_instance.iloc[element_idx]['score'] >= cfg.element_threshold:
-                cv2.polylines(img_copy, [normalize_rect_vertex(processed_el_body_instance.iloc[element_idx]['bbox'], image_size)],
-                                isClosed=True, color=(255, 0, 0), thickness=2)
-        elif processed_el_body_instance.iloc[element_idx]['category_id'] == 1:
-            if processed_el_body_instance.iloc[element_idx]['score'] >= cfg.element_threshold:
-                cv2.polylines(img_copy, [normalize_rect_vertex(processed_el_body_instance.iloc[element_idx]['bbox'], image_size)],
-                                isClosed=True, color=(0, 255, 0), thickness=2)
-        elif processed_el_body_instance.iloc[element_idx]['category_id'] == 2:
-            if processed_el_body_instance.iloc[element_idx]['score'] >= cfg.element_threshold:
-                cv2.polylines(img_copy, [normalize_rect_vertex(processed_el_body_instance.iloc[element_idx]['bbox'], image_size)],
-                                isClosed=True, color=(0, 0, 255), thickness=2)
-    for i in range(0, len(processed_el_body_instance[processed_el_body_instance['category_id'] != 1])):
-        head = processed_el_body_instance[processed_el_body_instance['category_id'] != 1]['head']
-        element_head = head.tolist()
-        tail = processed_el_body_instance[processed_el_body_instance['category_id'] != 1]['tail']
-        element_tail = tail.tolist()
-
-        if element_head[i] != None and element_head[i] != [] and element_tail[i] != None and element_tail[
-            i] != []:
-            x_head = int(element_head[i][0])
-            y_head = int(element_head[i][1])
-            x_tail = int(element_tail[i][0])
-            y_tail = int(element_tail[i][1])
+    img_copy = figure.image.copy()
+    colors = {0: (255, 0, 0), 1: (0, 255, 0), 2: (0, 0, 255)}
+    for row in range(0, len(figure_table)):
+        category = int(figure_table.category_id[row])
+        if category in colors and figure_table.score[row] >= cfg.element_threshold:
+            cv2.polylines(img_copy, [figure_table.normalized_bbox[row]],
+                            isClosed=True, color=colors[category], thickness=2)
+    for row in figure_table.relation_rows:
+        if not (np.isnan(figure_table.head[row]).any() or np.isnan(figure_table.tail[row]).any()):
+            x_head, y_head = figure_table.head[row].astype(int).tolist()
+            x_tail, y_tail = figure_table.tail[row].astype(int).tolist()
 
             cv2.circle(img_copy, (x_head, y_head), 6, (128, 0, 128), -1)
             cv2.circle(img_copy, (x_tail, y_tail), 6, (0, 255, 255), -1)
@@ -776,59 +520,37 @@ def save_visual(current_image_file, processed_el_body_instance,visuals_folder, i
     cv2.imwrite(os.path.join(visuals_folder, image_name + ext), img_copy)
     del img_copy
 
-def get_startors_and_receptors(current_image_file,processed_el_body_instances):
+def get_startors_and_receptors(figure,figure_table):
 
     '''
 
     Find each relation body's corresponding receptor and starter
 
     Args:
-        current_image_file: filepath of image being processed
-        processed_el_body_instances: element and arrow/t-bar body instances
+        figure: FigureContext of image being processed
+        figure_table: FigureTable of element and arrow/t-bar body instances
         
     Return:
-        (pd.DataFrame) processed_el_body_instances: processed_el_body_instances with detected gene starters and receptors for each relationship
+        (FigureTable) figure_table: figure_table with detected gene starters and receptors for each relationship
 
     '''
 
     # normalize coords for pairing
-    img = cv2.imread(current_image_file)
-    height, width, _ = img.shape
-    normalize_all_boxes(processed_el_body_instances, (height, width))
-
-    # get current genes' center bboxes
-    gene_dic = processed_el_body_instances[(processed_el_body_instances['category_id'] == 1)]
-    gene_list = gene_dic['bbox'].tolist()
-    for i in range(0, len(gene_list)):
-        # gene_list bbox values are XYWH
-        center = [int(gene_list[i][0] + gene_list[i][2] / 2), int(gene_list[i][1] + gene_list[i][3] / 2)]
-        # gene_dic.index slice maintains the row indexing from element_instances: this may throw a warning, but it is working as intended
-        processed_el_body_instances['center'][gene_dic.index[i]] = center
-    processed_genes = processed_el_body_instances[processed_el_body_instances['category_id'] == 1]
-    gene_centers = processed_genes['center'].tolist()
-
-    # get relation body instances and their head & tail bboxes
-    current_relation_body_instances = processed_el_body_instances[processed_el_body_instances['category_id'] != 1]
-    relation_heads = current_relation_body_instances['head'].tolist()
-    relation_tails = current_relation_body_instances['tail'].tolist()
+    figure_table.normalize_boxes(figure.shape)
+
+    # get current genes' center bboxes, bbox values are XYWH
+    gene_rows = figure_table.gene_rows
+    gene_bboxes = figure_table.bbox[gene_rows].astype(np.float64)
+    figure_table.center[gene_rows] = np.trunc(gene_bboxes[:, :2] + gene_bboxes[:, 2:] / 2)
+    gene_centers = list(figure_table.center[gene_rows].astype(np.float64))
 
     # get startors and receptors
     # TODO:: for given pair, double check startor and receptor selection minimizes total combo distancez
-    processed_el_body_instances, min_js = get_receptor(relation_heads,current_relation_body_instances,gene_centers,processed_el_body_instances,processed_genes)
-    processed_el_body_instances = get_startor(relation_tails,current_relation_body_instances,gene_centers,processed_el_body_instances,processed_genes,min_js)
-
-    relation_list = []
-    for index in processed_el_body_instances.index:
-        if processed_el_body_instances.loc[index]['category_id'] == 0:
-            # processed_el_body_instances.loc[index]['relation_category'] = 'activate_relation'
-            relation_list.append('activate_relation')
-        if processed_el_body_instances.loc[index]['category_id'] == 2:
-            relation_list.append('inhibit_relation')
-            # processed_el_body_instances.loc[index]['relation_category'] = 'inhibit_relation'
-        if processed_el_body_instances.loc[index]['category_id'] == 1:
-            relation_list.append('None')
-    processed_el_body_instances['relation_category'] = relation_list
-    return processed_el_body_instances
+    gene_index = GeneCenterIndex(gene_centers, figure_table.ocr[gene_rows].tolist())
+    min_js = get_receptor(figure_table, gene_index)
+    figure_table = get_startor(figure_table, gene_index, min_js)
+
+    return figure_table
 
 def score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances):
 
@@ -837,7 +559,7 @@ def score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances):
     rank each relationship by how often their gene's co_occur the figure's article
 
     Args:
-        gene_co_occurrence: current article's co-occurring genes by sentence
+        gene_co_occurrence: CooccurrenceIndex of the current article (get_cooccurrence_index), or its co-occurring genes by sentence
         processed_el_body_instances: element and arrow/t-bar body instances
         
     Return:
@@ -845,66 +567,244 @@ def score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances):
 
     '''
 
-    # TODO:: make this faster
-    # set coocurrence score and relation category
-    processed_el_body_instances['rank'] = 0
-    r_body_instances = processed_el_body_instances[processed_el_body_instances['category_id'] != 1]
-    for i, r_body_instance in r_body_instances.iterrows():
+    # set coocurrence score and relation category, one pair lookup per relationship
+    return score_relations(gene_co_occurrence, processed_el_body_instances)
 
-        for j, row in gene_co_occurrence.iterrows():
-            if r_body_instance['startor'] == row['gene_name_1'] and r_body_instance['receptor'] == row['gene_name_2']:
-                processed_el_body_instances['rank'][i] = row['co_occurrence']
-                break
-            elif r_body_instance['receptor'] == row['gene_name_1'] and r_body_instance['startor'] == row['gene_name_2']:
-                processed_el_body_instances['rank'][i] = row['co_occurrence']
-                break
+def filter_heads_and_tails(figure_table):
 
-        if r_body_instance['category_id']==0:
-            processed_el_body_instances['relation_category'][i] = 'activate_relation'
-        if r_body_instance['category_id']==2:
-            processed_el_body_instances['relation_category'][i] = 'inhibit_relation'
+    '''
 
-    return processed_el_body_instances
+    remove relationships that have no head or tail detected
 
-def filter_heads_and_tails(processed_el_body_instances):
+    Args:
+        figure_table: FigureTable of element and arrow/t-bar body instances
+        
+    Return:
+        (FigureTable) figure_table: figure_table with bad relationships removed
 
     '''
 
-    remove relationships that have no head or tail detected
+    # if no head or tail, then don't want to save this relationship
+    is_gene = figure_table.category_id == 1
+    has_head = ~np.isnan(figure_table.head).any(axis=1)
+    has_tail = ~np.isnan(figure_table.tail).any(axis=1)
+
+    return figure_table.select(is_gene | (has_head & has_tail))
+
+def get_stage_fingerprints(cfg):
+    '''
+
+    Return:
+        (dict) what the detection, OCR and pairing results of a figure depend on, for the RunManifest
+
+    '''
+    return {
+        'detection': [file_stamp(cfg.element_model), file_stamp(cfg.relation_model), file_stamp(cfg.element_config_file),
+                      file_stamp(cfg.relation_config_file), cfg.element_threshold, cfg.relation_threshold,
+                      code_fingerprint(reorganize_outputs)],
+        # the recognition batch size changes the padding of the crops, so it can change the recognized text
+        'ocr': [file_stamp(cfg.hugo_dictionary_path), cfg.verify_dictionary_index, cfg.correction_cache,
+                cfg.mmocr_recog_batch_size,
+                code_fingerprint(select_text_boxes, get_ocr, new_mmocr, corrected_ocr, gene_dictionary, correction_cache)],
+        'pairing': [cfg.tail_mode, code_fingerprint(get_relationship_head, get_relationship_tail, filter_heads_and_tails,
+                                                    get_startors_and_receptors, get_receptor, get_startor, relation_geometry,
+                                                    FigureTable)],
+    }
+
+
+@torch.no_grad()
+def detect_figures(inputs, detector, ocr_session, run_manifest=None):
+    '''
+
+    Detection stage: run both models on one loader batch and recognize the text boxes of its figures
 
     Args:
-        processed_el_body_instances: element and arrow/t-bar body instances
-        
+        inputs: one batch of the data loader
+        detector: DualDetector of the element and relation body models
+        ocr_session: RecognizerSession of the text recognizer
+        run_manifest: RunManifest, figures with current detections or OCR are not run again
+
     Return:
-        (pd.DataFrame) processed_el_body_instances: processed_el_body_instances with bad relationships removed
+        (list) work dict per figure of the batch with genes, in batch order
 
     '''
 
-    current_relation_body_instances = processed_el_body_instances[processed_el_body_instances['category_id'] != 1]
-    relation_heads = current_relation_body_instances['head'].tolist()
-    relation_tails = current_relation_body_instances['tail'].tolist()
-    rows_to_remove = []
+    # element, relation head and relation body instances per figure, from the run cache if current
+    detections = {}
+    for x in inputs:
+        cached = run_manifest.load_checkpoint(x['file_name'], 'detection') if run_manifest else None
+        if cached is not None:
+            # image ids follow the folder listing, they may have moved since
+            detections[x['file_name']] = tuple(instances.assign(image_id=x['image_id']) for instances in cached)
+    to_detect = [x for x in inputs if x['file_name'] not in detections]
+
+    if to_detect:
+        # run inference, one shared backbone forward or both models at once, as cfg.detection_mode selects
+        with metrics.timer('detection'):
+            el_output, body_output = detector(to_detect)
+        metrics.count('figures_detected', len(to_detect))
+
+        # reorganize model outputs into dataframes by category
+        element_instances, relation_head_instances, relation_body_instances = reorganize_outputs(el_output,body_output,to_detect,cfg)
+        for x in to_detect:
+            detections[x['file_name']] = tuple(instances[instances['file_name'] == x['file_name']]
+                                               for instances in (element_instances, relation_head_instances, relation_body_instances))
+            if run_manifest:
+                run_manifest.save_checkpoint(x['file_name'], 'detection', detections[x['file_name']])
+
+    # in batch order, figures without any gene are skipped
+    file_list = []
+    for x in inputs:
+        if len(detections[x['file_name']][0]) > 0:
+            file_list.append(x['file_name'])
+        elif run_manifest:
+            run_manifest.finish(x['file_name'], [])
+
+    # decode every image of the batch once, all stages share the arrays
+    figures = {}
+    for current_image_file in file_list:
+        try:
+            figures[current_image_file] = FigureContext(current_image_file)
+        except IOError as e:
+            # a header the manifest read may still not decode, lose only this figure and not the batch
+            print(str(e))
+            metrics.count('figures_undecodable')
+    file_list = [current_image_file for current_image_file in file_list if current_image_file in figures]
+
+    # cached OCR is only reused while the genes it wrote still exist
+    ocr_tables = {}
+    if run_manifest:
+        ocr_tables = {current_image_file: run_manifest.load_checkpoint(current_image_file, 'ocr', needs_outputs=True)
+                      for current_image_file in file_list}
+
+    # recognize the text boxes of all images in the batch together
+    with metrics.timer('recognition'):
+        recognized_figures = recognize_figures(
+            [(current_image_file, figure.image, select_text_boxes(detections[current_image_file][0])['bbox'])
+             for current_image_file, figure in figures.items() if ocr_tables.get(current_image_file) is None], ocr_session)
+
+    works = []
+    for current_image_file in file_list:
+        image_name, ext = os.path.splitext(os.path.basename(current_image_file))
+        # get current image's model outputs
+        current_element_instances, current_relation_head_instances, current_relation_body_instances = detections[current_image_file]
+        work = {
+            'figure': figures[current_image_file],
+            'image_name': image_name,
+            'ext': ext,
+            'relation_head_instances': current_relation_head_instances,
+        }
+        if ocr_tables.get(current_image_file) is not None:
+            work['figure_table'] = ocr_tables[current_image_file]
+            work['outputs'] = run_manifest.stage_outputs(current_image_file, 'ocr')
+        else:
+            work.update({'element_instances': current_element_instances,
+                         'relation_body_instances': current_relation_body_instances,
+                         'recognized': recognized_figures[current_image_file]})
+        works.append(work)
+    return works
 
-    # if no head or tail, then don't want to save this relationship
-    for i in range(0,len(relation_heads)):
-        if relation_heads[i] == None or relation_heads[i] == []:
-            rows_to_remove.append(current_relation_body_instances.index[i])
-        elif relation_tails[i] == None or relation_tails[i] == []:
-            rows_to_remove.append(current_relation_body_instances.index[i])
 
-    processed_el_body_instances = processed_el_body_instances.drop(labels=rows_to_remove,axis=0)
+def ocr_figure(work, article_gene_list, gene_name_list, data_folder, run_manifest=None, result_store=None):
+    '''
+
+    OCR stage: correct the recognized text and build the figure table
+
+    '''
+    figure = work['figure']
+    if 'figure_table' in work:
+        # current in the run cache, work['outputs'] are the genes it wrote
+        return work
+    print('doing ocr to file {:s}'.format(figure.file_name))
+
+    # get pubtator genes and coocurrences for corresponding article
+
+    # fix this **************************
+    # article_gene_list = article_pd.loc[(article_pd['figid'] == image_name+ext)]['gene_list'].values[0]
+
+    # current_pmcid = article_pd.loc[(article_pd['figid'] == image_name+ext)]['pmcid'].values[0]
+    # gene_co_occurrence = get_cooccurrence_index(current_pmcid)
+
+    # get ocr result
+    current_element_instances = work.pop('element_instances')
+    img_id = current_element_instances['image_id'].values[0]
+    with metrics.timer('ocr'):
+        work['figure_table'] = get_ocr(figure,article_gene_list,gene_name_list,data_folder,work['image_name'],
+                                       work.pop('relation_body_instances'),img_id,current_element_instances,
+                                       recognized=work.pop('recognized'), result_store=result_store,
+                                       outputs=work.setdefault('outputs', []))
+    if run_manifest:
+        run_manifest.save_checkpoint(figure.file_name, 'ocr', work['figure_table'], outputs=work['outputs'])
+    return work
+
+
+def pair_figure(work):
+    '''
+
+    Pairing stage: find relation heads and tails and pair them with the genes
+
+    '''
+    figure = work['figure']
+
+    with metrics.timer('pairing'):
+        # get relation head & tail
+        figure_table = get_relationship_head(work['figure_table'],work.pop('relation_head_instances'))
+        figure_table = get_relationship_tail(figure,figure_table)
+
+        # remove relationships with None head or tail
+        figure_table = filter_heads_and_tails(figure_table)
+
+        # get gene stators and receptors
+        figure_table = get_startors_and_receptors(figure,figure_table)
+
+    # score relationships
+    # processed_el_body_instances = score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances)
+
+    work['figure_table'] = figure_table
+    return work
+
+
+def write_figure(work, data_folder, visuals_folder, run_manifest=None, result_store=None):
+    '''
+
+    Writer stage: queue the visualization and save the relations of the figure
+
+    '''
+    figure, figure_table, image_name = work['figure'], work['figure_table'], work['image_name']
+    start = time.time()
+
+    # visualize elements and relationships, as cfg.visualize_mode selects
+    get_visualization_policy().render(image_name, save_visual, figure, figure_table,
+                                      visuals_folder, image_name, work['ext'],
+                                      failed=len(figure_table.relation_rows) == 0)
+
+    # save outputs, the only conversion back to a dataframe
+    results = figure_table.to_relation_frame()
+    if result_store is not None:
+        relation_file = result_store.append('relations', results.rename_axis('relation_id').reset_index())
+    else:
+        relation_path = data_folder + 'relation/'
+        if not os.path.exists(relation_path):
+            os.makedirs(relation_path)
+        relation_file = '{:s}_relation.json'.format(os.path.join(relation_path, image_name))
+        with open(relation_file, 'w') as output_fp:
+            results.to_json(output_fp, orient='index')
 
-    return processed_el_body_instances
+    if run_manifest:
+        # the relations and the genes of the OCR stage, from this run or its checkpoint
+        run_manifest.finish(figure.file_name, [relation_file] + work.get('outputs', []))
+
+    metrics.observe('writer', time.time() - start)
+    metrics.count('figures')
+    metrics.count('relations', len(figure_table.relation_rows))
 
 
 def run_model(cfg, article_pd, **kwargs):
 
     article_pd = None
     
-    # get gene dictionary
-    with open(cfg.dictionary_path) as gene_name_list_fp:
-        gene_name_list = json.load(gene_name_list_fp)
-    gene_name_list = [x.upper() for x in gene_name_list]
+    # get gene dictionary, loaded once per process
+    gene_name_list = get_gene_names()
 
 
     # load models
@@ -929,94 +829,77 @@ def run_model(cfg, article_pd, **kwargs):
         os.mkdir(visuals_folder)
 
 
-    # get data loader
-    data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False))
-
-    # set which device to run on
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
-    # set both models into eval mode and loop through data
-    with inference_context(el_model.to(device)), inference_context(body_model.to(device)), torch.no_grad():
-        for idx, inputs in enumerate(data_loader):
-
-            # run inference
-            el_output = el_model.to(device)(inputs)
-            body_output = body_model.to(device)(inputs)
-
-            # reorganize model outputs into dataframes by category
-            image_ids = inputs[0]["image_id"]
-            file_names = inputs[0]['file_name']
-            element_instances, relation_head_instances, relation_body_instances = reorganize_outputs(el_output,body_output,image_ids,file_names,cfg)
-
-            # print('element_instances:', element_instances)
-
-            # loop through each image in batch
-            file_list = set(element_instances['file_name'])
-            for current_image_file in file_list:
-                image_name, ext = os.path.splitext(os.path.basename(current_image_file))
-                print('doing ocr to file {:s}'.format(current_image_file))
-
-                # get current image's model outputs
-                current_element_instances = element_instances[(element_instances['file_name'] == current_image_file)]
-                # print(current_element_instances['bbox'][0])
-                # print('current_element_instances:', current_element_instances)
+    # figures whose outputs are current are skipped, stage results of the others are reused where current
+    run_manifest = None
+    if cfg.resume_runs:
+        run_manifest = RunManifest(data_folder, os.path.join(kwargs['dataset'], 'run_cache'), get_stage_fingerprints(cfg))
 
-                current_relation_head_instances = relation_head_instances[(relation_head_instances['file_name'] == current_image_file)]
-                current_relation_body_instances = relation_body_instances[(relation_body_instances['file_name'] == current_image_file)]
-
-                # get pubtator genes and coocurrences for corresponding article
-                
-                # fix this **************************
-                # article_gene_list = article_pd.loc[(article_pd['figid'] == image_name+ext)]['gene_list'].values[0]
-                article_gene_list = article_pd
-
-
-
-                # current_pmcid = article_pd.loc[(article_pd['figid'] == image_name+ext)]['pmcid'].values[0]
-                # gene_co_occurrence = pd.read_csv('nlp_pipeline_v2/from_PMCID_to_gene_annotation_and_cooccurrence/gene_co_occurrence/' + str(current_pmcid) + ".csv")
-
-                # get ocr result
-                img_id = current_element_instances['image_id'].values[0]
-                processed_el_body_instances = get_ocr(current_image_file,article_gene_list,gene_name_list,data_folder,image_name,current_relation_body_instances,img_id, current_element_instances)
-
-                # get relation head & tail
-                processed_el_body_instances = get_relationship_head(processed_el_body_instances,current_relation_head_instances)
-                processed_el_body_instances = get_relationship_tail(current_image_file,processed_el_body_instances)
+    # get data loader
+    data_loader = build_data_fold_loader(configuration, data_folder, mapper=DatasetMapper(configuration, False),
+                                         batch_size=cfg.detection_batch_size,
+                                         keep=lambda record: run_manifest is None or not run_manifest.is_done(record['file_name']))
 
-                # remove relationships with None head or tail
-                processed_el_body_instances = filter_heads_and_tails(processed_el_body_instances)
+    # text recognizer, loaded once for the whole run
+    ocr_session = RecognizerSession()
 
-                # get gene stators and receptors
-                processed_el_body_instances = get_startors_and_receptors(current_image_file,processed_el_body_instances)
+    # set which device to run on, both models are moved there and set into eval mode once
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    detector = DualDetector(el_model, body_model, device)
 
-                # score relationships
-                # processed_el_body_instances = score_by_cooccurrence(gene_co_occurrence,processed_el_body_instances)
+    # shared by the worker threads of the staged run, load them before it starts
+    get_hugo_index()
+    get_visualization_policy()
 
-                # visualize elements and relationships
-                save_visual(current_image_file, processed_el_body_instances,visuals_folder, image_name, ext)
-                # save_visual(current_image_file, current_element_instances,visuals_folder, image_name, ext)
+    # results go to one parquet store instead of json files per figure, as cfg.result_format selects
+    result_store = None
+    if cfg.result_format == 'parquet':
+        if parquet_available():
+            result_store = ResultStore(os.path.join(data_folder, 'results'))
+        else:
+            print('pyarrow is not installed, writing json results')
 
-                
+    detect = lambda inputs: detect_figures(inputs, detector, ocr_session, run_manifest)
+    ocr = lambda work: ocr_figure(work, article_pd, gene_name_list, data_folder, run_manifest, result_store)
+    write = lambda work: write_figure(work, data_folder, visuals_folder, run_manifest, result_store)
 
-                # save outputs
-                result = processed_el_body_instances[processed_el_body_instances['category_id'] != 1]
-                results = result[
-                    ["image_id", "file_name", "category_id", "bbox", "normalized_bbox", "startor", "startor_bbox", "relation_category",
-                    "receptor","receptor_bbox"]]
-                relation_path = data_folder + 'relation/'
-                if not os.path.exists(relation_path):
-                    os.makedirs(relation_path)
-                with open('{:s}_relation.json'.format(os.path.join(relation_path, image_name)), 'w') as output_fp:
-                    results.to_json(output_fp, orient='index')
+    if kwargs.get('profile'):
+        # the first figure alone, its detection batch included, on this thread so every stage shows up
+        first_batch = next(iter(data_loader), None)
+        if first_batch is None:
+            print('no figure to profile')
+        else:
+            profile_call(kwargs['profile'], lambda: [write(pair_figure(ocr(work))) for work in detect(first_batch[:1])])
+    elif cfg.pipeline_mode == 'staged':
+        # detection, OCR, pairing and writing overlap, bounded queues in between
+        pipeline = StagedPipeline([Stage('detection', detect, fan_out=True),
+                                   Stage('ocr', ocr, workers=cfg.pipeline_ocr_workers),
+                                   Stage('pairing', pair_figure, workers=cfg.pipeline_pairing_workers),
+                                   Stage('writer', write)])
+        pipeline.run(data_loader)
+        pipeline.report()
+    else:
+        # one figure after the other through the same stages
+        for idx, inputs in enumerate(data_loader):
+            for work in detect(inputs):
+                write(pair_figure(ocr(work)))
 
-                
+    detector.close()
+    if result_store is not None:
+        result_store.close()
+    if run_manifest:
+        run_manifest.close()
+    print('detection ({:s}): {:.1f} ms per figure'.format(detector.mode, detector.latency * 1000))
+    metrics.export()
 
-                del current_element_instances
+    # wait for queued visualizations
+    get_visualization_policy().close()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='run only the first figure and dump its cProfile stats to FILE, read them with python -m pstats FILE')
     args = parser.parse_args()
     # args.dataset = r'selective_figures_for_validation_set/img/group1'
     # args.dataset = r'NSCLC_pathway'
@@ -13,6 +13,7 @@ from detectron2.data import DatasetCatalog, MetadataCatalog
 from detectron2.data.dataset_mapper import DatasetMapper
 from detectron2.structures import Instances, RotatedBoxes,BoxMode
 from label_file import LabelFile
+from image_manifest import get_image_manifest
 from sklearn.model_selection import train_test_split
 from detectron2.utils.visualizer import Visualizer
 
@@ -22,6 +23,7 @@ from detectron2.utils.visualizer import Visualizer
 def get_rotated_annotation_dicts(json_path, img_path, category_list):
     #go through all label files
     dataset_dicts = []
+    manifest = get_image_manifest(img_path)
 
     for idx, json_file in enumerate(os.listdir(json_path)):
         if os.path.splitext(json_file)[1] != '.json':
@@ -31,9 +33,7 @@ def get_rotated_annotation_dicts(json_path, img_path, category_list):
             imgs_anns = LabelFile(os.path.join(json_path, json_file))
             #read key and value from current json file
             filename = os.path.join(img_path, imgs_anns.imagePath)
-            img = cv2.imread(filename)
-            height, width = img.shape[:2]
-            del img
+            height, width = manifest.image_size(filename)
         except Exception as e:
             #print(str(e))
             continue
@@ -89,6 +89,7 @@ def get_rotated_annotation_dicts(json_path, img_path, category_list):
 def get_regular_annotation_dicts(json_path, img_path, category_list):
     #go through all label files
     dataset_dicts = []
+    manifest = get_image_manifest(img_path)
 
     for idx, json_file in enumerate(os.listdir(json_path)):
         if os.path.splitext(json_file)[1] != '.json':
@@ -100,9 +101,7 @@ def get_regular_annotation_dicts(json_path, img_path, category_list):
             #read key and value from current json file
             filename = os.path.join(img_path, imgs_anns.imagePath)
             # print(filename)
-            img = cv2.imread(filename)
-            height, width = img.shape[:2]
-            del img
+            height, width = manifest.image_size(filename)
         except Exception as e:
             #print(str(e))
             continue
@@ -0,0 +1,306 @@
+import cv2
+import numpy as np
+import torch
+from detectron2.structures import Boxes, pairwise_iou
+from scipy.spatial import cKDTree
+from skimage.morphology import skeletonize
+
+# candidate tail points of one relation body crop, see find_relation_tails
+TAIL_MODES = ('corners', 'skeleton')
+
+
+def xywh_to_pixel_xyxy(bboxes):
+    '''
+
+    Args:
+        bboxes: list of [x, y, w, h]
+
+    Return:
+        (np.ndarray) N x 4 [xmin, ymin, xmax, ymax], truncated to whole pixels as compute_iou does
+
+    '''
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    return np.trunc(np.concatenate([bboxes[:, :2], bboxes[:, :2] + bboxes[:, 2:]], axis=1))
+
+
+def assign_relation_heads(relation_body_bboxes, relation_head_bboxes):
+    '''
+
+    Match every relation body to the head box it overlaps most, from one body x head IoU matrix
+
+    Args:
+        relation_body_bboxes: list of [x, y, w, h] of arrow/t-bar bodies
+        relation_head_bboxes: list of [x, y, w, h] of arrow/t-bar heads
+
+    Return:
+        (list) center [x, y] of the matched head per body, None for a body no head overlaps;
+        ties go to the first head, as in the pairwise compute_iou loop
+
+    '''
+    if len(relation_body_bboxes) == 0 or len(relation_head_bboxes) == 0:
+        return [None] * len(relation_body_bboxes)
+
+    body_boxes = xywh_to_pixel_xyxy(relation_body_bboxes)
+    head_boxes = xywh_to_pixel_xyxy(relation_head_bboxes)
+
+    ious = pairwise_iou(Boxes(torch.from_numpy(body_boxes)), Boxes(torch.from_numpy(head_boxes))).numpy()
+    best_heads = ious.argmax(axis=1)
+    head_centers = (head_boxes[:, :2] + head_boxes[:, 2:]) / 2
+
+    return [head_centers[head].tolist() if ious[body, head] > 0 else None
+            for body, head in enumerate(best_heads)]
+
+
+
+def body_corners(gray_crop):
+    """Strong corners of a body crop as integer (x, y), the candidates the pipeline always used."""
+    corners = cv2.goodFeaturesToTrack(gray_crop, 20, 0.06, 10)
+    if corners is None:
+        return np.zeros((0, 2), dtype=np.int64)
+    return corners.reshape(-1, 2).astype(np.int64)
+
+
+def skeleton_endpoints(gray_crop):
+    """Ends of the skeleton of the dark strokes in a body crop as (x, y), the arrow line ends."""
+    _, strokes = cv2.threshold(gray_crop, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    skeleton = skeletonize(strokes.astype(bool)).astype(np.uint8)
+
+    # an end pixel has one skeleton neighbour: itself plus one in the 3x3 sum
+    neighbours = cv2.filter2D(skeleton, -1, np.ones((3, 3), dtype=np.float32), borderType=cv2.BORDER_CONSTANT)
+    ys, xs = np.nonzero((skeleton == 1) & (neighbours == 2))
+    return np.stack([xs, ys], axis=1).astype(np.int64)
+
+
+def find_relation_tails(gray, body_bboxes, heads, mode='corners'):
+    '''
+
+    Tail of every relation body: the candidate point of its crop furthest from its head
+
+    Args:
+        gray: grayscale figure, read only
+        body_bboxes: N x 4 [x, y, w, h] of the arrow/t-bar bodies
+        heads: N x 2 head [x, y] per body, NaN for a body without head
+        mode: 'corners' (goodFeaturesToTrack corners) or 'skeleton' (end points of the skeleton)
+
+    Return:
+        (np.ndarray) N x 2 tail [x, y], NaN for a body without head or without candidate point away from it;
+        ties go to the first candidate, as in the corner loop
+
+    '''
+    if mode not in TAIL_MODES:
+        raise ValueError('unknown tail mode {!r}, expected one of {}'.format(mode, TAIL_MODES))
+    candidates_of = body_corners if mode == 'corners' else skeleton_endpoints
+
+    body_bboxes = np.asarray(body_bboxes, dtype=np.float64).reshape(-1, 4)
+    heads = np.asarray(heads, dtype=np.float64).reshape(-1, 2)
+    tails = np.full((len(body_bboxes), 2), np.nan)
+
+    # candidates of all bodies in one array, in figure coordinates, with the body they belong to
+    points, owners = [], []
+    for body, bbox in enumerate(body_bboxes.tolist()):
+        if np.isnan(heads[body]).any():
+            continue
+        crop = gray[int(bbox[1]):int(bbox[1] + bbox[3]), int(bbox[0]):int(bbox[0] + bbox[2])]
+        if crop.size == 0:
+            continue
+        candidates = candidates_of(crop)
+        points.append(candidates + np.asarray(bbox[:2]))
+        owners.append(np.full(len(candidates), body))
+    if not points:
+        return tails
+    points, owners = np.concatenate(points), np.concatenate(owners)
+
+    distances = np.hypot(points[:, 0] - heads[owners, 0], points[:, 1] - heads[owners, 1])
+    away = distances > 0
+    points, owners, distances = points[away], owners[away], distances[away]
+
+    # per body the furthest candidate, the first of equally far ones
+    order = np.lexsort((np.arange(len(owners)), -distances, owners))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = owners[order][1:] != owners[order][:-1]
+    tails[owners[order][first]] = points[order][first]
+    return tails
+
+
+def point_distance(point1, point2):
+    return np.sqrt((point2[0] - point1[0]) ** 2 + (point2[1] - point1[1]) ** 2)
+
+
+class GeneCenterIndex(object):
+    """
+    Nearest-gene lookups for the relation endpoints of one figure.
+
+    Gene centers go into two cKDTrees, one for genes whose OCR is '-' (no dictionary match) and one
+    for named genes, so each endpoint needs radius bounded k-NN queries instead of a scan over every
+    gene. Results match the scan in get_receptor / get_startor: a gene has to be closer than radius,
+    equally distant genes resolve to the first one, and a dash that is further than cluster_distance
+    from the closest named gene wins only if it is closer to the endpoint.
+    """
+
+    def __init__(self, gene_centers, gene_ocr, radius=500, cluster_distance=75):
+        self.radius = radius
+        self.cluster_distance = cluster_distance
+        self.gene_centers = gene_centers
+
+        # dash -> (tree, gene indices, centers), tree is None if there is no such gene
+        self.trees = {}
+        for dash in (True, False):
+            ids = [j for j, center in enumerate(gene_centers)
+                   if center is not None and len(center) > 0 and (gene_ocr[j] == '-') == dash]
+            points = np.asarray([gene_centers[j] for j in ids], dtype=np.float64).reshape(-1, 2)
+            self.trees[dash] = (cKDTree(points) if ids else None, ids, points)
+
+    def nearest(self, point, dash, exclude=None):
+        """
+        Index of the closest dash or named gene to point within radius, skipping gene exclude.
+        """
+        tree, ids, points = self.trees[dash]
+        if tree is None:
+            return None
+
+        # two neighbours, so one is left when the closest is the excluded gene
+        dists, rows = tree.query(point, k=min(len(ids), 2), distance_upper_bound=self.radius)
+        for dist, row in zip(np.atleast_1d(dists), np.atleast_1d(rows)):
+            # missing neighbours come back as row == len(ids)
+            if row < len(ids) and ids[row] != exclude:
+                break
+        else:
+            return None
+
+        # collect every gene at that distance, the scan kept the one with the lowest index
+        best = None
+        for row in tree.query_ball_point(point, dist * (1 + 1e-9) + 1e-9):
+            if ids[row] == exclude:
+                continue
+            row_dist = point_distance(point, points[row])
+            if row_dist < self.radius and (best is None or (row_dist, ids[row]) < best):
+                best = (row_dist, ids[row])
+        return None if best is None else best[1]
+
+    def closest_gene(self, point, exclude=None):
+        '''
+
+        Args:
+            point: relation head or tail [x, y]
+            exclude: index of a gene that can not be chosen (the receptor when looking for the startor)
+
+        Return:
+            (int) index into gene_centers of the gene the endpoint points at, None if no gene is within radius
+
+        '''
+        min_dash = self.nearest(point, True, exclude)
+        min_entity = self.nearest(point, False, exclude)
+
+        if min_entity is not None and min_dash is not None:
+            entity_dis = point_distance(point, self.gene_centers[min_entity])
+            dash_dis = point_distance(point, self.gene_centers[min_dash])
+            dash_entity_dis = point_distance(self.gene_centers[min_entity], self.gene_centers[min_dash])
+
+            # a dash next to a named gene is part of the same cluster
+            if dash_entity_dis > self.cluster_distance and entity_dis > dash_dis:
+                return min_dash
+            return min_entity
+
+        return min_entity if min_entity is not None else min_dash
+
+
+if __name__ == '__main__':
+    import time
+
+    from pipeline_hugo import compute_iou
+
+    # a dense figure: 300 arrow bodies and 300 heads
+    rng = np.random.RandomState(0)
+    bodies = np.concatenate([rng.uniform(0, 2000, (300, 2)), rng.uniform(5, 200, (300, 2))], axis=1).tolist()
+    heads = np.concatenate([rng.uniform(0, 2000, (300, 2)), rng.uniform(5, 40, (300, 2))], axis=1).tolist()
+
+    start = time.time()
+    expected = []
+    for body in bodies:
+        iou, best_center = 0, None
+        for head in heads:
+            temp_iou, center = compute_iou(head, body, True)
+            if temp_iou > iou:
+                iou, best_center = temp_iou, center
+        expected.append(best_center)
+    loop_time = time.time() - start
+
+    start = time.time()
+    assigned = assign_relation_heads(bodies, heads)
+    matrix_time = time.time() - start
+
+    assert assigned == expected
+    print('300 x 300: pairwise loop {:.1f} ms, iou matrix {:.1f} ms'.format(loop_time * 1000, matrix_time * 1000))
+
+    # gene lookups: 200 genes, a quarter of them unmatched dashes, 600 endpoints
+    from pipeline_hugo import compute_dis
+
+    centers = [[int(x), int(y)] for x, y in rng.uniform(0, 2000, (200, 2))]
+    ocr = ['-' if k % 4 == 0 else 'GENE{:d}'.format(k) for k in range(len(centers))]
+    endpoints = rng.uniform(0, 2000, (600, 2)).tolist()
+
+    def scan(point, exclude=None):
+        nearest = {True: (500, None), False: (500, None)}
+        for j, center in enumerate(centers):
+            if j == exclude:
+                continue
+            dis = compute_dis(point, center)
+            if dis < nearest[ocr[j] == '-'][0]:
+                nearest[ocr[j] == '-'] = (dis, j)
+        min_dash, min_entity = nearest[True][1], nearest[False][1]
+        if min_entity is not None and min_dash is not None:
+            if compute_dis(centers[min_entity], centers[min_dash]) > 75 and \
+                    compute_dis(point, centers[min_entity]) > compute_dis(point, centers[min_dash]):
+                return min_dash
+            return min_entity
+        return min_entity if min_entity is not None else min_dash
+
+    start = time.time()
+    expected = [(scan(point), scan(point, exclude=3)) for point in endpoints]
+    scan_time = time.time() - start
+
+    start = time.time()
+    gene_index = GeneCenterIndex(centers, ocr)
+    found = [(gene_index.closest_gene(point), gene_index.closest_gene(point, exclude=3)) for point in endpoints]
+    tree_time = time.time() - start
+
+    assert found == expected
+    print('600 endpoints x 200 genes: scan {:.1f} ms, kd-tree {:.1f} ms'.format(scan_time * 1000, tree_time * 1000))
+
+    # tails of 300 arrow bodies drawn into a 2000 x 2000 figure
+    figure = np.full((2000, 2000, 3), 255, dtype=np.uint8)
+    starts = rng.uniform(100, 1900, (300, 2))
+    ends = np.clip(starts + rng.uniform(-80, 80, (300, 2)), 0, 1999)
+    for start_point, end_point in zip(starts.astype(int).tolist(), ends.astype(int).tolist()):
+        cv2.line(figure, tuple(start_point), tuple(end_point), (0, 0, 0), 3)
+    body_bboxes = np.concatenate([np.minimum(starts, ends) - 5, np.abs(ends - starts) + 10], axis=1)
+    body_heads = ends
+
+    start = time.time()
+    img = figure.copy()
+    expected = np.full((len(body_bboxes), 2), np.nan)
+    for body, bbox in enumerate(body_bboxes.tolist()):
+        crop_img = img[int(bbox[1]):int(bbox[1] + bbox[3]), int(bbox[0]):int(bbox[0] + bbox[2])]
+        corners = cv2.goodFeaturesToTrack(cv2.cvtColor(crop_img, cv2.COLOR_BGR2GRAY), 20, 0.06, 10)
+        if corners is None:
+            continue
+        dis_max = 0
+        for x, y in corners.reshape(-1, 2).astype(np.int64).tolist():
+            cv2.circle(crop_img, (x, y), 3, 255, -1)
+            dis = np.sqrt((x + bbox[0] - body_heads[body][0]) ** 2 + (y + bbox[1] - body_heads[body][1]) ** 2)
+            if dis > dis_max:
+                dis_max = dis
+                expected[body] = [x + bbox[0], y + bbox[1]]
+    loop_time = time.time() - start
+
+    gray = cv2.cvtColor(figure, cv2.COLOR_BGR2GRAY)
+    start = time.time()
+    tails = find_relation_tails(gray, body_bboxes, body_heads)
+    vector_time = time.time() - start
+    skeleton_tails = find_relation_tails(gray, body_bboxes, body_heads, mode='skeleton')
+
+    # the loop marks corners into its copy, overlapping bodies see those marks, so a few tails may differ
+    agree = np.mean(np.all(np.isclose(tails, expected) | (np.isnan(tails) & np.isnan(expected)), axis=1))
+    print('300 arrow bodies: corner loop {:.1f} ms, one call {:.1f} ms, {:.0%} same tails, '
+          '{:d} skeleton tails'.format(loop_time * 1000, vector_time * 1000, agree,
+                                       int((~np.isnan(skeleton_tails).any(axis=1)).sum())))
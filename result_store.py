@@ -0,0 +1,282 @@
+import glob
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+
+import cfg
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# columns of the tables, the order of the parquet parts
+TABLE_COLUMNS = {
+    'relations': ['relation_id', 'image_id', 'file_name', 'category_id', 'bbox', 'normalized_bbox', 'startor',
+                  'startor_bbox', 'relation_category', 'receptor', 'receptor_bbox', 'run_id', 'sequence'],
+    'elements': ['image_id', 'file_name', 'height', 'width', 'gene_name', 'post_gene_name', 'coordinates',
+                 'run_id', 'sequence'],
+}
+
+# suffix of the per-figure json files the pipelines write without a store, read_results reads them too
+JSON_SUFFIXES = {'relations': '_relation.json', 'elements': '_elements.json'}
+
+# stores opened by this process, two runs started in the same millisecond still get their own parts
+_store_count = itertools.count()
+
+
+def parquet_available():
+    return pa is not None
+
+
+def table_schema(table):
+    """Fixed schema of every part of a table, so parts with only None in a column still read together."""
+    if table not in TABLE_COLUMNS:
+        raise ValueError('unknown result table {!r}'.format(table))
+    points = pa.list_(pa.list_(pa.int64()))
+    types = {'relation_id': pa.int64(), 'image_id': pa.int64(), 'file_name': pa.string(), 'category_id': pa.int64(),
+             'bbox': pa.list_(pa.float64()), 'normalized_bbox': points, 'startor': pa.string(), 'startor_bbox': points,
+             'relation_category': pa.string(), 'receptor': pa.string(), 'receptor_bbox': points,
+             'height': pa.int64(), 'width': pa.int64(), 'gene_name': pa.string(), 'post_gene_name': pa.string(),
+             'coordinates': pa.list_(pa.float64()), 'run_id': pa.string(), 'sequence': pa.int64()}
+    return pa.schema([(name, types[name]) for name in TABLE_COLUMNS[table]])
+
+
+def empty_results(table):
+    """Result frame of a table without rows, with the columns read_results returns."""
+    if table not in TABLE_COLUMNS:
+        raise ValueError('unknown result table {!r}'.format(table))
+    return pd.DataFrame(columns=TABLE_COLUMNS[table] + ['image_name'])
+
+
+def image_name(file_name):
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+
+def to_plain(value):
+    # numpy arrays (normalized boxes) to nested lists, pyarrow converts 1-d arrays only
+    return value.tolist() if hasattr(value, 'tolist') else value
+
+
+def run_started(run_id):
+    """Start of a run in ms from its id, runs before the ids had milliseconds are named in seconds."""
+    started = int(run_id.split('-')[0])
+    return started if started >= 10 ** 12 else started * 1000
+
+
+class ResultStore(object):
+    """
+    Append-only Parquet store of the pipeline results, one folder per table.
+
+    append queues the records of one figure and returns the part file they go to. A writer thread
+    collects the records of a part and writes it as one file of cfg.result_store_rows_per_part rows
+    or more, named after the run so earlier parts are never touched. A part is written to a hidden
+    temp file and renamed, so readers and the run manifest see it complete or not at all. Every row
+    carries the run and the sequence number of its append, read_results keeps only the newest append
+    of a figure.
+    """
+
+    def __init__(self, folder, rows_per_part=None):
+        if pa is None:
+            raise ImportError('the parquet result store needs pyarrow')
+        self.folder = folder
+        self.rows_per_part = rows_per_part or cfg.result_store_rows_per_part
+        self.run_id = '{:013d}-{:d}-{:d}'.format(int(time.time() * 1000), os.getpid(), next(_store_count))
+
+        self.lock = threading.Lock()
+        self.parts = {}  # table -> (part index, rows in the part)
+        self.sequence = 0  # appends so far
+        self.queue = queue.Queue(maxsize=cfg.result_store_queue_size)
+        self.thread = threading.Thread(target=self.write_parts, name='result-store', daemon=True)
+        self.thread.start()
+
+    def part_file(self, table, index):
+        return os.path.join(self.folder, table, 'part-{:s}-{:05d}.parquet'.format(self.run_id, index))
+
+    def append(self, table, records):
+        '''
+
+        Args:
+            table: 'relations' or 'elements'
+            records: pd.DataFrame with the columns of table_schema(table)
+
+        Return:
+            (str) part file the records will be in once it is written
+
+        '''
+        # under the lock, the records of a part are queued before the request to write it
+        with self.lock:
+            self.sequence += 1
+            records = records.assign(run_id=self.run_id, sequence=self.sequence)
+            index, rows = self.parts.get(table, (0, 0))
+            part_file = self.part_file(table, index)
+            rows += len(records)
+            full = rows >= self.rows_per_part
+            self.parts[table] = (index + 1, 0) if full else (index, rows)
+
+            self.queue.put((part_file, table, records))
+            if full:
+                self.queue.put((part_file, table, None))
+        return part_file
+
+    def write_parts(self):
+        pending = {}  # part file -> (table, list of frames)
+        while True:
+            part_file, table, records = self.queue.get()
+            if part_file is None:
+                for pending_file, (pending_table, frames) in pending.items():
+                    self.write_part(pending_file, pending_table, frames)
+                return
+            if records is not None:
+                pending.setdefault(part_file, (table, []))[1].append(records)
+            elif part_file in pending:
+                self.write_part(part_file, *pending.pop(part_file))
+
+    def write_part(self, part_file, table, frames):
+        try:
+            schema = table_schema(table)
+            records = pd.concat(frames, ignore_index=True)
+            columns = {name: [to_plain(value) for value in records[name]] if name in records else [None] * len(records)
+                       for name in schema.names}
+            arrow_table = pa.Table.from_pydict(columns, schema=schema)
+
+            os.makedirs(os.path.dirname(part_file), exist_ok=True)
+            tmp_file = os.path.join(os.path.dirname(part_file), '.' + os.path.basename(part_file) + '.tmp')
+            pq.write_table(arrow_table, tmp_file)
+            os.replace(tmp_file, part_file)
+        except Exception as e:
+            print('could not write result part {:s}: {:s}'.format(part_file, str(e)))
+
+    def close(self):
+        """Write the parts still open and stop the writer."""
+        self.queue.put((None, None, None))
+        self.thread.join()
+
+
+def json_result_files(folder, table):
+    return sorted(glob.glob(os.path.join(folder, '*' + JSON_SUFFIXES[table])))
+
+
+def read_json_results(folder, table):
+    '''
+
+    Args:
+        folder: the folder the <image>_relation.json or <image>_elements.json files were written to, subfolders
+            are not searched
+        table: 'relations' or 'elements'
+
+    Return:
+        (pd.DataFrame) rows of every file, with the columns of empty_results(table)
+
+    '''
+    suffix = JSON_SUFFIXES[table]
+    frames = []
+    for json_file in json_result_files(folder, table):
+        if table == 'relations':
+            frame = pd.read_json(json_file).T
+            frame['relation_id'] = frame.index
+        else:
+            with open(json_file, 'r', encoding='utf-8') as json_fp:
+                json_dicts = json.load(json_fp)
+            height, width = json_dicts[0]['image_size']
+            frame = pd.DataFrame(json_dicts[1:], columns=['gene_name', 'post_gene_name', 'coordinates'])
+            frame['height'], frame['width'] = height, width
+        # the element files do not record the figure path, only their name tells the image
+        frame['image_name'] = os.path.basename(json_file)[:-len(suffix)]
+        frames.append(frame)
+    if not frames:
+        return empty_results(table)
+    results = pd.concat(frames, ignore_index=True)
+    # columns the older pipelines did not write, kept beside the ones they wrote beyond the store
+    for name in empty_results(table).columns:
+        if name not in results:
+            results[name] = None
+    return results
+
+
+def read_part(part_file, columns=None):
+    """Rows of one part with their run and sequence, parts written before rows had them get the run of the file name."""
+    names = pq.read_schema(part_file).names
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ['file_name', 'run_id', 'sequence']))
+    frame = pq.read_table(part_file, columns=[name for name in columns or names if name in names]).to_pandas()
+    if 'run_id' not in names:
+        frame['run_id'] = os.path.basename(part_file)[len('part-'):].rsplit('-', 1)[0]
+        frame['sequence'] = 0
+    return frame
+
+
+def latest_appends(results):
+    """Rows of the newest append of every figure, a figure run again is otherwise read once per run."""
+    started = results['run_id'].map(run_started)
+    append = pd.DataFrame({'started': started, 'run_id': results['run_id'], 'sequence': results['sequence']})
+    order = append.groupby(['started', 'run_id', 'sequence'], sort=True).ngroup()
+    latest = order.groupby(results['file_name']).transform('max')
+    return results[order == latest].reset_index(drop=True)
+
+
+def read_results(folder, table='relations', columns=None):
+    '''
+
+    Read every result of a table at once
+
+    Args:
+        folder: folder of the result store (<data folder>/results of pipeline_hugo), or the folder the per-figure
+            json files were written to without one (e.g. <data folder>/relation of pipeline_hugo), never both
+        table: 'relations' or 'elements'
+        columns: columns to read, all if None
+
+    Return:
+        (pd.DataFrame) one row per relation or recognized gene of every figure, of the newest run of the figure.
+        image_name is the figure name without folder and extension in both layouts, file_name the figure
+        path, None in element json files
+
+    '''
+    part_files = sorted(glob.glob(os.path.join(folder, table, '*.parquet')))
+    if part_files and json_result_files(folder, table):
+        raise ValueError('{:s} holds both a result store and {:s} files, pass the folder of one of them'.format(
+            folder, JSON_SUFFIXES[table]))
+
+    if part_files:
+        results = latest_appends(pd.concat([read_part(part_file, columns) for part_file in part_files],
+                                           ignore_index=True))
+        results['image_name'] = results['file_name'].map(image_name)
+    else:
+        results = read_json_results(folder, table)
+    return results[columns] if columns is not None else results
+
+
+if __name__ == '__main__':
+    import sys
+
+    # usage: python result_store.py <folder with per-figure json results> <store folder>
+    json_folder, store_folder = sys.argv[1], sys.argv[2]
+
+    start = time.time()
+    relations = read_json_results(json_folder, 'relations')
+    json_time = time.time() - start
+
+    store = ResultStore(store_folder)
+    for file_name, figure_relations in relations.groupby('file_name'):
+        store.append('relations', figure_relations)
+    store.close()
+
+    start = time.time()
+    stored = read_results(store_folder, 'relations')
+    print('{:d} relations: {:.2f}s from json files, {:.2f}s from the store'.format(
+        len(stored), json_time, time.time() - start))
+
+    # a rerun of the same figures appends new parts, the store still reads one copy of each figure
+    store = ResultStore(store_folder)
+    for file_name, figure_relations in relations.groupby('file_name'):
+        store.append('relations', figure_relations)
+    store.close()
+    rerun = read_results(store_folder, 'relations')
+    assert len(rerun) == len(stored) and rerun['run_id'].nunique() == 1 and rerun['run_id'][0] == store.run_id
@@ -0,0 +1,203 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import threading
+
+import cfg
+from image_manifest import get_image_manifest
+from instrumentation import metrics
+
+# every stage key covers the stages before it, so new detections rerun OCR and pairing too
+STAGES = ('detection', 'ocr', 'pairing')
+
+# bump when the layout of the checkpoints changes
+RUN_MANIFEST_VERSION = 1
+
+
+def file_stamp(file_name):
+    """Path, size and mtime of a model or dictionary file, hashing a checkpoint on every start would be slow."""
+    if not os.path.isfile(file_name):
+        return [file_name, None, None]
+    stat = os.stat(file_name)
+    return [os.path.abspath(file_name), stat.st_size, int(stat.st_mtime)]
+
+
+def code_fingerprint(*objects):
+    """Source of functions or modules, a changed rule changes the fingerprint of its stage."""
+    return [hashlib.blake2b(inspect.getsource(obj).encode('utf-8'), digest_size=8).hexdigest() for obj in objects]
+
+
+def fingerprint(*parts):
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class RunManifest(object):
+    """
+    Which stages of the figure pipeline are current for every figure of a dataset.
+
+    A stage result is keyed by the content hash of the figure (from the image manifest) and the
+    fingerprint of the stage: checkpoints, config values and the source of the code it runs, chained
+    with the stages before it. Stage results are pickled into cache_folder/<stage>/<key>.pkl, so a
+    changed pairing rule reruns pairing from the cached detections and OCR. A figure whose last stage
+    is current and whose outputs exist is skipped. The manifest is rewritten every
+    cfg.run_manifest_save_every updates and on close, a run that dies loses at most those.
+    """
+
+    def __init__(self, image_folder, cache_folder, stage_fingerprints):
+        '''
+
+        Args:
+            image_folder: folder of the figures
+            cache_folder: folder of the manifest and the stage checkpoints
+            stage_fingerprints: dict stage -> list of what the stage depends on, see STAGES
+
+        '''
+        self.image_folder = image_folder
+        self.cache_folder = cache_folder
+        self.manifest_file = os.path.join(cache_folder, 'run_manifest.json')
+        self.image_manifest = get_image_manifest(image_folder)
+
+        self.fingerprints = {}
+        previous = RUN_MANIFEST_VERSION
+        for stage in STAGES:
+            previous = fingerprint(previous, stage_fingerprints.get(stage))
+            self.fingerprints[stage] = previous
+
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        # figure name -> {stage: key}, '<stage>_outputs': paths written by a stage, 'outputs': by all of them
+        self.figures = self.load()
+        self.skipped = {stage: 0 for stage in STAGES}
+
+    def load(self):
+        try:
+            with open(self.manifest_file, 'r') as manifest_fp:
+                return json.load(manifest_fp)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        # under the lock, an older snapshot never replaces a newer one
+        with self.lock:
+            if not os.path.isdir(self.cache_folder):
+                os.makedirs(self.cache_folder)
+            tmp_file = '{:s}.{:d}.tmp'.format(self.manifest_file, os.getpid())
+            with open(tmp_file, 'w') as manifest_fp:
+                json.dump(self.figures, manifest_fp)
+            os.replace(tmp_file, self.manifest_file)
+            self.unsaved = 0
+
+    def figure_name(self, file_name):
+        return os.path.relpath(file_name, self.image_folder)
+
+    def key(self, file_name, stage):
+        entry = self.image_manifest.entries.get(self.figure_name(file_name))
+        if entry is None or entry['hash'] is None:
+            return None
+        return fingerprint(entry['hash'], self.fingerprints[stage])
+
+    def checkpoint_file(self, stage, key):
+        return os.path.join(self.cache_folder, stage, '{:s}.pkl'.format(key))
+
+    def update(self, file_name, values):
+        with self.lock:
+            self.figures.setdefault(self.figure_name(file_name), {}).update(values)
+            self.unsaved += 1
+            save = self.unsaved >= cfg.run_manifest_save_every
+        if save:
+            self.save()
+
+    def is_done(self, file_name):
+        '''
+
+        Return:
+            (bool) the last stage of the figure is current and every output it wrote still exists
+
+        '''
+        key = self.key(file_name, STAGES[-1])
+        entry = self.figures.get(self.figure_name(file_name), {})
+        done = key is not None and entry.get(STAGES[-1]) == key and \
+            all(os.path.exists(output) for output in entry.get('outputs', []))
+        if done:
+            self.skipped[STAGES[-1]] += 1
+            metrics.count('run_cache_hits_{:s}'.format(STAGES[-1]))
+        return done
+
+    def stage_outputs(self, file_name, stage):
+        """Files the current checkpoint of stage wrote for the figure, None if they were not recorded."""
+        outputs = self.figures.get(self.figure_name(file_name), {}).get(stage + '_outputs')
+        return None if outputs is None else list(outputs)
+
+    def load_checkpoint(self, file_name, stage, needs_outputs=False):
+        '''
+
+        Args:
+            file_name: figure
+            stage: one of STAGES
+            needs_outputs: the checkpoint is only current if the files its stage wrote were recorded and still exist
+
+        Return:
+            cached result of stage for the figure, None if it is missing or not current
+
+        '''
+        key = self.key(file_name, stage)
+        if key is None or self.figures.get(self.figure_name(file_name), {}).get(stage) != key:
+            return None
+        if needs_outputs:
+            outputs = self.stage_outputs(file_name, stage)
+            if outputs is None or not all(os.path.exists(output) for output in outputs):
+                return None
+        try:
+            with open(self.checkpoint_file(stage, key), 'rb') as checkpoint_fp:
+                result = pickle.load(checkpoint_fp)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        with self.lock:
+            self.skipped[stage] += 1
+        metrics.count('run_cache_hits_{:s}'.format(stage))
+        return result
+
+    def save_checkpoint(self, file_name, stage, result, outputs=None):
+        '''
+
+        Args:
+            file_name: figure
+            stage: one of STAGES
+            result: result of the stage, has to pickle
+            outputs: files the stage wrote for the figure, see load_checkpoint
+
+        '''
+        key = self.key(file_name, stage)
+        if key is None:
+            return
+        checkpoint_file = self.checkpoint_file(stage, key)
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+        tmp_file = '{:s}.{:d}.{:d}.tmp'.format(checkpoint_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'wb') as checkpoint_fp:
+            pickle.dump(result, checkpoint_fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, checkpoint_file)
+        values = {stage: key}
+        if outputs is not None:
+            values[stage + '_outputs'] = list(outputs)
+        self.update(file_name, values)
+
+    def finish(self, file_name, outputs):
+        '''
+
+        Record the last stage of a figure as current
+
+        Args:
+            file_name: figure
+            outputs: files written for the figure, the figure is rerun if one of them is removed
+
+        '''
+        key = self.key(file_name, STAGES[-1])
+        if key is not None:
+            self.update(file_name, {STAGES[-1]: key, 'outputs': list(outputs)})
+
+    def close(self):
+        self.save()
+        print('run manifest: {:s}'.format(', '.join('{:d} {:s} results reused'.format(self.skipped[stage], stage)
+                                                     for stage in STAGES)))
@@ -0,0 +1,227 @@
+from math import floor
+
+import numpy as np
+
+from identity_cache import IdentityCache
+
+# bits set in every byte value, to count the shared characters of two masks
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+# SimilarityIndex of the dictionaries in use, built once per object
+_indexes = IdentityCache(lambda gene_names: SimilarityIndex(gene_names))
+
+
+def jaro_distance(s1, s2):
+    '''
+
+    Jaro similarity of two strings as the pipelines always computed it
+
+    Kept as it was: the transposition term is (match - t + 1) / match and the transposition walk only
+    moves on in s2 at a mismatch, so scores are not the textbook Jaro and can exceed 1. Equal strings
+    score 1.0.
+
+    '''
+    if s1 == s2:
+        return 1.0
+
+    len1 = len(s1)
+    len2 = len(s2)
+
+    # maximum distance up to which matching is allowed
+    max_dist = floor(max(len1, len2) / 2) - 1
+
+    match = 0
+    hash_s1 = [0] * len1
+    hash_s2 = [0] * len2
+    for i in range(len1):
+        for j in range(max(0, i - max_dist), min(len2, i + max_dist + 1)):
+            if s1[i] == s2[j] and hash_s2[j] == 0:
+                hash_s1[i] = 1
+                hash_s2[j] = 1
+                match += 1
+                break
+
+    if match == 0:
+        return 0.0
+
+    # transpositions
+    t = 0
+    point = 0
+    for i in range(len1):
+        if hash_s1[i]:
+            while hash_s2[point] == 0:
+                point += 1
+            if s1[i] != s2[point]:
+                point += 1
+                t += 1
+    t = t // 2
+
+    return (match / len1 + match / len2 + (match - t + 1) / match) / 3.0
+
+
+def jaro_upper_bound(length, lengths, shared):
+    """
+    Highest jaro_distance a string of length can reach against entries of lengths with shared characters
+    in common. At most shared characters match and t >= 0, the score of m matches is at most
+    (m / l1 + m / l2 + 1 + 1 / m) / 3, convex in m, so it peaks at m = 1 or m = shared.
+    """
+    shared = np.maximum(shared, 1).astype(np.float64)
+    lengths = np.maximum(lengths, 1).astype(np.float64)
+    at_one = (1.0 / max(length, 1) + 1.0 / lengths + 2.0) / 3.0
+    at_shared = (shared / max(length, 1) + shared / lengths + 1.0 + 1.0 / shared) / 3.0
+    return np.maximum(at_one, at_shared)
+
+
+class SimilarityIndex(object):
+    """
+    Character masks and counts of a gene dictionary, built once, for Jaccard and Jaro matching.
+
+    Every entry gets a bitmask of its distinct characters over the alphabet of the dictionary, so the
+    Jaccard distance against every entry is a handful of numpy operations. For Jaro, entries whose upper
+    bound from length and shared character count can not beat score_cutoff are skipped, and only the
+    rest are scored. Results are the same as the per-entry loops of get_jaccard and get_jaro.
+    """
+
+    def __init__(self, gene_names):
+        self.gene_names = list(gene_names)
+        self.alphabet = {c: k for k, c in enumerate(sorted(set(''.join(self.gene_names))))}
+        self.lengths = np.array([len(name) for name in self.gene_names], dtype=np.int64)
+
+        words = max(1, (len(self.alphabet) + 63) // 64)
+        self.masks = np.zeros((len(self.gene_names), words), dtype=np.uint64)
+        for row, name in enumerate(self.gene_names):
+            for c in set(name):
+                bit = self.alphabet[c]
+                self.masks[row, bit // 64] |= np.uint64(1 << (bit % 64))
+        self.set_sizes = self.popcount(self.masks)
+
+        self.exact = {}
+        for row, name in enumerate(self.gene_names):
+            self.exact.setdefault(name, []).append(row)
+        self._counts = None
+
+    @staticmethod
+    def popcount(masks):
+        return POPCOUNT[masks.view(np.uint8)].reshape(len(masks), -1).sum(axis=1, dtype=np.int64)
+
+    @property
+    def counts(self):
+        """Occurrences of every alphabet character per entry, built on the first Jaro query."""
+        if self._counts is None:
+            counts = np.zeros((len(self.gene_names), len(self.alphabet)), dtype=np.uint8)
+            for row, name in enumerate(self.gene_names):
+                for c in name:
+                    column = self.alphabet[c]
+                    counts[row, column] = min(int(counts[row, column]) + 1, 255)
+            self._counts = counts
+        return self._counts
+
+    def query_mask(self, text):
+        mask = np.zeros((1, self.masks.shape[1]), dtype=np.uint64)
+        for c in set(text):
+            bit = self.alphabet.get(c)
+            if bit is not None:
+                mask[0, bit // 64] |= np.uint64(1 << (bit % 64))
+        return mask
+
+    def jaccard(self, text, score_cutoff):
+        '''
+
+        Args:
+            text: OCR string
+            score_cutoff: entries with a Jaccard distance above it are kept
+
+        Return:
+            (list) [gene name, nltk.jaccard_distance of the character sets] in dictionary order
+
+        '''
+        # distance above the cutoff, no bound rules an entry out, all are scored at once
+        shared = self.popcount(self.masks & self.query_mask(text))
+        union = self.set_sizes + len(set(text)) - shared
+        distances = np.where(union > 0, (union - shared) / np.maximum(union, 1), 0.0)
+        return [[self.gene_names[row], float(distances[row])] for row in np.flatnonzero(distances > score_cutoff)]
+
+    def jaro(self, text, score_cutoff):
+        '''
+
+        Args:
+            text: OCR string
+            score_cutoff: entries with a jaro_distance above it are kept
+
+        Return:
+            (list) [gene name, jaro_distance] in dictionary order
+
+        '''
+        # a little slack, the bound is computed in another order than the score
+        cutoff = score_cutoff - 1e-9
+        rows = np.flatnonzero(jaro_upper_bound(len(text), self.lengths, np.minimum(self.lengths, len(text))) > cutoff)
+
+        query_counts = np.zeros(len(self.alphabet), dtype=np.uint8)
+        for c in text:
+            column = self.alphabet.get(c)
+            if column is not None:
+                query_counts[column] = min(int(query_counts[column]) + 1, 255)
+        shared = np.minimum(self.counts[rows], query_counts).sum(axis=1, dtype=np.int64)
+
+        # an entry without shared characters scores 0 unless it equals the text
+        keep = (shared > 0) & (jaro_upper_bound(len(text), self.lengths[rows], shared) > cutoff)
+        rows = set(rows[keep].tolist()) | set(self.exact.get(text, []))
+
+        results = []
+        for row in sorted(rows):
+            jd = jaro_distance(text, self.gene_names[row])
+            if jd > score_cutoff:
+                results.append([self.gene_names[row], jd])
+        return results
+
+
+def get_similarity_index(gene_names):
+    '''
+
+    Args:
+        gene_names: list of gene names, not changed once indexed
+
+    Return:
+        (SimilarityIndex) of the list, built on first use in this process
+
+    '''
+    return _indexes.get(gene_names)
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    import nltk
+
+    from gene_dictionary import get_gene_names
+
+    gene_names = get_gene_names()
+    random.seed(0)
+    texts = []
+    for gene in random.sample(gene_names, 20):
+        pos = random.randrange(len(gene))
+        texts += [gene, gene[:pos] + random.choice('01ILO-') + gene[pos + 1:]]
+    texts += ['-', 'P', 'AKT', 'MTOR', 'PI3K']
+
+    start = time.time()
+    index = get_similarity_index(gene_names)
+    print('{:d} names indexed in {:.2f}s'.format(len(gene_names), time.time() - start))
+
+    for name, loop, indexed, cutoff in [
+            ('jaccard', lambda text: [[gene_name, nltk.jaccard_distance(set(text), set(gene_name))]
+                                      for gene_name in gene_names
+                                      if nltk.jaccard_distance(set(text), set(gene_name)) > 0.5], index.jaccard, 0.5),
+            ('jaro', lambda text: [[gene_name, jaro_distance(text, gene_name)] for gene_name in gene_names
+                                   if jaro_distance(text, gene_name) > 0.9], index.jaro, 0.9)]:
+        start = time.time()
+        expected = [loop(text) for text in texts]
+        loop_time = time.time() - start
+
+        start = time.time()
+        found = [indexed(text, cutoff) for text in texts]
+        index_time = time.time() - start
+
+        assert found == expected
+        print('{:s}: loop {:.1f} ms, index {:.1f} ms per string'.format(
+            name, loop_time * 1000 / len(texts), index_time * 1000 / len(texts)))
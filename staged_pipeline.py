@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+import traceback
+
+import cfg
+
+# end of the stream, passed from stage to stage once every item went through
+_DONE = object()
+
+
+class Stage(object):
+    """
+    One step of a StagedPipeline, run by workers threads.
+
+    function takes one item and returns the item for the next stage, None to drop it, or with
+    fan_out an iterable of items (a detection batch turning into its figures).
+    """
+
+    def __init__(self, name, function, workers=1, fan_out=False):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.fan_out = fan_out
+
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0  # seconds inside function, summed over workers
+        self.blocked = 0.0  # seconds waiting for room in the next queue, i.e. backpressure
+        self.lock = threading.Lock()
+        self.running = 0
+
+
+class StagedPipeline(object):
+    """
+    Runs items through a chain of stages that overlap in time.
+
+    Stages are connected by bounded queues of queue_size items. A stage that runs ahead blocks on its
+    full output queue, so memory stays bounded and the slowest stage sets the pace instead of the sum
+    of all stages. An item that raises is reported and dropped, the run goes on.
+    """
+
+    def __init__(self, stages, queue_size=None):
+        self.stages = stages
+        self.queue_size = queue_size or cfg.pipeline_queue_size
+        self.elapsed = 0.0
+
+    def work(self, stage, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # let the other workers of this stage see the end too, the last one passes it on
+                inbox.put(_DONE)
+                with stage.lock:
+                    stage.running -= 1
+                    last = stage.running == 0
+                if last and outbox is not None:
+                    outbox.put(_DONE)
+                return
+
+            start = time.time()
+            try:
+                result = stage.function(item)
+                results = [] if result is None else (list(result) if stage.fan_out else [result])
+            except Exception:
+                with stage.lock:
+                    stage.errors += 1
+                print('stage {:s} failed:\n{:s}'.format(stage.name, traceback.format_exc()))
+                results = []
+            busy = time.time() - start
+
+            start = time.time()
+            if outbox is not None:
+                for result in results:
+                    if result is not None:
+                        outbox.put(result)
+            with stage.lock:
+                stage.items += 1
+                stage.busy += busy
+                stage.blocked += time.time() - start
+
+    def run(self, source):
+        '''
+
+        Args:
+            source: iterable of items for the first stage, read on its own thread
+
+        Return:
+            (list) the stages, with their counters filled in
+
+        '''
+        start = time.time()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        threads = []
+        for k, stage in enumerate(self.stages):
+            outbox = queues[k + 1] if k + 1 < len(self.stages) else None
+            stage.running = stage.workers
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(stage, queues[k], outbox),
+                                          name='{:s}-{:d}'.format(stage.name, worker), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in source:
+                queues[0].put(item)
+        finally:
+            queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        self.elapsed = time.time() - start
+        return self.stages
+
+    def report(self):
+        """Print items per second of every stage, the lowest one bounds the pipeline."""
+        for stage in self.stages:
+            rate = stage.items * stage.workers / stage.busy if stage.busy > 0 else float('inf')
+            print('{:s}: {:d} items, {:d} errors, {:.2f} items/s with {:d} workers, busy {:.1f}s, '
+                  'blocked by the next stage {:.1f}s'.format(stage.name, stage.items, stage.errors, rate,
+                                                            stage.workers, stage.busy, stage.blocked))
+        print('pipeline: {:.1f}s wall time'.format(self.elapsed))
@@ -0,0 +1,115 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+import cfg
+from expand import expand
+from swaps import swap_list
+
+# characters expand splits or strips on, a token without any of them only loses its outer spaces
+EXPAND_CHARACTERS = frozenset('/|,&-')
+
+
+class TextNormalizer(object):
+    """
+    The nfkc -> deburr -> upper -> expand -> swaps chain of the pipelines as one memoized call.
+
+    An ASCII token is already NFKC and has nothing to deburr, so it is only upper-cased. expand runs
+    only for tokens with a separator, and one alternation regex of the swap keys tells whether any
+    swap applies. swaps replaces its keys one after the other, a replacement can create or hide the
+    match of a later key (KAPPA -> K turns IKKAPPAP into IKKP, II hides III), so a token with a match
+    still goes through the keys in order. Results are the same as the chain.
+    """
+
+    def __init__(self, swap_dict=None, cache_size=None):
+        self.swap_items = list((swap_list if swap_dict is None else swap_dict).items())
+        # longest first, only whether a key occurs matters here
+        self.swap_re = re.compile('|'.join(re.escape(key) for key, _ in
+                                           sorted(self.swap_items, key=lambda item: -len(item[0]))))
+        self.normalize = lru_cache(maxsize=cache_size or cfg.text_normalizer_cache_size)(self.normalize_uncached)
+
+    def normalize_uncached(self, token):
+        # nfkc, deburr and upper
+        if token.isascii():
+            text = token.upper()
+        else:
+            text = unicodedata.normalize('NFKC', token)
+            text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+            text = text.upper()
+
+        # expand, joined back into one string as the pipelines did
+        if EXPAND_CHARACTERS.isdisjoint(text):
+            text = text.strip(' ')
+        else:
+            text = ''.join(expand(text))
+
+        # swaps
+        if self.swap_re.search(text) is not None:
+            for key, value in self.swap_items:
+                text = text.upper().replace(key, value)
+        return text
+
+    def __call__(self, token):
+        return self.normalize(token)
+
+    def normalize_many(self, tokens):
+        '''
+
+        Args:
+            tokens: OCR strings, e.g. all results of a figure
+
+        Return:
+            (list) normalized token per input token
+
+        '''
+        return [self.normalize(token) for token in tokens]
+
+    def cache_info(self):
+        return self.normalize.cache_info()
+
+
+# shared by every caller of the process, the hot vocabulary is normalized once
+text_normalizer = TextNormalizer()
+
+
+def normalize_tokens(tokens):
+    return text_normalizer.normalize_many(tokens)
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    from nfkc import nfkc
+    from deburr import deburr
+    from upper import upper
+    from swaps import swaps
+
+    def chain(r):
+        r = ''.join(nfkc(r))
+        r = ''.join(deburr(r))
+        r = ''.join(upper(r))
+        r = ''.join(expand(r))
+        return ''.join(swaps(r))
+
+    # OCR output of a run: a hot vocabulary repeated over the figures, plus rarer tokens
+    random.seed(0)
+    hot = ['AKT', 'mTOR', 'PI3K', 'P13K', '-', 'P', 'NF-κB', 'TGF-β', 'IKKγ', 'Wnt9/10', 'ERK1/2', 'IL-1β',
+           'E-cadherin', 'Caspase-3', 'IFN-γ', 'TNFα', 'SMAD2/3', 'ikkappap', 'TGFBRII', 'Ca²⁺', 'café']
+    tokens = [random.choice(hot) for _ in range(20000)] + \
+        [''.join(random.choice('ABCDEFGHIKLMNPRSTW0123456789-/') for _ in range(random.randint(1, 8)))
+         for _ in range(2000)]
+
+    start = time.time()
+    expected = [chain(token) for token in tokens]
+    chain_time = time.time() - start
+
+    normalizer = TextNormalizer()
+    start = time.time()
+    found = normalizer.normalize_many(tokens)
+    normalizer_time = time.time() - start
+
+    # expand joins a set, tokens it expands to several names may come out in another order
+    same = sum(f == e or sorted(f) == sorted(e) for f, e in zip(found, expected))
+    print('{:d} tokens: chain {:.1f} ms, normalizer {:.1f} ms, {:d} same results, {}'.format(
+        len(tokens), chain_time * 1000, normalizer_time * 1000, same, normalizer.cache_info()))
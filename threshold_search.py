@@ -0,0 +1,178 @@
+import hashlib
+import os
+
+import cv2
+
+import cfg
+import OCR
+from instrumentation import metrics
+
+# OCR.hist runs the strategy named by cfg.OCR_threshold_search, 'sweep' is the histogram walk built into OCR.hist
+THRESHOLD_SEARCHES = {}
+
+# totals of this process over every searched box
+search_stats = {'boxes': 0, 'ocr_calls': 0, 'cache_hits': 0}
+
+
+def register_threshold_search(name):
+    def register(search_class):
+        THRESHOLD_SEARCHES[name] = search_class
+        return search_class
+    return register
+
+
+def bitmap_key(bitmap):
+    """Key of a binarized image, neighbouring thresholds often produce the very same bitmap."""
+    return bitmap.shape, hashlib.blake2b(bitmap.tobytes(), digest_size=16).digest()
+
+
+@register_threshold_search('ranked')
+class RankedThresholdSearch(object):
+    """
+    Threshold search of one text box that tries the most promising thresholds first.
+
+    The Otsu threshold of the box is tried first, then the sub step grid of the histogram sweep ordered
+    by distance to it. Every bitmap is OCR'd and corrected once, a threshold that reproduces a bitmap
+    already seen costs a hash only. The search stops as soon as a correction reaches cfg.threshold,
+    or once the best correction (at least cfg.early_stop_threshold) came out of cfg.patience bitmaps.
+    """
+
+    def __init__(self, dst_folder, dst_file, log_file, user_words):
+        self.dst_folder = dst_folder
+        self.dst_file = dst_file
+        self.log_file = log_file
+        self.user_words = user_words
+
+        self.memo = {}  # bitmap key -> (result, corrections)
+        self.ocr_calls = 0
+        self.cache_hits = 0
+
+    def candidate_thresholds(self, image):
+        otsu_thresh, _ = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        otsu_thresh = int(otsu_thresh)
+
+        sub_step = cfg.OCR_hist_step_size // cfg.OCR_hist_num_sub_steps
+        grid = [thresh for thresh in range(sub_step, 255, sub_step) if thresh != otsu_thresh]
+        grid.sort(key=lambda thresh: (abs(thresh - otsu_thresh), thresh))
+
+        return ([otsu_thresh] + grid)[:cfg.OCR_search_max_thresholds]
+
+    def correct(self, bitmap, thresh):
+        """
+        (result, corrections) of one bitmap, None if the same bitmap was already tried.
+        """
+        key = bitmap_key(bitmap)
+        if key in self.memo:
+            self.cache_hits += 1
+            metrics.count('threshold_cache_hits')
+            return None
+
+        dst_name, dst_ext = os.path.splitext(self.dst_file)
+        raw_result = OCR.ocr_threshold_image(self.dst_folder, dst_name + "_" + str(thresh) + dst_ext, bitmap)
+        self.ocr_calls += 1
+
+        self.memo[key] = OCR.correct_ocr_result(raw_result, self.user_words)
+        return self.memo[key]
+
+    def run(self, image, test_vertical=False):
+        '''
+
+        Args:
+            image: grayscale text box
+            test_vertical: also try the box rotated 90c and 90cc, before the upright box
+
+        Return:
+            best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
+            all_results, corrected_results, fuzz_ratios, count, as the histogram sweep in OCR.hist
+
+        '''
+
+        best_result = ''
+        best_corrected_result = ''
+        best_fuzz_ratio = -1
+        best_thresh = -1
+
+        all_results = set()
+        corrected_results = []
+        fuzz_ratios = []
+        confirmations = 0  # bitmaps whose top correction is the current best
+
+        orientations = [image]
+        if test_vertical:
+            orientations = [cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE),
+                            cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE), image]
+
+        # rotations keep the histogram, one ranking serves every orientation
+        thresholds = self.candidate_thresholds(image)
+
+        for oriented in orientations:
+            for thresh in thresholds:
+                ret, bitmap = cv2.threshold(oriented, thresh, 255, cv2.THRESH_BINARY)
+                corrected = self.correct(bitmap, thresh)
+                if corrected is None:
+                    continue
+
+                result, corrections = corrected
+                if not result:
+                    continue
+                all_results.add(result)
+                if not corrections:
+                    continue
+
+                OCR.display(str(thresh) + ": \t" + str(result) + " \t" + str(corrections[0][0]) +
+                            " \t" + str(corrections[0][1]), file=self.log_file)
+
+                previous_best = best_corrected_result
+                best_result, best_corrected_result, best_fuzz_ratio, best_thresh = \
+                    OCR.record_corrections(thresh, result, corrections,
+                                           best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
+                                           all_results, corrected_results, fuzz_ratios)
+
+                if best_corrected_result != previous_best:
+                    confirmations = 0
+                if corrections[0][0] == best_corrected_result and corrections[0][1] >= cfg.early_stop_threshold:
+                    confirmations += 1
+
+                if best_fuzz_ratio >= cfg.threshold or confirmations >= cfg.patience:
+                    return self.finish(best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
+                                       all_results, corrected_results, fuzz_ratios, cfg.patience)
+
+        return self.finish(best_result, best_corrected_result, best_fuzz_ratio, best_thresh,
+                           all_results, corrected_results, fuzz_ratios, confirmations)
+
+    def finish(self, *results):
+        search_stats['boxes'] += 1
+        search_stats['ocr_calls'] += self.ocr_calls
+        search_stats['cache_hits'] += self.cache_hits
+        return results
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    from gene_dictionary import get_gene_names
+
+    # usage: python threshold_search.py <folder of cropped text boxes>
+    box_folder = sys.argv[1]
+    work_folder = os.path.join(box_folder, 'threshold_search')
+    if not os.path.isdir(work_folder):
+        os.makedirs(work_folder)
+
+    user_words = get_gene_names(upper=False)
+    box_files = sorted(f for f in os.listdir(box_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+
+    for strategy in ['sweep', 'ranked']:
+        cfg.OCR_threshold_search = strategy
+        OCR.ocr_call_count = 0
+        found = 0
+        start = time.time()
+        for box_file in box_files:
+            results = OCR.hist(box_folder, box_file, os.path.join(work_folder, 'log.txt'), user_words,
+                               hist_folder=work_folder, hist_file=box_file)
+            if isinstance(results, tuple) and results[2] >= cfg.threshold:
+                found += 1
+        print('{:s}: {:.2f} OCR calls per box, {:d}/{:d} boxes corrected, {:.2f}s'.format(
+            strategy, OCR.ocr_call_count / max(len(box_files), 1), found, len(box_files), time.time() - start))
+
+    print('ranked: {:d} repeated bitmaps skipped'.format(search_stats['cache_hits']))
@@ -0,0 +1,101 @@
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cfg
+
+VISUALIZE_MODES = ('off', 'sampled', 'on_failure', 'on')
+
+
+class VisualizationPolicy(object):
+    """
+    Decides which figures get debug renderings and draws them on a background thread pool.
+
+    cfg.visualize_mode selects:
+        'off'        never render
+        'sampled'    render 1 in cfg.visualize_sample_every figures, picked by a hash of the figure name
+                     so every rendering of a sampled figure is kept
+        'on_failure' render only figures the caller reports as failed
+        'on'         render every figure
+    """
+
+    def __init__(self, mode=None, sample_every=None, workers=None):
+        self.mode = mode or cfg.visualize_mode
+        if self.mode not in VISUALIZE_MODES:
+            raise ValueError('visualize_mode has to be one of {}, got {!r}'.format(VISUALIZE_MODES, self.mode))
+        self.sample_every = max(1, sample_every or cfg.visualize_sample_every)
+        self.workers = workers or cfg.visualize_workers
+
+        # render is called from several pipeline threads at once
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = []
+
+    def should_render(self, figure, failed=False):
+        if self.mode == 'off':
+            return False
+        if self.mode == 'on':
+            return True
+        if self.mode == 'on_failure':
+            return failed
+        return zlib.crc32(str(figure).encode('utf-8')) % self.sample_every == 0
+
+    def render(self, figure, draw, *args, failed=False):
+        '''
+
+        Queue one rendering if the policy selects this figure
+
+        Args:
+            figure: name of the figure, the sampling key
+            draw: callable that renders and writes the visualization, called with *args
+            failed: the caller found no usable result for this figure
+
+        Return:
+            (bool) whether the rendering was queued
+
+        draw runs later on another thread, the caller must not modify args afterwards
+
+        '''
+        if not self.should_render(figure, failed):
+            return False
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.pending.append((figure, self.executor.submit(draw, *args)))
+
+            # drop finished renderings, report their errors without stopping the run
+            still_pending = []
+            for pending_figure, future in self.pending:
+                if future.done():
+                    self.report(pending_figure, future)
+                else:
+                    still_pending.append((pending_figure, future))
+            self.pending = still_pending
+        return True
+
+    def report(self, figure, future):
+        error = future.exception()
+        if error is not None:
+            print('visualization of {:s} failed: {:s}'.format(str(figure), str(error)))
+
+    def close(self):
+        """Wait for every queued rendering."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            executor, self.executor = self.executor, None
+        for figure, future in pending:
+            self.report(figure, future)
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+# policy shared by every stage of this process
+visualization_policy = None
+
+
+def get_visualization_policy():
+    global visualization_policy
+    if visualization_policy is None:
+        visualization_policy = VisualizationPolicy()
+    return visualization_policy